@@ -4,3 +4,6 @@ db.entities.createIndex(
   { "location.value": "2dsphere" },
   { name: "location_value_2dsphere" }
 );
+
+// Lets mongo_to_influx fetch only the entities modified since its last run.
+db.entities.createIndex({ modDate: 1 }, { name: "modDate_1" });
@@ -0,0 +1,361 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from datetime import datetime, timezone
+import numpy as np
+import requests
+import fiware
+import metrics
+import spatial_index
+from schedule_index import build_schedule_index
+
+# Logging configuration
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+formatter = logging.Formatter("[%(levelname)s] %(asctime)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.propagate = False
+
+WEATHER_API_URL = os.environ.get(
+    "WEATHER_API_URL", "https://api.open-meteo.com/v1/forecast"
+)
+WEATHER_API_TIMEOUT = float(os.environ.get("WEATHER_API_TIMEOUT", "10"))
+WEATHER_API_MAX_LOCATIONS = int(os.environ.get("WEATHER_API_MAX_LOCATIONS", "100"))
+
+# Every PLANNER_INTERVAL seconds, the classes of the next PLANNER_HORIZON_HOURS are
+# checked against the hourly precipitation forecast of their grid cell.
+PLANNER_INTERVAL = float(os.environ.get("PLANNER_INTERVAL", "3600"))
+PLANNER_HORIZON_HOURS = float(os.environ.get("PLANNER_HORIZON_HOURS", "24"))
+PLANNER_CELL_DEG = float(os.environ.get("PLANNER_CELL_DEG", "0.01"))
+PLANNER_RUN_ONCE = os.environ.get("PLANNER_RUN_ONCE", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+# Hourly precipitation (mm) counted as rain, and from which the alert is "high".
+RAIN_THRESHOLD_MM = float(os.environ.get("PLANNER_RAIN_THRESHOLD_MM", "0.2"))
+HEAVY_RAIN_MM = float(os.environ.get("PLANNER_HEAVY_RAIN_MM", "7.6"))
+
+COURSE_ATTRS = ["location", "classSchedule"]
+ALERT_ID_PREFIX = "Alert:Forecast:"
+HOUR = 3600
+# Open-Meteo serves up to 16 forecast days.
+MAX_FORECAST_DAYS = 16
+
+# alert id -> content hash of the last alert written, to skip unchanged alerts.
+published = {}
+
+
+def forecast_cell(lat, lon, cell_deg=PLANNER_CELL_DEG):
+    """
+    Returns the grid cell containing (lat, lon) and the cell center.
+    """
+    row = math.floor(lat / cell_deg)
+    col = math.floor(lon / cell_deg)
+    center_lat = round((row + 0.5) * cell_deg, 6)
+    center_lon = round((col + 0.5) * cell_deg, 6)
+    return (row, col), center_lat, center_lon
+
+
+def fetch_precipitation(http, centers, hour_starts):
+    """
+    Fetches the hourly precipitation forecast of many cells with Open-Meteo's comma
+    separated latitude/longitude lists, WEATHER_API_MAX_LOCATIONS cells per request.
+    Args:
+        centers (list): (lat, lon) of each cell center.
+        hour_starts (ndarray): Epoch seconds of the hours to fill, shape (H,).
+    Returns:
+        tuple: (precipitation, requests). precipitation is a (cells, H) array of mm
+        per hour, NaN where the forecast is unavailable.
+    """
+    precipitation = np.full((len(centers), len(hour_starts)), np.nan)
+    if not centers:
+        return precipitation, 0
+    midnight = hour_starts[0] - hour_starts[0] % 86400
+    days = math.ceil((hour_starts[-1] + HOUR - midnight) / 86400)
+    params = {
+        "hourly": "precipitation",
+        "forecast_days": min(max(days, 1), MAX_FORECAST_DAYS),
+        "timeformat": "unixtime",
+        "timezone": "GMT",
+    }
+
+    sent = 0
+    for first in range(0, len(centers), WEATHER_API_MAX_LOCATIONS):
+        chunk = centers[first : first + WEATHER_API_MAX_LOCATIONS]
+        results = get_forecast(http, chunk, params)
+        sent += 1
+        for row, data in enumerate(results or [], first):
+            hourly = data.get("hourly") or {}
+            times = np.asarray(hourly.get("time") or [], dtype=np.int64)
+            values = np.asarray(hourly.get("precipitation") or [], dtype=float)
+            if len(times) != len(values):
+                continue
+            columns = (times - hour_starts[0]) // HOUR
+            valid = (columns >= 0) & (columns < len(hour_starts))
+            precipitation[row, columns[valid]] = values[valid]
+    return precipitation, sent
+
+
+def get_forecast(http, locations, params):
+    """
+    Calls Open-Meteo for a list of (lat, lon) locations.
+    Returns:
+        list: One result per location, in request order, or None on failure.
+    """
+    query = dict(params)
+    query["latitude"] = ",".join(str(lat) for lat, _ in locations)
+    query["longitude"] = ",".join(str(lon) for _, lon in locations)
+    started = time.perf_counter()
+    status = "error"
+    try:
+        res = http.get(WEATHER_API_URL, params=query, timeout=WEATHER_API_TIMEOUT)
+        status = res.status_code
+        if res.status_code != 200:
+            logger.warning(f"Failed forecast API call. Status: {res.status_code}")
+            return None
+        data = res.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error(f"Forecast fetch error: {e}")
+        return None
+    finally:
+        metrics.EXTERNAL_API_SECONDS.labels("open-meteo", str(status)).observe(
+            time.perf_counter() - started
+        )
+
+    # A single location is returned as an object, several as a list.
+    if isinstance(data, dict):
+        data = [data]
+    if len(data) != len(locations):
+        logger.warning(
+            f"Forecast API returned {len(data)} results for {len(locations)} locations"
+        )
+        return None
+    return data
+
+
+def rain_windows(starts, ends, cells, precipitation, hour_starts, threshold):
+    """
+    Joins every class session with the hourly forecast of its cell in one pass.
+    Args:
+        starts (ndarray): Session starts, epoch seconds, shape (S,).
+        ends (ndarray): Session ends, epoch seconds, shape (S,).
+        cells (ndarray): Row of each session's cell in precipitation, shape (S,).
+        precipitation (ndarray): mm per hour, shape (cells, H), NaN when unknown.
+        hour_starts (ndarray): Epoch seconds of each precipitation column, shape (H,).
+        threshold (float): Hourly precipitation (mm) counted as rain.
+    Returns:
+        tuple: Arrays of shape (S,): whether rain overlaps the session, the start
+        and end of the rain within it (epoch seconds), and the peak and total mm.
+    """
+    hours = precipitation[cells]
+    overlaps = (hour_starts < ends[:, None]) & (hour_starts + HOUR > starts[:, None])
+    wet = overlaps & (np.nan_to_num(hours) >= threshold)
+
+    rainy = wet.any(axis=1)
+    first = wet.argmax(axis=1)
+    last = wet.shape[1] - 1 - wet[:, ::-1].argmax(axis=1)
+    rain_start = np.maximum(starts, hour_starts[first])
+    rain_end = np.minimum(ends, hour_starts[last] + HOUR)
+    rain = np.where(wet, hours, 0.0)
+    return rainy, rain_start, rain_end, rain.max(axis=1), rain.sum(axis=1)
+
+
+def format_iso_utc(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+
+
+def build_alert(course, rain_start, rain_end, peak_mm, total_mm, issued):
+    course_id = course["id"]
+    start = datetime.fromtimestamp(rain_start, timezone.utc)
+    end = datetime.fromtimestamp(rain_end, timezone.utc)
+    # Orion rejects quotes and parentheses in attribute values.
+    description = (
+        f"Rain forecast during the class of course {course_id} between "
+        f"{start:%H:%M} and {end:%H:%M}, {total_mm:.1f} mm in total."
+    )
+    return {
+        "id": f"{ALERT_ID_PREFIX}{course_id}",
+        "type": "Alert",
+        "category": {"value": "weather", "type": "Text"},
+        "subCategory": {"value": "rainfall", "type": "Text"},
+        "description": {"value": description, "type": "Text"},
+        "location": course["location"],
+        "dateIssued": {"type": "DateTime", "value": issued},
+        "validFrom": {"type": "DateTime", "value": format_iso_utc(rain_start)},
+        "validTo": {"type": "DateTime", "value": format_iso_utc(rain_end)},
+        "alertSource": {"value": "Weather Forecast Planner", "type": "Text"},
+        "severity": {"value": "high" if peak_mm >= HEAVY_RAIN_MM else "medium"},
+        "affectedEntity": {"type": "Relationship", "value": course_id},
+    }
+
+
+def alert_content_hash(alert):
+    """
+    Hash of the alert without dateIssued, so an alert planned again unchanged is
+    not written again.
+    """
+    content = {name: value for name, value in alert.items() if name != "dateIssued"}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def plan_alerts(courses, http, now=None, horizon_hours=PLANNER_HORIZON_HOURS):
+    """
+    Finds the courses whose next class in horizon_hours overlaps forecast rain.
+    Args:
+        courses (list): CourseInstance entities with location and classSchedule.
+        http (requests.Session): Session used for Open-Meteo.
+        now (datetime, optional): Timezone-aware reference time, now by default.
+    Returns:
+        tuple: (alerts, unknown, stats). alerts are the Alert entities, one per
+        course, and unknown the IDs of courses whose forecast was unavailable.
+    """
+    now = now or datetime.now(timezone.utc)
+    courses = {
+        course["id"]: course
+        for course in courses
+        if course.get("id") and spatial_index.entity_coordinates(course)
+    }
+    schedules = build_schedule_index(courses.values())
+    sessions = schedules.sessions(now, horizon_hours)
+
+    cell_rows = {}
+    centers = []
+    cells = np.empty(len(sessions), dtype=np.int64)
+    starts = np.empty(len(sessions), dtype=np.float64)
+    ends = np.empty(len(sessions), dtype=np.float64)
+    for i, session in enumerate(sessions):
+        lat, lon = spatial_index.entity_coordinates(courses[session.course_id])
+        key, center_lat, center_lon = forecast_cell(lat, lon)
+        if key not in cell_rows:
+            cell_rows[key] = len(centers)
+            centers.append((center_lat, center_lon))
+        cells[i] = cell_rows[key]
+        starts[i] = session.start.timestamp()
+        ends[i] = session.end.timestamp()
+
+    first_hour = math.floor(now.timestamp() / HOUR) * HOUR
+    last_end = ends.max() if len(sessions) else now.timestamp()
+    hour_starts = np.arange(first_hour, last_end, HOUR, dtype=np.int64)
+    if not len(hour_starts):
+        hour_starts = np.array([first_hour], dtype=np.int64)
+    precipitation, api_requests = fetch_precipitation(http, centers, hour_starts)
+    rainy, rain_start, rain_end, peak, total = rain_windows(
+        starts, ends, cells, precipitation, hour_starts, RAIN_THRESHOLD_MM
+    )
+
+    # Sessions are ordered by day then start, so the first rainy one of a course is
+    # its next class with rain.
+    issued = now.strftime("%Y-%m-%dT%H:%M:%SZ")
+    unknown_cells = np.isnan(precipitation).all(axis=1)
+    alerts = {}
+    unknown = set()
+    for i in np.flatnonzero(rainy | unknown_cells[cells]):
+        course_id = sessions[i].course_id
+        if unknown_cells[cells[i]]:
+            unknown.add(course_id)
+        elif course_id not in alerts:
+            alerts[course_id] = build_alert(
+                courses[course_id],
+                rain_start[i],
+                rain_end[i],
+                peak[i],
+                total[i],
+                issued,
+            )
+
+    stats = {
+        "courses": len(courses),
+        "sessions": len(sessions),
+        "cells": len(centers),
+        "api_requests": api_requests,
+        "unknown_cells": int(unknown_cells.sum()),
+        "alerts": len(alerts),
+    }
+    return list(alerts.values()), unknown, stats
+
+
+def existing_alert_ids():
+    return {
+        entity["id"]
+        for entity in fiware.iter_entities(
+            "Alert",
+            attrs="id",
+            key_values=True,
+            params={"idPattern": f"^{ALERT_ID_PREFIX}"},
+        )
+    }
+
+
+def run_once(http, now=None):
+    """
+    Plans the alerts of the next classes and brings Orion in line with the plan:
+    new and changed alerts are written in bulk, and alerts for classes no longer
+    forecast to have rain are deleted. Courses whose forecast is unavailable keep
+    their alert.
+    Returns:
+        dict: Counters of the run.
+    """
+    started = time.perf_counter()
+    courses = list(fiware.iter_entities("CourseInstance", attrs=COURSE_ATTRS))
+    alerts, unknown, stats = plan_alerts(courses, http, now)
+    stats.update(written=0, failed=0, deleted=0)
+
+    changed = []
+    for alert in alerts:
+        content_hash = alert_content_hash(alert)
+        if published.get(alert["id"]) != content_hash:
+            changed.append((alert, content_hash))
+    if changed:
+        result = fiware.batch_upsert([alert for alert, _ in changed])
+        logger.info(f"Forecast alerts {result.summary()}")
+        for alert, content_hash in changed:
+            if alert["id"] in result.succeeded:
+                published[alert["id"]] = content_hash
+        stats["written"] = len(result.succeeded)
+        stats["failed"] = len(result.errors)
+
+    planned = {alert["id"] for alert in alerts}
+    planned.update(f"{ALERT_ID_PREFIX}{course_id}" for course_id in unknown)
+    stale = sorted(existing_alert_ids() - planned)
+    if stale:
+        result = fiware.batch_delete("Alert", stale)
+        logger.info(f"Stale forecast alerts {result.summary()}")
+        for alert_id in result.succeeded:
+            published.pop(alert_id, None)
+        stats["deleted"] = len(result.succeeded)
+
+    stats["unchanged"] = len(alerts) - len(changed)
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    logger.info(
+        f"Planned {stats['alerts']} forecast alerts for {stats['sessions']} sessions "
+        f"of {stats['courses']} courses in {stats['cells']} cells "
+        f"({stats['api_requests']} forecast requests) in {stats['seconds']}s"
+    )
+    return stats
+
+
+def main():
+    metrics.start_reporter("alert_planner")
+    fiware.wait_for_orion()
+    with requests.Session() as http:
+        while True:
+            started = time.monotonic()
+            try:
+                run_once(http)
+            except Exception as e:
+                logger.error(f"Alert planning failed: {e}", exc_info=True)
+            if PLANNER_RUN_ONCE:
+                return
+            time.sleep(max(PLANNER_INTERVAL - (time.monotonic() - started), 0))
+
+
+if __name__ == "__main__":
+    main()
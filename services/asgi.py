@@ -0,0 +1,87 @@
+import json
+import logging
+import fiware_async
+
+logger = logging.getLogger("asgi")
+
+
+def make_asgi_app(routes):
+    """
+    Build a minimal ASGI application that serves the notification endpoints of a service.
+
+    Running the service on an ASGI server (e.g. uvicorn) keeps a single event loop per
+    worker, so the pooled fiware_async client is shared by every request and one worker
+    can overlap many Orion calls instead of serializing them.
+
+    Args:
+        routes (dict): Maps (method, path) to an async handler. POST handlers receive the
+            decoded JSON body, other methods receive None. A handler returns a status code
+            or a (status, body, content_type[, headers]) tuple.
+    Returns:
+        callable: The ASGI application.
+    """
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await _lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        handler = routes.get((scope["method"], scope["path"]))
+        if handler is None:
+            await _respond(send, 404)
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        payload = None
+        if scope["method"] == "POST":
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                logger.warning(f"Invalid JSON body on {scope['path']}")
+                await _respond(send, 400)
+                return
+
+        try:
+            result = await handler(payload)
+        except Exception as e:
+            logger.exception(f"Error handling {scope['method']} {scope['path']}: {e}")
+            await _respond(send, 500)
+            return
+
+        if isinstance(result, tuple):
+            await _respond(send, *result)
+        else:
+            await _respond(send, result)
+
+    return app
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await fiware_async.close_client()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def _respond(send, status, body=b"", content_type="text/plain", extra_headers=None):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    headers = [(b"content-length", str(len(body)).encode())]
+    if body:
+        headers.append((b"content-type", content_type.encode()))
+    for name, value in (extra_headers or {}).items():
+        headers.append((name.lower().encode(), str(value).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,154 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Open-Meteo refreshes current weather every 15 minutes.
+UPDATE_INTERVAL = 900
+
+
+class _Server(ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class FakeOpenMeteo:
+    """
+    In-process stand-in for Open-Meteo's /v1/forecast endpoint: current_weather and
+    the hourly precipitation forecast, including comma separated multi-location
+    requests.
+
+    Args:
+        latency (float): Seconds added to every response.
+        weathercode (int): Weather code returned for every location.
+        precipitation (float): Hourly precipitation (mm) forecast in rain hours.
+        rain_hours (iterable, optional): UTC hours of the day with rain; every hour
+            when not set.
+    """
+
+    def __init__(self, latency=0.0, weathercode=61, precipitation=1.5, rain_hours=None):
+        self.latency = latency
+        self.weathercode = weathercode
+        self.precipitation = precipitation
+        self.rain_hours = set(range(24) if rain_hours is None else rain_hours)
+        self.requests = 0
+        self.locations = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/forecast"
+
+    def start(self, host="127.0.0.1", port=0):
+        handler = type("FakeOpenMeteoHandler", (_Handler,), {"meteo": self})
+        self._server = _Server((host, port), handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def forecast(self, latitudes, longitudes):
+        now = datetime.now(timezone.utc)
+        slot = now.replace(minute=now.minute // 15 * 15, second=0, microsecond=0)
+        return [
+            {
+                "latitude": float(lat),
+                "longitude": float(lon),
+                "current_weather_units": {"temperature": "°C", "windspeed": "km/h"},
+                "current_weather": {
+                    "time": slot.strftime("%Y-%m-%dT%H:%M"),
+                    "interval": UPDATE_INTERVAL,
+                    "temperature": 27.5,
+                    "windspeed": 12.0,
+                    "winddirection": 90,
+                    "is_day": 1,
+                    "weathercode": self.weathercode,
+                },
+            }
+            for lat, lon in zip(latitudes, longitudes)
+        ]
+
+    def hourly_forecast(self, latitudes, longitudes, params):
+        """
+        Hourly precipitation from 00:00 UTC today for forecast_days days, with times
+        as ISO strings or, with timeformat=unixtime, epoch seconds.
+        """
+        today = datetime.now(timezone.utc).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        hours = [
+            today + timedelta(hours=i)
+            for i in range(24 * int(params.get("forecast_days", 7)))
+        ]
+        if params.get("timeformat") == "unixtime":
+            times = [int(hour.timestamp()) for hour in hours]
+        else:
+            times = [hour.strftime("%Y-%m-%dT%H:%M") for hour in hours]
+        precipitation = [
+            self.precipitation if hour.hour in self.rain_hours else 0.0
+            for hour in hours
+        ]
+        return [
+            {
+                "latitude": float(lat),
+                "longitude": float(lon),
+                "utc_offset_seconds": 0,
+                "hourly_units": {
+                    "time": params.get("timeformat", "iso8601"),
+                    "precipitation": "mm",
+                },
+                "hourly": {"time": times, "precipitation": precipitation},
+            }
+            for lat, lon in zip(latitudes, longitudes)
+        ]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    meteo = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        meteo = self.meteo
+        query = parse_qs(urlparse(self.path).query)
+        params = {key: values[0] for key, values in query.items()}
+        latitudes = params.get("latitude", "").split(",")
+        longitudes = params.get("longitude", "").split(",")
+        with meteo._lock:
+            meteo.requests += 1
+            meteo.locations += len(latitudes)
+        if meteo.latency:
+            time.sleep(meteo.latency)
+
+        if len(latitudes) != len(longitudes) or not latitudes[0]:
+            status, body = 400, {"error": True, "reason": "Invalid coordinates"}
+        else:
+            if "hourly" in params:
+                results = meteo.hourly_forecast(latitudes, longitudes, params)
+            else:
+                results = meteo.forecast(latitudes, longitudes)
+            # A single location is returned as an object, several as a list.
+            status, body = 200, results if len(results) > 1 else results[0]
+
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,409 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from spatial_index import haversine_meters
+
+# Orion caps pages at 1000 entities and defaults to 20.
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 1000
+
+_ENTITY_PATH = re.compile(r"^/v2/entities/([^/]+)$")
+_ATTRS_PATH = re.compile(r"^/v2/entities/([^/]+)/attrs$")
+_SUBSCRIPTION_PATH = re.compile(r"^/v2/subscriptions/([^/]+)$")
+
+
+class _Server(ThreadingHTTPServer):
+    # The default backlog of 5 resets connections under concurrent benchmark load.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def _key_values(entity):
+    return {
+        name: attr["value"] if isinstance(attr, dict) and "value" in attr else attr
+        for name, attr in entity.items()
+    }
+
+
+def _project(entity, attrs):
+    return {
+        name: value
+        for name, value in entity.items()
+        if name in ("id", "type") or name in attrs
+    }
+
+
+def _attrs(entity):
+    return {name: value for name, value in entity.items() if name not in ("id", "type")}
+
+
+def _coordinates(entity):
+    value = entity.get("location", {}).get("value", {})
+    coordinates = value.get("coordinates") if isinstance(value, dict) else None
+    if not coordinates or len(coordinates) < 2:
+        return None
+    return coordinates[1], coordinates[0]
+
+
+class FakeOrion:
+    """
+    In-process stand-in for the subset of the Orion NGSI v2 API used by the services:
+    entity CRUD, attribute updates, op/update batches, paged queries with type, id,
+    idPattern, attrs, keyValues, count and georel near filters, and subscriptions.
+    Subscriptions are stored but never notified.
+
+    Latency and failures can be injected to see how clients behave on a slow or
+    flaky broker.
+
+    Args:
+        latency (float): Seconds added to every response.
+        jitter (float): Random extra latency, uniform between 0 and jitter seconds.
+        failure_rate (float): Fraction of requests answered with failure_status.
+        failure_status (int): Status code of injected failures.
+        seed (int): Seed of the latency and failure random generator.
+    """
+
+    def __init__(
+        self, latency=0.0, jitter=0.0, failure_rate=0.0, failure_status=503, seed=0
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.entities = {}
+        self.subscriptions = {}
+        # (method, path, body) of every write request, in arrival order.
+        self.writes = []
+        self.requests = 0
+        self.failures = 0
+        self._subscription_seq = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host="127.0.0.1", port=0):
+        handler = type("FakeOrionHandler", (_Handler,), {"orion": self})
+        self._server = _Server((host, port), handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset(self):
+        """
+        Removes every entity. Subscriptions, the write log and counters are kept.
+        """
+        with self._lock:
+            self.entities.clear()
+
+    def _injected_failure(self):
+        with self._lock:
+            self.requests += 1
+            delay = self.latency
+            if self.jitter:
+                delay += self._random.uniform(0, self.jitter)
+            failed = self.failure_rate and self._random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        if delay:
+            time.sleep(delay)
+        return failed
+
+    def query(self, params):
+        """
+        Returns (entities, total) for GET /v2/entities query parameters.
+        """
+        types = set(params["type"].split(",")) if "type" in params else None
+        ids = set(params["id"].split(",")) if "id" in params else None
+        id_pattern = re.compile(params["idPattern"]) if "idPattern" in params else None
+        near = self._near_filter(params)
+
+        with self._lock:
+            matches = [
+                entity
+                for entity in self.entities.values()
+                if (types is None or entity.get("type") in types)
+                and (ids is None or entity["id"] in ids)
+                and (id_pattern is None or id_pattern.search(entity["id"]))
+            ]
+        if near:
+            lat, lon, max_distance = near
+            distances = []
+            for entity in matches:
+                coords = _coordinates(entity)
+                if coords:
+                    distance = haversine_meters(lat, lon, coords[0], coords[1])
+                    if distance <= max_distance:
+                        distances.append((distance, entity["id"], entity))
+            distances.sort(key=lambda d: d[:2])
+            matches = [entity for _, _, entity in distances]
+        else:
+            matches.sort(key=lambda entity: entity["id"])
+
+        total = len(matches)
+        offset = int(params.get("offset", 0))
+        limit = min(int(params.get("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+        page = matches[offset : offset + limit]
+
+        attrs = set(params["attrs"].split(",")) if params.get("attrs") else None
+        key_values = "keyValues" in params.get("options", "").split(",")
+        result = []
+        for entity in page:
+            if attrs:
+                entity = _project(entity, attrs)
+            # Copies, so callers never mutate the stored entities.
+            if key_values:
+                entity = _key_values(entity)
+            else:
+                entity = json.loads(json.dumps(entity))
+            result.append(entity)
+        return result, total
+
+    @staticmethod
+    def _near_filter(params):
+        georel = params.get("georel")
+        if not georel:
+            return None
+        relation, _, modifier = georel.partition(";")
+        if relation != "near" or not modifier.startswith("maxDistance:"):
+            raise ValueError(f"Unsupported georel {georel}")
+        lat, lon = (float(part) for part in params["coords"].split(","))
+        return lat, lon, float(modifier.split(":", 1)[1])
+
+    def batch(self, action_type, entities):
+        """
+        Applies an op/update batch. Returns the IDs that could not be applied.
+        """
+        missing = []
+        with self._lock:
+            for entity in entities:
+                entity_id = entity["id"]
+                current = self.entities.get(entity_id)
+                if action_type == "delete":
+                    if self.entities.pop(entity_id, None) is None:
+                        missing.append(entity_id)
+                elif action_type in ("update", "replace") and current is None:
+                    missing.append(entity_id)
+                elif action_type == "appendStrict" and current is not None:
+                    missing.append(entity_id)
+                elif action_type == "replace":
+                    self.entities[entity_id] = {
+                        "id": entity_id,
+                        "type": current["type"],
+                        **_attrs(entity),
+                    }
+                elif current is None:
+                    self.entities[entity_id] = dict(entity)
+                else:
+                    current.update(_attrs(entity))
+        return missing
+
+    def add_subscription(self, subscription):
+        with self._lock:
+            self._subscription_seq += 1
+            subscription_id = f"{self._subscription_seq:024x}"
+            subscription = {**subscription, "id": subscription_id}
+            self.subscriptions[subscription_id] = subscription
+        return subscription_id
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    orion = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        data = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.send_header("Content-Length", str(len(data)))
+        if data:
+            self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, error, description):
+        self._send(status, {"error": error, "description": description})
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = self._body() if method in ("POST", "PUT", "PATCH") else None
+        if method != "GET":
+            with self.orion._lock:
+                self.orion.writes.append((method, url.path, body))
+        if self.orion._injected_failure():
+            self._error(
+                self.orion.failure_status, "InternalServerError", "Injected failure"
+            )
+            return
+        handler = getattr(self, f"_{method.lower()}", None)
+        try:
+            handled = handler(url.path, params, body) if handler else False
+        except (ValueError, KeyError, TypeError) as e:
+            self._error(400, "BadRequest", str(e))
+            return
+        if handled is False:
+            self._error(404, "NotFound", "The requested resource could not be found")
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _get(self, path, params, _body):
+        orion = self.orion
+        if path == "/version":
+            return self._send(200, {"orion": {"version": "fake"}})
+        if path == "/v2/entities":
+            entities, total = orion.query(params)
+            count = "count" in params.get("options", "").split(",")
+            headers = {"Fiware-Total-Count": total} if count else None
+            return self._send(200, entities, headers)
+        match = _ENTITY_PATH.match(path)
+        if match:
+            query = {**params, "id": unquote(match.group(1)), "limit": 1}
+            entities, _ = orion.query(query)
+            if not entities:
+                return False
+            return self._send(200, entities[0])
+        if path == "/v2/subscriptions":
+            with orion._lock:
+                subscriptions = sorted(
+                    orion.subscriptions.values(), key=lambda s: s["id"]
+                )
+            offset = int(params.get("offset", 0))
+            limit = min(int(params.get("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+            return self._send(
+                200,
+                subscriptions[offset : offset + limit],
+                {"Fiware-Total-Count": len(subscriptions)},
+            )
+        match = _SUBSCRIPTION_PATH.match(path)
+        if match and match.group(1) in orion.subscriptions:
+            return self._send(200, orion.subscriptions[match.group(1)])
+        return False
+
+    def _post(self, path, params, body):
+        orion = self.orion
+        if path == "/v2/entities":
+            upsert = "upsert" in params.get("options", "").split(",")
+            with orion._lock:
+                current = orion.entities.get(body["id"])
+                if current is not None and not upsert:
+                    return self._error(422, "Unprocessable", "Already Exists")
+                if current is not None:
+                    current.update(_attrs(body))
+                    return self._send(204)
+                orion.entities[body["id"]] = dict(body)
+            return self._send(201, None, {"Location": f"/v2/entities/{body['id']}"})
+        match = _ATTRS_PATH.match(path)
+        if match:
+            entity_id = unquote(match.group(1))
+            with orion._lock:
+                if entity_id not in orion.entities:
+                    return False
+                orion.entities[entity_id].update(body)
+            return self._send(204)
+        if path == "/v2/op/update":
+            missing = orion.batch(body["actionType"], body["entities"])
+            if missing:
+                description = "do not exist: " + ", ".join(
+                    f"{entity_id} - [entity itself]" for entity_id in missing
+                )
+                return self._error(404, "PartialUpdate", description)
+            return self._send(204)
+        if path == "/v2/subscriptions":
+            subscription_id = orion.add_subscription(body)
+            location = f"/v2/subscriptions/{subscription_id}"
+            return self._send(201, None, {"Location": location})
+        return False
+
+    def _put(self, path, _params, body):
+        match = _ATTRS_PATH.match(path)
+        if not match:
+            return False
+        entity_id = unquote(match.group(1))
+        with self.orion._lock:
+            current = self.orion.entities.get(entity_id)
+            if current is None:
+                return False
+            self.orion.entities[entity_id] = {
+                "id": entity_id,
+                "type": current["type"],
+                **body,
+            }
+        return self._send(204)
+
+    def _patch(self, path, _params, body):
+        orion = self.orion
+        match = _ATTRS_PATH.match(path)
+        if match:
+            entity_id = unquote(match.group(1))
+            with orion._lock:
+                current = orion.entities.get(entity_id)
+                if current is None:
+                    return False
+                current.update(body)
+            return self._send(204)
+        match = _SUBSCRIPTION_PATH.match(path)
+        if match:
+            with orion._lock:
+                subscription = orion.subscriptions.get(match.group(1))
+                if subscription is None:
+                    return False
+                subscription.update(body)
+            return self._send(204)
+        return False
+
+    def _delete(self, path, _params, _body):
+        orion = self.orion
+        match = _ENTITY_PATH.match(path)
+        if match:
+            with orion._lock:
+                if orion.entities.pop(unquote(match.group(1)), None) is None:
+                    return False
+            return self._send(204)
+        match = _SUBSCRIPTION_PATH.match(path)
+        if match:
+            with orion._lock:
+                if orion.subscriptions.pop(match.group(1), None) is None:
+                    return False
+            return self._send(204)
+        return False
@@ -0,0 +1,366 @@
+"""
+Replays notifications captured with NOTIFY_CAPTURE_PATH against a service.
+
+In-process (the default), the service module is imported with Orion and Open-Meteo
+replaced by the fakes of bench, optionally seeded with entities, and every Orion
+write it makes is recorded:
+
+    python -m bench.replay capture.jsonl --service weather_alert_course \\
+        --seed-entities ../entities --speed 10
+
+With --target, notifications are posted to a running service instead; only the
+request side (throughput and acknowledgement latency) is measured then.
+
+--speed is 1 for the captured pace, N for N times faster, or "max". The report
+has throughput, latency percentiles and, in-process, the set of downstream writes
+with a digest that stays the same as long as the service writes the same entities
+and attributes, so runs of two versions can be compared.
+"""
+import argparse
+import contextlib
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+import requests
+import capture
+from bench.fake_meteo import FakeOpenMeteo
+from bench.fake_orion import FakeOrion
+from bench.run import git_commit, report
+
+SERVICES = ("weather_alert_course", "weather_context_enricher")
+# Seconds to wait for the service queue to drain after the last notification.
+DRAIN_TIMEOUT = 300
+
+
+def parse_speed(value):
+    if value == "max":
+        return None
+    speed = float(value.rstrip("x"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+def percentiles(values):
+    ordered = sorted(values)
+    if not ordered:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+
+    def at(fraction):
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    return {
+        "p50": round(at(0.50), 6),
+        "p95": round(at(0.95), 6),
+        "p99": round(at(0.99), 6),
+        "max": round(ordered[-1], 6),
+    }
+
+
+def load_entities(path):
+    """
+    Entities to seed the fake Orion with: a directory of .json files (one entity or
+    a list per file) or a .jsonl file.
+    """
+    entities = []
+    if os.path.isdir(path):
+        for filename in sorted(glob.glob(os.path.join(path, "*.json"))):
+            with open(filename, encoding="utf-8") as f:
+                data = json.load(f)
+            entities.extend(data if isinstance(data, list) else [data])
+    else:
+        with open(path, encoding="utf-8") as f:
+            entities.extend(json.loads(line) for line in f if line.strip())
+    return entities
+
+
+def write_keys(method, path, body):
+    """
+    Describes an Orion write as (operation, entity id, attribute names) tuples,
+    leaving values out so that timestamps do not make equal runs look different.
+    """
+    body = body or {}
+    parts = path.strip("/").split("/")
+    if path == "/v2/op/update":
+        action = body.get("actionType")
+        return [
+            (f"op/update {action}", entity.get("id"), _attr_names(entity))
+            for entity in body.get("entities", [])
+        ]
+    if parts[:2] == ["v2", "entities"]:
+        if len(parts) == 2:
+            return [(f"{method} entity", body.get("id"), _attr_names(body))]
+        operation = f"{method} entity" if len(parts) == 3 else f"{method} attrs"
+        return [(operation, parts[2], tuple(sorted(body)))]
+    return [(f"{method} {'/'.join(parts[:2])}", None, ())]
+
+
+def _attr_names(entity):
+    return tuple(sorted(name for name in entity if name not in ("id", "type")))
+
+
+def summarize_writes(writes):
+    keys = [
+        key for method, path, body in writes for key in write_keys(method, path, body)
+    ]
+    unique = sorted(set(keys), key=lambda key: (key[0], key[1] or "", key[2]))
+    digest = hashlib.sha256(json.dumps(unique).encode("utf-8")).hexdigest()
+    return {
+        "requests": len(writes),
+        "entity_writes": len(keys),
+        "distinct_writes": len(unique),
+        "entities": len({entity_id for _, entity_id, _ in keys if entity_id}),
+        "operations": dict(Counter(operation for operation, _, _ in keys)),
+        "digest": digest,
+    }
+
+
+class InProcessTarget:
+    """
+    Delivers notifications to a service module through its Flask app, with Orion
+    and Open-Meteo replaced by fakes.
+    """
+
+    def __init__(self, service, seed_entities=None, orion_latency=0.0):
+        self.orion = FakeOrion(latency=orion_latency).start()
+        self.meteo = FakeOpenMeteo().start()
+        if seed_entities:
+            entities = load_entities(seed_entities)
+            self.orion.batch("append", entities)
+            report(f"Seeded fake Orion with {len(entities)} entities")
+
+        os.environ["ORION_URL"] = self.orion.url
+        os.environ["WEATHER_API_URL"] = self.meteo.url
+        os.environ.setdefault("CALLBACK_URL", "http://127.0.0.1:9/notify")
+        os.environ["WEATHER_CACHE_BACKEND"] = "memory"
+        # Replaying must not capture again.
+        os.environ.pop("NOTIFY_CAPTURE_PATH", None)
+        capture.NOTIFY_CAPTURE_PATH = None
+        # The services log to stdout, which is kept for the JSON report.
+        with contextlib.redirect_stdout(sys.stderr):
+            self.module = __import__(service)
+        self.client = self.module.app.test_client()
+        self.queue = getattr(self.module, "notification_queue", None)
+        self.writes_before = len(self.orion.writes)
+
+    def send(self, path, payload):
+        return self.client.post(path, json=payload).status_code
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """
+        Waits until the service queue has processed everything it accepted.
+        """
+        if self.queue is None:
+            return True
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            stats = self.queue.stats()
+            if not stats["depth"] and not stats["in_flight"]:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def results(self):
+        writes = self.orion.writes[self.writes_before :]
+        results = {"writes": summarize_writes(writes)}
+        if self.queue is not None:
+            stats = self.queue.stats()
+            results["queue"] = {
+                key: stats[key]
+                for key in ("accepted", "merged", "rejected", "processed", "failed")
+            }
+            results["processing_latency_seconds"] = stats["latency_seconds"]
+        return results, writes
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.stop()
+        self.orion.stop()
+        self.meteo.stop()
+
+
+class HttpTarget:
+    """
+    Posts notifications to a running service.
+    """
+
+    def __init__(self, url, timeout=10):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, path, payload):
+        try:
+            return self.session.post(
+                f"{self.url}{path}", json=payload, timeout=self.timeout
+            ).status_code
+        except Exception as e:
+            logging.getLogger("replay").debug(f"POST {path} failed: {e}")
+            return None
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        return True
+
+    def results(self):
+        return {}, []
+
+    def close(self):
+        self.session.close()
+
+
+def replay(notifications, target, speed, service=None):
+    """
+    Sends the notifications to target, keeping their captured spacing divided by
+    speed (None sends them back to back).
+    Returns:
+        dict: Counts, throughput and acknowledgement latency percentiles.
+    """
+    statuses = Counter()
+    latencies = []
+    sent = 0
+    entities = 0
+    started = time.monotonic()
+    first_received = None
+    for notification in notifications:
+        if service and notification.get("service") not in (None, service):
+            continue
+        received_at = notification.get("received_at")
+        if speed is not None and received_at is not None:
+            if first_received is None:
+                first_received = received_at
+            due = started + (received_at - first_received) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        request_started = time.monotonic()
+        payload = notification.get("payload") or {}
+        status = target.send(notification.get("path", "/notify"), payload)
+        latencies.append(time.monotonic() - request_started)
+        statuses[str(status)] += 1
+        sent += 1
+        entities += len(payload.get("data") or [])
+
+    sent_seconds = time.monotonic() - started
+    drained = target.drain()
+    total_seconds = time.monotonic() - started
+    return {
+        "notifications": sent,
+        "entities": entities,
+        "status_codes": dict(statuses),
+        "send_seconds": round(sent_seconds, 6),
+        "total_seconds": round(total_seconds, 6),
+        "throughput_per_second": (
+            round(sent / total_seconds, 2) if total_seconds else None
+        ),
+        "drained": drained,
+        "ack_latency_seconds": percentiles(latencies),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay captured Orion notifications."
+    )
+    parser.add_argument("capture", help="JSONL file written with NOTIFY_CAPTURE_PATH.")
+    parser.add_argument(
+        "--service",
+        choices=SERVICES,
+        help="Service to replay in-process; defaults to the service in the capture.",
+    )
+    parser.add_argument(
+        "--target", help="URL of a running service to post to instead."
+    )
+    parser.add_argument(
+        "--speed",
+        type=parse_speed,
+        default=1.0,
+        help="1 for the captured pace, N for N times faster, or 'max'.",
+    )
+    parser.add_argument(
+        "--seed-entities",
+        help="Directory of .json entities or a .jsonl file to seed the fake Orion.",
+    )
+    parser.add_argument(
+        "--orion-latency-ms", type=float, default=0.0, help="Latency of fake Orion."
+    )
+    parser.add_argument("--output", help="Write the JSON report to this file.")
+    parser.add_argument(
+        "--writes-output",
+        help="Write every downstream Orion write (in-process only) to this JSONL file.",
+    )
+    parser.add_argument(
+        "--log-level", default="ERROR", help="Log level of the service module."
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    notifications = list(capture.read_capture(args.capture))
+    if not notifications:
+        report(f"No notifications in {args.capture}")
+        return 2
+
+    service = args.service
+    if not service and not args.target:
+        service = notifications[0].get("service")
+        if service not in SERVICES:
+            report("Cannot tell the service from the capture, use --service.")
+            return 2
+
+    if args.target:
+        target = HttpTarget(args.target)
+    else:
+        target = InProcessTarget(
+            service, args.seed_entities, args.orion_latency_ms / 1000
+        )
+        logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+    try:
+        results = replay(notifications, target, args.speed, service)
+        service_results, writes = target.results()
+        results.update(service_results)
+    finally:
+        target.close()
+
+    document = {
+        "created": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "git_commit": git_commit(),
+        "capture": args.capture,
+        "service": service,
+        "target": args.target or "in-process",
+        "speed": args.speed or "max",
+        "results": results,
+    }
+    if args.writes_output:
+        with open(args.writes_output, "w", encoding="utf-8") as f:
+            for method, path, body in writes:
+                line = {"method": method, "path": path, "body": body}
+                f.write(json.dumps(line) + "\n")
+
+    report(
+        f"Replayed {results['notifications']} notifications in "
+        f"{results['total_seconds']}s ({results['throughput_per_second']}/s), "
+        f"ack p95 {results['ack_latency_seconds']['p95'] * 1000:.1f}ms"
+    )
+    if "writes" in results:
+        report(
+            f"Downstream writes: {results['writes']['distinct_writes']} distinct, "
+            f"digest {results['writes']['digest'][:12]}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2)
+    else:
+        print(json.dumps(document, indent=2))
+    return 0 if results["drained"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
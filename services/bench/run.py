@@ -0,0 +1,593 @@
+"""
+Benchmarks of the Orion client, the notify handlers and the Influx conversion
+against in-process fakes of Orion and Open-Meteo, so no docker-compose stack is
+needed. Run from the services directory:
+
+    python -m bench.run --output bench-results.json
+    python -m bench.run --baseline bench-results.json --only bulk_load,purge
+
+Results are written as JSON; with --baseline, benchmarks whose throughput dropped
+by more than --threshold are reported and the exit status is 1.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from bench.fake_meteo import FakeOpenMeteo
+from bench.fake_orion import FakeOrion
+
+# Natal area, where the stations and courses are spread.
+BBOX = (-35.30, -5.90, -35.15, -5.75)
+# Courses are placed within this distance (degrees, ~2 km) of a station.
+COURSE_SPREAD_DEG = 0.02
+WEEKDAYS = [
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+]
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+
+    return register
+
+
+def station_entities(count, seed=0):
+    rng = random.Random(seed)
+    min_lon, min_lat, max_lon, max_lat = BBOX
+    return [
+        {
+            "id": f"WeatherStation:Bench-{i:05d}",
+            "type": "WeatherStation",
+            "weathercode": {"type": "Number", "value": 61},
+            "timestamp": {"type": "DateTime", "value": "2025-01-01T00:00:00Z"},
+            "location": {
+                "type": "geo:json",
+                "value": {
+                    "type": "Point",
+                    "coordinates": [
+                        round(rng.uniform(min_lon, max_lon), 6),
+                        round(rng.uniform(min_lat, max_lat), 6),
+                    ],
+                },
+            },
+        }
+        for i in range(count)
+    ]
+
+
+def course_entities(count, stations, seed=0):
+    """
+    CourseInstance entities placed around the stations, with a class running all day
+    every day, so every course near a station gets an alert.
+    """
+    rng = random.Random(seed)
+    schedule = [
+        {"day": day, "startTime": "00:00", "endTime": "23:59"} for day in WEEKDAYS
+    ]
+    courses = []
+    for i in range(count):
+        lon, lat = stations[i % len(stations)]["location"]["value"]["coordinates"]
+        courses.append(
+            {
+                "id": f"CourseInstance:Bench:{i:06d}",
+                "type": "CourseInstance",
+                "courseCode": {"type": "Text", "value": f"BENCH{i % 500:04d}"},
+                "courseName": {"type": "Text", "value": f"Benchmark course {i}"},
+                "status": {"type": "Text", "value": "ABERTA"},
+                "enrollments": {"type": "Number", "value": rng.randint(0, 60)},
+                "classSchedule": {"type": "StructuredValue", "value": schedule},
+                "location": {
+                    "type": "geo:json",
+                    "value": {
+                        "type": "Point",
+                        "coordinates": [
+                            round(lon + rng.uniform(-1, 1) * COURSE_SPREAD_DEG, 6),
+                            round(lat + rng.uniform(-1, 1) * COURSE_SPREAD_DEG, 6),
+                        ],
+                    },
+                },
+            }
+        )
+    return courses
+
+
+def mongo_documents(count, seed=0):
+    """
+    Entity documents as Orion stores them in MongoDB, for the conversion benchmark.
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    docs = []
+    for i in range(count):
+        mdate = now - rng.uniform(0, 3600)
+        attrs = {
+            "weathercode": {"type": "Number", "value": rng.choice([0, 1, 61, 80])},
+            "timestamp": {"type": "Number", "value": mdate},
+            "enrollments": {"type": "Number", "value": rng.randint(0, 60)},
+            "status": {"type": "Text", "value": "ABERTA"},
+            "courseCode": {"type": "Text", "value": f"BENCH{i % 500:04d}"},
+            "currentWeather": {
+                "type": "StructuredValue",
+                "value": {"temperature": 27.5, "windspeed": 12.0, "weathercode": 61},
+            },
+            "location": {
+                "type": "geo:json",
+                "value": {"type": "Point", "coordinates": [-35.2, -5.8]},
+            },
+        }
+        for attr in attrs.values():
+            attr["mdate"] = mdate
+        docs.append(
+            {
+                "_id": {
+                    "id": f"CourseInstance:Bench:{i:06d}",
+                    "type": "CourseInstance",
+                },
+                "attrs": attrs,
+                "modDate": mdate,
+            }
+        )
+    return docs
+
+
+class Context:
+    """
+    Fakes, arguments and generated entities shared by the benchmarks.
+    """
+
+    def __init__(self, args, orion, meteo):
+        self.args = args
+        self.orion = orion
+        self.meteo = meteo
+        self.stations = station_entities(args.stations, args.seed)
+        self.courses = course_entities(args.courses, self.stations, args.seed)
+
+    def load(self, entities):
+        self.orion.reset()
+        self.orion.batch("append", json.loads(json.dumps(entities)))
+
+
+def run_async(function):
+    """
+    Runs an async benchmark body on a fresh event loop and closes the async Orion
+    and Open-Meteo clients bound to it, like a Flask async view would.
+    """
+    import fiware_async
+    import weather_context_enricher
+
+    async def main():
+        try:
+            return await function()
+        finally:
+            await fiware_async.close_client()
+            await weather_context_enricher.close_weather_client()
+
+    return asyncio.run(main())
+
+
+def measure(ctx, run, setup=None):
+    """
+    Runs setup (untimed) and run (timed) args.repeat times.
+    Returns:
+        tuple: (list of run durations in seconds, value returned by the last run).
+    """
+    durations = []
+    value = None
+    for _ in range(ctx.args.repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        value = run()
+        durations.append(time.perf_counter() - started)
+    return durations, value
+
+
+def result(ops, unit, durations, **extra):
+    median = statistics.median(durations)
+    return {
+        "ops": ops,
+        "unit": unit,
+        "seconds": round(median, 6),
+        "best_seconds": round(min(durations), 6),
+        "ops_per_second": round(ops / median, 2) if median else None,
+        "runs": len(durations),
+        **extra,
+    }
+
+
+@benchmark("bulk_load")
+def bench_bulk_load(ctx):
+    import fiware
+
+    durations, batch = measure(
+        ctx,
+        lambda: fiware.batch_upsert(ctx.courses),
+        setup=ctx.orion.reset,
+    )
+    return result(
+        len(ctx.courses),
+        "entities",
+        durations,
+        requests=batch.requests,
+        failed=len(batch.errors),
+    )
+
+
+@benchmark("purge")
+def bench_purge(ctx):
+    import fiware
+
+    durations, purge = measure(
+        ctx,
+        lambda: fiware.delete_all_entities("CourseInstance"),
+        setup=lambda: ctx.load(ctx.courses),
+    )
+    return result(
+        len(ctx.courses),
+        "entities",
+        durations,
+        passes=purge.passes,
+        failed=len(purge.failed),
+        error=purge.error,
+    )
+
+
+def _alert_count(orion):
+    return sum(1 for entity in orion.entities.values() if entity.get("type") == "Alert")
+
+
+def _prepare_alert_service(ctx):
+    import cache
+    import weather_alert_course
+
+    ctx.load(ctx.courses + ctx.stations)
+    weather_alert_course.alert_cache = cache.TTLCache(
+        weather_alert_course.ALERT_CACHE_SIZE, weather_alert_course.ALERT_CACHE_TTL
+    )
+    weather_alert_course.course_index_last_attempt = 0.0
+    weather_alert_course.warm_course_index()
+    return weather_alert_course
+
+
+@benchmark("alert_fanout")
+def bench_alert_fanout(ctx):
+    """
+    One weathercode notification for every station, alerts for every nearby course.
+    """
+    import weather_alert_course as service
+
+    payload = {"data": ctx.stations}
+    durations, _ = measure(
+        ctx,
+        lambda: run_async(lambda: service.handle_weather_notification(payload)),
+        setup=lambda: _prepare_alert_service(ctx),
+    )
+    alerts = _alert_count(ctx.orion)
+    return result(alerts, "alerts", durations, stations=len(ctx.stations))
+
+
+@benchmark("alert_fanout_cached")
+def bench_alert_fanout_cached(ctx):
+    """
+    The same notification again: every alert is unchanged and skipped by the cache.
+    """
+    service = _prepare_alert_service(ctx)
+    payload = {"data": ctx.stations}
+    run_async(lambda: service.handle_weather_notification(payload))
+    alerts = _alert_count(ctx.orion)
+
+    durations, _ = measure(
+        ctx, lambda: run_async(lambda: service.handle_weather_notification(payload))
+    )
+    return result(alerts, "alerts", durations, stations=len(ctx.stations))
+
+
+def _prepare_enricher(ctx):
+    import cache
+    import weather_context_enricher
+
+    ctx.load(ctx.courses)
+    weather_context_enricher.weather_cache = cache.TTLCache(
+        weather_context_enricher.WEATHER_CACHE_SIZE,
+        weather_context_enricher.WEATHER_CACHE_DEFAULT_TTL,
+    )
+    return weather_context_enricher
+
+
+def _location_notification(courses):
+    return {
+        "data": [
+            {"id": course["id"], "type": course["type"], "location": course["location"]}
+            for course in courses
+        ]
+    }
+
+
+@benchmark("enrichment")
+def bench_enrichment(ctx):
+    """
+    One location notification for every course with a cold weather cache.
+    """
+    import weather_context_enricher as service
+
+    payload = _location_notification(ctx.courses)
+    requests_before = ctx.meteo.requests
+
+    durations, _ = measure(
+        ctx,
+        lambda: run_async(lambda: service.handle_notification(payload)),
+        setup=lambda: _prepare_enricher(ctx),
+    )
+    return result(
+        len(ctx.courses),
+        "entities",
+        durations,
+        weather_requests=(ctx.meteo.requests - requests_before) // len(durations),
+    )
+
+
+@benchmark("enrichment_cached")
+def bench_enrichment_cached(ctx):
+    """
+    The same notification again, every grid cell served from the weather cache.
+    """
+    service = _prepare_enricher(ctx)
+    payload = _location_notification(ctx.courses)
+    run_async(lambda: service.handle_notification(payload))
+
+    durations, _ = measure(
+        ctx, lambda: run_async(lambda: service.handle_notification(payload))
+    )
+    return result(len(ctx.courses), "entities", durations)
+
+
+def _convert_all(converter, docs):
+    points = 0
+    for doc in docs:
+        point = converter.convert_mongo(doc)
+        if point:
+            converter.latest_point(point)
+            points += 1
+    return points
+
+
+@benchmark("conversion")
+def bench_conversion(ctx):
+    """
+    Mongo-to-Influx conversion of every document with a fresh converter.
+    """
+    import influx_convert
+
+    docs = mongo_documents(ctx.args.documents, ctx.args.seed)
+    durations, points = measure(
+        ctx, lambda: _convert_all(influx_convert.InfluxConverter(), docs)
+    )
+    return result(len(docs), "documents", durations, points=points)
+
+
+@benchmark("conversion_unchanged")
+def bench_conversion_unchanged(ctx):
+    """
+    The same documents again: every attribute is skipped as unchanged.
+    """
+    import influx_convert
+
+    docs = mongo_documents(ctx.args.documents, ctx.args.seed)
+    converter = influx_convert.InfluxConverter()
+    _convert_all(converter, docs)
+    durations, points = measure(ctx, lambda: _convert_all(converter, docs))
+    return result(len(docs), "documents", durations, points=points)
+
+
+@benchmark("alert_planner")
+def bench_alert_planner(ctx):
+    """
+    One planning run: every course's sessions of the next day joined with the hourly
+    forecast of its cell, and every alert written.
+    """
+    import requests
+    import alert_planner
+
+    def setup():
+        ctx.load(ctx.courses)
+        alert_planner.published.clear()
+
+    with requests.Session() as http:
+        durations, stats = measure(
+            ctx, lambda: alert_planner.run_once(http), setup=setup
+        )
+    return result(
+        stats["sessions"],
+        "sessions",
+        durations,
+        courses=stats["courses"],
+        cells=stats["cells"],
+        alerts=stats["alerts"],
+        forecast_requests=stats["api_requests"],
+    )
+
+
+def report(message):
+    # Progress goes to stderr so that stdout only carries the JSON results.
+    print(message, file=sys.stderr)
+
+
+def import_services():
+    """
+    Imports the service modules once the fakes are configured. They read their
+    configuration when imported, and the notify services register their
+    subscriptions and configure the root logger.
+    """
+    import alert_planner  # noqa: F401
+    import fiware  # noqa: F401
+    import fiware_async  # noqa: F401
+    import influx_convert  # noqa: F401
+    import weather_alert_course  # noqa: F401
+    import weather_context_enricher  # noqa: F401
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the benchmarks whose ops_per_second dropped by more than threshold
+    (a fraction) relative to the baseline results, as (name, baseline, current).
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous or not previous.get("ops_per_second"):
+            continue
+        ratio = (current["ops_per_second"] or 0) / previous["ops_per_second"]
+        report(
+            f"{name}: {previous['ops_per_second']} -> {current['ops_per_second']} "
+            f"{current['unit']}/s ({ratio - 1:+.1%})"
+        )
+        if ratio < 1 - threshold:
+            regressions.append(
+                (name, previous["ops_per_second"], current["ops_per_second"])
+            )
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SmartCampus benchmarks.")
+    parser.add_argument(
+        "--only", help=f"Comma separated benchmarks, from: {', '.join(BENCHMARKS)}."
+    )
+    parser.add_argument("--courses", type=int, default=2000)
+    parser.add_argument("--stations", type=int, default=20)
+    parser.add_argument("--documents", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--latency-ms", type=float, default=0.0, help="Latency added by fake Orion."
+    )
+    parser.add_argument(
+        "--jitter-ms", type=float, default=0.0, help="Random extra Orion latency."
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of Orion requests answered with 503.",
+    )
+    parser.add_argument(
+        "--meteo-latency-ms",
+        type=float,
+        default=0.0,
+        help="Latency added by fake Open-Meteo.",
+    )
+    parser.add_argument("--output", help="Write the JSON results to this file.")
+    parser.add_argument("--baseline", help="Compare with a previous results file.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Throughput drop (fraction) reported as a regression.",
+    )
+    parser.add_argument(
+        "--log-level", default="ERROR", help="Log level of the service modules."
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f"Unknown benchmarks: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    orion = FakeOrion(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    ).start()
+    meteo = FakeOpenMeteo(latency=args.meteo_latency_ms / 1000).start()
+
+    os.environ["ORION_URL"] = orion.url
+    os.environ["WEATHER_API_URL"] = meteo.url
+    os.environ.setdefault("CALLBACK_URL", "http://127.0.0.1:9/notify")
+    os.environ["WEATHER_CACHE_BACKEND"] = "memory"
+    # The services log to stdout, which is kept for the JSON results.
+    with contextlib.redirect_stdout(sys.stderr):
+        import_services()
+    logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+    ctx = Context(args, orion, meteo)
+    results = {}
+    try:
+        for name in names:
+            results[name] = BENCHMARKS[name](ctx)
+            report(
+                f"{name}: {results[name]['ops_per_second']} {results[name]['unit']}/s "
+                f"({results[name]['seconds']}s median of {results[name]['runs']})"
+            )
+    finally:
+        orion.stop()
+        meteo.stop()
+
+    document = {
+        "created": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "baseline", "log_level")
+        },
+        "orion_requests": orion.requests,
+        "orion_injected_failures": orion.failures,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2)
+        report(f"Results written to {args.output}")
+    else:
+        print(json.dumps(document, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, previous, current in regressions:
+            report(f"Regression in {name}: {previous} -> {current} ops/s")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
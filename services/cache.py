@@ -0,0 +1,242 @@
+import asyncio
+import concurrent.futures
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe in-process LRU cache whose entries expire after a time-to-live.
+
+    When the cache is full the least recently used entry is evicted. Lookups are
+    counted so callers can report how much work the cache saves.
+
+    Args:
+        maxsize (int): Maximum number of entries kept.
+        ttl (float): Default time-to-live of an entry, in seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SqliteCache:
+    """
+    On-disk cache with the same interface as TTLCache, stored in a SQLite file.
+
+    Entries survive restarts, so a warm cache is still useful after a redeploy.
+    Values must be JSON serializable. Expiry uses wall clock time.
+
+    Args:
+        path (str): SQLite database file.
+        maxsize (int): Number of rows above which expired entries are purged.
+        ttl (float): Default time-to-live of an entry, in seconds.
+    """
+
+    def __init__(self, path, maxsize=1024, ttl=300):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires_at, value FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] > time.time():
+                self.hits += 1
+                return json.loads(row[1])
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, expires_at, value) VALUES (?, ?, ?)",
+                (key, expires_at, json.dumps(value)),
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if count > self.maxsize:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE expires_at <= ?", (time.time(),)
+                )
+            self._conn.commit()
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def open_cache(backend="memory", path=None, maxsize=1024, ttl=300):
+    """
+    Returns a cache for the configured backend: "memory" (TTLCache) or "disk" (SqliteCache).
+    """
+    if backend == "memory":
+        return TTLCache(maxsize, ttl)
+    if backend == "disk":
+        if not path:
+            raise ValueError("A path is required for the disk cache backend.")
+        return SqliteCache(path, maxsize, ttl)
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+class SingleFlight:
+    """
+    Collapses concurrent async calls for the same key into a single execution.
+
+    The first caller runs the coroutine; callers arriving while it is in flight await
+    its result instead of starting their own. Works across event loops and threads
+    (e.g. queue workers that each own a loop).
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    async def run(self, key, coroutine_factory):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._calls[key] = future
+            else:
+                self.shared += 1
+
+        if not leader:
+            return await asyncio.wrap_future(future)
+
+        try:
+            result = await coroutine_factory()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def run_many(self, keys, coroutine_factory):
+        """
+        Multi-key variant of run(). Keys not in flight are claimed by this caller and
+        fetched with a single coroutine_factory(claimed_keys) call, which must return a
+        dict keyed by key; keys already in flight are awaited.
+        Returns:
+            dict: key -> result for every requested key.
+        """
+        with self._lock:
+            owned = {}
+            waiting = {}
+            for key in keys:
+                if key in self._calls:
+                    waiting[key] = self._calls[key]
+                elif key not in owned:
+                    owned[key] = concurrent.futures.Future()
+            self._calls.update(owned)
+            self.shared += len(waiting)
+
+        results = {}
+        if owned:
+            try:
+                fetched = await coroutine_factory(list(owned))
+                for key, future in owned.items():
+                    results[key] = fetched.get(key)
+                    future.set_result(results[key])
+            except BaseException as e:
+                for future in owned.values():
+                    if not future.done():
+                        future.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    for key in owned:
+                        del self._calls[key]
+
+        for key, future in waiting.items():
+            results[key] = await asyncio.wrap_future(future)
+        return results
@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("capture")
+
+# When set, every notification received by the notify endpoints is appended to this
+# JSONL file with its arrival time, for offline replay (see bench/replay.py).
+NOTIFY_CAPTURE_PATH = os.environ.get("NOTIFY_CAPTURE_PATH")
+
+
+class NotificationRecorder:
+    """
+    Appends notifications to a JSONL file, one line per notification:
+    {"received_at": epoch seconds, "service": ..., "path": ..., "payload": ...}.
+
+    Each line is written with a single O_APPEND write, so several workers of a
+    service can share the file. The file is reopened after a fork.
+
+    Args:
+        path (str): The capture file.
+        service (str): Name of the service recorded on every line.
+    """
+
+    def __init__(self, path, service):
+        self.path = path
+        self.service = service
+        self.recorded = 0
+        self.failed = 0
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def record(self, path, payload, received_at=None):
+        line = json.dumps(
+            {
+                "received_at": time.time() if received_at is None else received_at,
+                "service": self.service,
+                "path": path,
+                "payload": payload,
+            },
+            separators=(",", ":"),
+        )
+        data = (line + "\n").encode("utf-8")
+        try:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._fd = os.open(
+                        self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+                    )
+                    self._pid = os.getpid()
+                os.write(self._fd, data)
+                self.recorded += 1
+        except OSError as e:
+            # Capturing must never fail the notification itself.
+            self.failed += 1
+            if self.failed == 1 or self.failed % 1000 == 0:
+                logger.error(f"Could not capture notification to {self.path}: {e}")
+
+    def stats(self):
+        return {"path": self.path, "recorded": self.recorded, "failed": self.failed}
+
+
+def open_recorder(service, path=None):
+    """
+    Returns a NotificationRecorder for service writing to path (NOTIFY_CAPTURE_PATH
+    by default), or None when capture is disabled.
+    """
+    path = path or NOTIFY_CAPTURE_PATH
+    if not path:
+        return None
+    logger.info(f"Capturing {service} notifications to {path}")
+    return NotificationRecorder(path, service)
+
+
+def read_capture(path):
+    """
+    Yields the notifications of a capture file in file order. Lines that are not
+    valid JSON (e.g. a partial last line) are skipped.
+    """
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning(f"{path}:{number}: skipping invalid capture line")
@@ -0,0 +1,5 @@
+import os
+
+# fiware reads ORION_URL when imported; tests that talk to Orion start a FakeOrion
+# and build their own client.
+os.environ.setdefault("ORION_URL", "http://127.0.0.1:9")
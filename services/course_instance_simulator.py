@@ -1,7 +1,9 @@
+import hashlib
 import logging
 import os
 import json
 import fiware
+import metrics
 from datetime import datetime, timedelta, timezone
 import time
 
@@ -15,19 +17,188 @@ logger.propagate = False
 
 ENTITY_TYPE = "CourseInstance"
 ENTITIES_DIR = os.environ.get("ENTITIES_DIR")
+# "incremental" only writes the entities whose file changed since the last run and
+# deletes the ones whose file disappeared; "full" deletes and recreates everything.
+RELOAD_MODE = os.environ.get("RELOAD_MODE", "incremental")
+MANIFEST_PATH = os.environ.get("MANIFEST_PATH", "entity_manifest.json")
 
 headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
 get_delete_headers = {"Accept": "application/json"}
 
 
-def create_entity_from_file(filepath):
+def load_entity_from_file(filepath):
     try:
         with open(filepath, "r", encoding="utf-8") as file:
-            entity = json.load(file)
-            fiware.create_entity(entity)
+            return json.load(file)
     except Exception as e:
         logger.error(f"Error processing {filepath}: {e}")
+        return None
+
+
+def load_entities(directory):
+    entities = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".json"):
+            entity = load_entity_from_file(os.path.join(directory, filename))
+            if entity:
+                entities.append(entity)
+    return entities
+
+
+def file_digest(filepath):
+    with open(filepath, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def load_manifest(path):
+    """
+    Reads the manifest of the last reload: file name -> {"sha256", "id"}.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable manifest {path}: {e}")
+        return {}
+
+
+def save_manifest(path, manifest):
+    # Write then rename, so a crash never leaves a truncated manifest behind.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def reload_incremental(directory, manifest_path):
+    """
+    Brings Orion in line with the entity files, writing only what changed.
+
+    Files are compared with the content hashes of the previous run's manifest and
+    entity IDs are checked against Orion: entities missing from Orion are created,
+    entities whose file changed are updated (append), and entities whose file
+    disappeared are deleted. Files that are unchanged and present in Orion are not
+    even parsed. Only entities Orion accepted are recorded in the new manifest, so
+    failures are retried on the next run. A file that no longer parses counts as
+    failed and keeps its previous manifest entry, so its entity is not deleted.
+    Returns:
+        dict: Number of entities added, changed, removed, unchanged and failed.
+    """
+    if not os.path.exists(manifest_path):
+        logger.warning(
+            f"No manifest at {manifest_path}: every file is written, and entities "
+            "whose file was removed before this run are not deleted."
+        )
+    previous = load_manifest(manifest_path)
+
+    known, parsed, unparsable = {}, {}, {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".json"):
+            continue
+        filepath = os.path.join(directory, filename)
+        digest = file_digest(filepath)
+        entry = previous.get(filename)
+        if entry and entry["sha256"] == digest:
+            known[filename] = entry
+            continue
+        entity = load_entity_from_file(filepath)
+        if entity and entity.get("id"):
+            parsed[filename] = (
+                {"sha256": digest, "id": entity["id"], "type": entity.get("type")},
+                entity,
+            )
+        else:
+            unparsable[filename] = entry
+
+    # The directory may hold several entity types (e.g. the Organization).
+    types = {entry.get("type") for entry in previous.values()}
+    types.update(entry["type"] for entry, _ in parsed.values())
+    orion_ids = set()
+    for entity_type in sorted(t for t in types if t):
+        orion_ids.update(
+            entity["id"]
+            for entity in fiware.iter_entities(entity_type, attrs="id", key_values=True)
+        )
+
+    # Broken files keep their old entry: the digest still differs next run, so
+    # they are parsed again once fixed.
+    manifest = {filename: entry for filename, entry in unparsable.items() if entry}
+    failed = set(unparsable)
+    added, changed = [], []
+    unchanged = 0
+    for filename, entry in known.items():
+        if entry["id"] in orion_ids:
+            manifest[filename] = entry
+            unchanged += 1
+            continue
+        # Deleted from Orion behind our back: create it again.
+        entity = load_entity_from_file(os.path.join(directory, filename))
+        if entity and entity.get("id"):
+            added.append((filename, entry, entity))
+        else:
+            failed.add(filename)
+    for filename, (entry, entity) in parsed.items():
+        if entry["id"] in orion_ids:
+            changed.append((filename, entry, entity))
+        else:
+            added.append((filename, entry, entity))
+
+    current_ids = {entry["id"] for entry in manifest.values()}
+    current_ids.update(entry["id"] for _, entry, _ in added + changed)
+    removed = {}
+    for entry in previous.values():
+        if entry["id"] not in current_ids and entry["id"] in orion_ids:
+            removed.setdefault(entry.get("type") or ENTITY_TYPE, []).append(entry["id"])
+
+    # append creates the new entities and updates the changed ones in place, which
+    # keeps attributes added by other services (e.g. currentWeather).
+    upserts = added + changed
+    if upserts:
+        result = fiware.batch_upsert([entity for _, _, entity in upserts], "append")
+        failed.update(result.errors)
+        for filename, entry, _ in upserts:
+            if entry["id"] not in result.errors:
+                manifest[filename] = entry
+    for entity_type, entity_ids in removed.items():
+        result = fiware.batch_delete(entity_type, entity_ids)
+        failed.update(result.errors)
+
+    save_manifest(manifest_path, manifest)
+
+    summary = {
+        "added": len(added),
+        "changed": len(changed),
+        "removed": sum(len(entity_ids) for entity_ids in removed.values()),
+        "unchanged": unchanged,
+        "failed": len(failed),
+    }
+    logger.info(
+        f"Reloaded '{directory}': {summary['added']} added, "
+        f"{summary['changed']} changed, {summary['removed']} removed, "
+        f"{summary['unchanged']} unchanged, {summary['failed']} failed."
+    )
+    for entity_id in sorted(failed):
+        logger.error(f"Reload failed for {entity_id}.")
+    return summary
+
+
+def reload_full(directory):
+    purge = fiware.delete_all_entities(ENTITY_TYPE)
+    if not purge.ok:
+        logger.error(f"Purge before the full reload was incomplete: {purge.summary()}")
+
+    logger.info("Waiting for 1 second before creating entities...")
+    time.sleep(1)
+
+    entities = load_entities(directory)
+    logger.info(f"Loaded {len(entities)} entities from '{directory}'.")
+
+    result = fiware.batch_upsert(entities, action_type="append")
+    if not result.ok:
+        logger.error(f"{len(result.errors)} entities could not be created.")
 
 
 def update_course_schedule():
@@ -63,20 +234,16 @@ def main():
         logger.error(f"Folder '{ENTITIES_DIR}' not found.")
         return
 
-    fiware.delete_all_entities(ENTITY_TYPE)
-
-    logger.info("Waiting for 1 second before creating entities...")
-    time.sleep(1)
-
-    for filename in os.listdir(ENTITIES_DIR):
-        if filename.endswith(".json"):
-            filepath = os.path.join(ENTITIES_DIR, filename)
-            create_entity_from_file(filepath)
+    if RELOAD_MODE == "full":
+        reload_full(ENTITIES_DIR)
+    else:
+        reload_incremental(ENTITIES_DIR, MANIFEST_PATH)
 
     update_course_schedule()
     logger.info("All entities created and updated successfully.")
 
 
 if __name__ == "__main__":
+    metrics.start_reporter("course_instance_simulator")
     fiware.wait_for_orion()
     main()
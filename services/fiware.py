@@ -1,9 +1,21 @@
 import time
+import hashlib
 import logging
 import json
 import os
+import re
+import tempfile
+from contextlib import contextmanager
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, HTTPError, Timeout, RequestException
+from urllib3.util.retry import Retry
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger("fiware")
 
@@ -11,242 +23,993 @@ ORION_URL = os.environ.get("ORION_URL")
 if not ORION_URL:
     raise ValueError("ORION_URL environment variable is not set.")
 
+ORION_POOL_SIZE = int(os.environ.get("ORION_POOL_SIZE", "10"))
+ORION_TIMEOUT = float(os.environ.get("ORION_TIMEOUT", "10"))
+ORION_RETRIES = int(os.environ.get("ORION_RETRIES", "3"))
+ORION_BACKOFF = float(os.environ.get("ORION_BACKOFF", "0.5"))
 
-def upsert_entity(entity):
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+# Only idempotent requests are retried after a read error or a 5xx: a POST that
+# timed out may have been applied (e.g. created a subscription). Connection errors
+# are retried for every method, as the request never reached Orion.
+RETRY_METHODS = Retry.DEFAULT_ALLOWED_METHODS | {"PATCH"}
+
+# Orion rejects request payloads above 1 MB by default (-inReqPayloadMaxSize),
+# so batches are kept comfortably below that.
+BATCH_MAX_ENTITIES = int(os.environ.get("ORION_BATCH_MAX_ENTITIES", "500"))
+BATCH_MAX_BYTES = int(os.environ.get("ORION_BATCH_MAX_BYTES", "800000"))
+BATCH_ACTION_TYPES = ("append", "appendStrict", "update", "replace", "delete")
+
+ORION_PAGE_SIZE = int(os.environ.get("ORION_PAGE_SIZE", "1000"))
+PURGE_MAX_PASSES = int(os.environ.get("ORION_PURGE_MAX_PASSES", "5"))
+
+# Lock files that serialize subscription reconciliation between processes on a host.
+SUBSCRIPTION_LOCK_DIR = os.environ.get(
+    "ORION_SUBSCRIPTION_LOCK_DIR", tempfile.gettempdir()
+)
+
+# Entity ids listed in an Orion PartialUpdate description, e.g.
+# "do not exist: E1 - [ ], E2 - [ A, B ]"
+_PARTIAL_UPDATE_ID = re.compile(r"(?:: |, )([^\s,\[\]]+) - \[")
+
+
+class BatchResult:
     """
-    Create or update an entity in Orion. If the entity already exists, update its attributes.
-    Returns the response object or None if an error occurs.
+    Outcome of a batch operation sent through POST /v2/op/update.
+
+    Attributes:
+        action_type (str): The NGSI v2 actionType used for the batch.
+        succeeded (list): IDs of the entities Orion accepted.
+        errors (dict): Entity ID -> error description for every rejected entity.
+        requests (int): Number of HTTP requests sent to Orion.
+        elapsed (float): Wall clock time spent, in seconds.
     """
-    try:
-        url = f"{ORION_URL}/v2/entities"
-        headers = {"Content-Type": "application/json"}
-        res = requests.post(url, json=entity, headers=headers)
-        if res.status_code == 422 and "Already Exists" in res.text:
-            # Entity exists, update its attributes
-            alert_id = entity.get("id")
-            if not alert_id:
-                logger.error("Entity ID missing for update.")
-                return None
-            update_url = f"{ORION_URL}/v2/entities/{alert_id}/attrs"
-            update_entity = entity.copy()
-            update_entity.pop("id", None)
-            update_entity.pop("type", None)
-            res = requests.put(update_url, headers=headers, json=update_entity)
-        return res
-    except Exception as e:
-        logger.error(f"Error upserting entity {entity.get('id', 'Unknown')}: {e}")
-        raise
 
+    def __init__(self, action_type):
+        self.action_type = action_type
+        self.succeeded = []
+        self.errors = {}
+        self.requests = 0
+        self.elapsed = 0.0
 
-def update_entity(entity_id, attrs):
+    @property
+    def ok(self):
+        return not self.errors
+
+    def summary(self):
+        return (
+            f"{self.action_type}: {len(self.succeeded)} succeeded, "
+            f"{len(self.errors)} failed in {self.requests} requests ({self.elapsed:.2f}s)"
+        )
+
+
+def chunk_entities(entities, max_entities, max_bytes, result):
     """
-    Update attributes of an existing entity in Orion using POST /v2/entities/{entity_id}/attrs.
-    Args:
-        entity_id (str): The ID of the entity to update.
-        attrs (dict): The attributes to update in the entity.
-    Logging:
-        - Logs success or error for the update operation.
+    Serialize entities once and group them into chunks bounded by count and payload size.
+    Entities without an ID or larger than max_bytes on their own are recorded as errors
+    in result and never sent. Entities without an ID are keyed by their position, e.g.
+    "<missing id #3>".
+    Yields:
+        list: Chunks of (entity_id, serialized_entity) tuples.
     """
-    try:
-        url = f"{ORION_URL}/v2/entities/{entity_id}/attrs"
-        headers = {"Content-Type": "application/json"}
-        requests.post(url, json=attrs, headers=headers)
-        logger.info(f"Updated entity {entity_id} with {json.dumps(attrs)} attributes.")
-    except Exception as e:
-        logger.error(
-            f"Error updating entiupdate_entityty {entity_id}: {e}", exc_info=True
-        )
-        raise
+    chunk, chunk_bytes = [], 0
+    for position, entity in enumerate(entities):
+        entity_id = entity.get("id")
+        if not entity_id:
+            result.errors[f"<missing id #{position}>"] = "Entity ID missing"
+            continue
+        body = json.dumps(entity, separators=(",", ":"))
+        size = len(body.encode("utf-8")) + 1
+        if size > max_bytes:
+            result.errors[entity_id] = f"Entity payload too large ({size} bytes)"
+            continue
+        if chunk and (len(chunk) >= max_entities or chunk_bytes + size > max_bytes):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append((entity_id, body))
+        chunk_bytes += size
+    if chunk:
+        yield chunk
 
 
-def create_entity(entity):
+def batch_payload(action_type, chunk):
     """
-    Create a new entity in Orion using POST /v2/entities.
-    Args:
-        entity (dict): The entity data to create.
+    Build the POST /v2/op/update body from already serialized entities.
+    """
+    payload = (
+        f'{{"actionType":"{action_type}","entities":['
+        + ",".join(body for _, body in chunk)
+        + "]}"
+    )
+    return payload.encode("utf-8")
+
+
+def apply_batch_response(status_code, text, chunk, result):
+    """
+    Record the outcome of a batch request in result.
+
+    When Orion rejects a chunk without naming the failing entities, the chunk is split
+    in two and the halves are returned so the caller can resend them.
     Returns:
-        bool: True if created successfully, False otherwise.
-    Logging:
-        - Logs success or error for the creation operation.
+        list: Sub-chunks that must be resent (empty when the outcome is known).
     """
+    if status_code in [200, 204]:
+        result.succeeded.extend(entity_id for entity_id, _ in chunk)
+        return []
+
     try:
-        url = f"{ORION_URL}/v2/entities"
-        headers = {"Content-Type": "application/json"}
-        res = requests.post(url, json=entity, headers=headers)
-        if res.status_code in [201, 204]:
-            logger.info(f"Created entity {entity.get('id')}")
-            return True
-        else:
-            logger.warning(
-                f"Failed to create entity {entity.get('id')}: {res.status_code} {res.text}"
-            )
-            return False
-    except Exception as e:
-        logger.error(f"Error creating entity {entity.get('id')}: {e}", exc_info=True)
-        return False
+        description = json.loads(text).get("description", text)
+    except (ValueError, AttributeError):
+        description = text
 
+    chunk_ids = {entity_id for entity_id, _ in chunk}
+    failed_ids = set(_PARTIAL_UPDATE_ID.findall(description)) & chunk_ids
+    if failed_ids:
+        for entity_id, _ in chunk:
+            if entity_id in failed_ids:
+                result.errors[entity_id] = f"{status_code} {description}"
+            else:
+                result.succeeded.append(entity_id)
+        return []
+    if len(chunk) > 1:
+        middle = len(chunk) // 2
+        return [chunk[:middle], chunk[middle:]]
+    result.errors[chunk[0][0]] = f"{status_code} {description}"
+    return []
 
-def delete_all_entities(type):
+
+class PurgeResult:
     """
-    Deletes all entities of a specified type from the Orion Context Broker.
+    Outcome of purging all entities of a type.
 
-    This function retrieves all entities of the given type in batches (with a limit of 100 per request)
-    and deletes each entity individually. It logs the number of entities found, each deletion attempt,
-    and any errors encountered during the process.
+    Attributes:
+        entity_type (str): The purged entity type.
+        deleted (int): Number of entities deleted.
+        failed (dict): Entity ID -> last error for every entity known to be present.
+        error (str): Why listing the entities failed, or None. When set, failed only
+            holds the entities known from the last successful listing.
+        passes (int): Number of list/delete passes performed.
+        elapsed (float): Wall clock time spent, in seconds.
+    """
 
+    def __init__(self, entity_type):
+        self.entity_type = entity_type
+        self.deleted = 0
+        self.failed = {}
+        self.error = None
+        self.passes = 0
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return not self.failed and self.error is None
+
+    @property
+    def rate(self):
+        return self.deleted / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        summary = (
+            f"{self.entity_type}: deleted {self.deleted} in {self.elapsed:.2f}s "
+            f"({self.rate:.1f} entities/s, {self.passes} passes), "
+            f"{len(self.failed)} could not be deleted"
+        )
+        if self.error:
+            summary += f", incomplete: {self.error}"
+        return summary
+
+
+def entity_query(entity_type=None, attrs=None, key_values=False, params=None):
+    """
+    Query parameters of GET /v2/entities, without pagination.
     Args:
-        type (str): The type of entities to delete.
+        entity_type (str, optional): Restrict the query to this entity type.
+        attrs (str or list, optional): Attributes to return (projection).
+        key_values (bool): Request the simplified keyValues representation.
+        params (dict, optional): Extra query parameters (q, georel, idPattern...).
+    """
+    query = dict(params or {})
+    if entity_type:
+        query["type"] = entity_type
+    if attrs:
+        query["attrs"] = attrs if isinstance(attrs, str) else ",".join(attrs)
+    if key_values:
+        query["options"] = "keyValues"
+    return query
 
-    Raises:
-        RequestsException: If there is an error retrieving or deleting entities from the Orion Context Broker.
-        Exception: For any other unexpected errors during the process.
 
-    Logging:
-        - Logs the total number of entities found for the given type.
-        - Logs each successful or failed deletion.
-        - Logs errors encountered during retrieval or deletion.
+def nearby_params(latitude, longitude, radius_meters):
     """
-    try:
-        headers = {"Accept": "application/json"}
-        limit = 100
+    georel query parameters matching entities within radius_meters of a point.
+    """
+    return {
+        "georel": f"near;maxDistance:{radius_meters}",
+        "geometry": "point",
+        "coords": f"{latitude},{longitude}",
+    }
 
-        while True:
-            params = {
-                "type": type,
-                "limit": limit,
-                "offset": 0,
-                "options": "count",
-            }
-            url = f"{ORION_URL}/v2/entities"
-            res = requests.get(url, params=params, headers=headers)
-            res.raise_for_status()
-            total = int(res.headers.get("Fiware-Total-Count", 0))
-            logger.info(f"Found entities of type {type}: {total}")
-            if total == 0:
-                logger.info(f"No entities of type {type} to delete.")
-                break
-
-            entities = res.json()
-            for entity in entities:
-                entity_id = entity.get("id")
-                if entity_id:
-                    del_url = f"{ORION_URL}/v2/entities/{entity_id}"
-                    try:
-                        del_res = requests.delete(del_url, headers=headers)
-                        if del_res.status_code in [204, 404]:
-                            logger.info(f"Deleted entity {entity_id}")
-                        else:
-                            logger.warning(
-                                f"Failed to delete entity {entity_id}: {del_res.status_code}"
-                            )
-                    except Exception as e:
-                        logger.error(
-                            f"Error deleting entity {entity_id}: {e}", exc_info=True
-                        )
-    except Exception as e:
-        logger.error(f"Error retrieving entities: {e}", exc_info=True)
 
+def subscription_url(subscription):
+    """
+    Callback URL of a subscription, for plain and custom HTTP notifications.
+    """
+    notification = subscription.get("notification", {})
+    target = notification.get("http") or notification.get("httpCustom") or {}
+    return target.get("url")
 
-def wait_for_orion():
+
+def is_subset(desired, actual):
     """
-    Waits for the Orion Context Broker to become available by polling the /version endpoint.
-    Tries for up to 30 seconds, checking every second. Logs the status of each attempt.
-    Returns:
-        bool: True if Orion is available within the timeout, False otherwise.
-    Logging:
-        - Logs each attempt and the final result (success or failure).
+    True when every field of desired has the same value in actual. Orion adds
+    defaults and counters (status, timesSent, attrsFormat...) to the subscriptions it
+    returns, so a stored subscription is up to date when the desired one is a subset.
+    """
+    if isinstance(desired, dict):
+        return isinstance(actual, dict) and all(
+            key in actual and is_subset(value, actual[key])
+            for key, value in desired.items()
+        )
+    if isinstance(desired, list):
+        return (
+            isinstance(actual, list)
+            and len(desired) == len(actual)
+            and all(is_subset(d, a) for d, a in zip(desired, actual))
+        )
+    return desired == actual
+
+
+@contextmanager
+def _subscription_lock(subscription, lock_dir=SUBSCRIPTION_LOCK_DIR):
+    # Serializes reconcilers of the same subscription on this host (e.g. gunicorn
+    # workers). Without fcntl the deterministic survivor choice still converges.
+    if fcntl is None:
+        yield
+        return
+    key = f"{subscription.get('description')}|{subscription_url(subscription)}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(lock_dir, f"orion-subscription-{digest}.lock")
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class FiwareClient:
+    """
+    NGSI v2 client for the Orion Context Broker backed by a pooled, keep-alive session.
+
+    All calls share one requests.Session, so connections to Orion are reused instead of
+    opening a new TCP connection per request. Every request carries a timeout and is
+    retried with exponential backoff on connection errors, and idempotent requests
+    (RETRY_METHODS) also on read errors and 5xx responses.
+
+    Args:
+        base_url (str): Orion base URL, e.g. http://orion:1026.
+        pool_size (int): Maximum number of pooled connections kept open to Orion.
+        timeout (float): Default timeout in seconds applied to every request.
+        retries (int): Number of retries on connection errors and 5xx responses.
+        backoff_factor (float): Backoff factor between retries (0.5 -> 0.5s, 1s, 2s...).
     """
-    url = f"{ORION_URL}/version"
-    timeout_seconds = 30
-    retry_interval = 1
-    start_time = time.time()
 
-    while time.time() - start_time < timeout_seconds:
+    def __init__(
+        self,
+        base_url,
+        pool_size=ORION_POOL_SIZE,
+        timeout=ORION_TIMEOUT,
+        retries=ORION_RETRIES,
+        backoff_factor=ORION_BACKOFF,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=RETRY_METHODS,
+            backoff_factor=backoff_factor,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def request(self, method, path, timeout=None, **kwargs):
+        """
+        Send a request to Orion through the pooled session.
+        Args:
+            method (str): HTTP method.
+            path (str): Path relative to the Orion base URL, e.g. /v2/entities.
+            timeout (float, optional): Overrides the client default timeout for this call.
+        Returns:
+            requests.Response: The response returned by Orion.
+        """
+        url = f"{self.base_url}{path}"
+        started = time.perf_counter()
+        status = None
+        try:
+            res = self.session.request(
+                method, url, timeout=timeout or self.timeout, **kwargs
+            )
+            status = res.status_code
+            return res
+        finally:
+            metrics.observe_orion(method, path, status, started)
+
+    def upsert_entity(self, entity, timeout=None):
+        """
+        Create or update an entity in Orion. If the entity already exists, update its attributes.
+        Returns the response object or None if an error occurs.
+        """
         try:
-            res = requests.get(url, timeout=5)
-            if res.status_code == 200:
-                logger.info("Orion is available.")
+            headers = {"Content-Type": "application/json"}
+            res = self.request(
+                "POST", "/v2/entities", json=entity, headers=headers, timeout=timeout
+            )
+            if res.status_code == 422 and "Already Exists" in res.text:
+                # Entity exists, update its attributes
+                alert_id = entity.get("id")
+                if not alert_id:
+                    logger.error("Entity ID missing for update.")
+                    return None
+                update_entity = entity.copy()
+                update_entity.pop("id", None)
+                update_entity.pop("type", None)
+                res = self.request(
+                    "PUT",
+                    f"/v2/entities/{alert_id}/attrs",
+                    headers=headers,
+                    json=update_entity,
+                    timeout=timeout,
+                )
+            return res
+        except Exception as e:
+            logger.error(f"Error upserting entity {entity.get('id', 'Unknown')}: {e}")
+            raise
+
+    def update_entity(self, entity_id, attrs, timeout=None):
+        """
+        Update attributes of an existing entity in Orion using POST /v2/entities/{entity_id}/attrs.
+        Args:
+            entity_id (str): The ID of the entity to update.
+            attrs (dict): The attributes to update in the entity.
+            timeout (float, optional): Overrides the client default timeout for this call.
+        Logging:
+            - Logs success or error for the update operation.
+        """
+        try:
+            headers = {"Content-Type": "application/json"}
+            self.request(
+                "POST",
+                f"/v2/entities/{entity_id}/attrs",
+                json=attrs,
+                headers=headers,
+                timeout=timeout,
+            )
+            logger.info(
+                f"Updated entity {entity_id} with {json.dumps(attrs)} attributes."
+            )
+        except Exception as e:
+            logger.error(f"Error updating entity {entity_id}: {e}", exc_info=True)
+            raise
+
+    def create_entity(self, entity, timeout=None):
+        """
+        Create a new entity in Orion using POST /v2/entities.
+        Args:
+            entity (dict): The entity data to create.
+            timeout (float, optional): Overrides the client default timeout for this call.
+        Returns:
+            bool: True if created successfully, False otherwise.
+        Logging:
+            - Logs success or error for the creation operation.
+        """
+        try:
+            headers = {"Content-Type": "application/json"}
+            res = self.request(
+                "POST", "/v2/entities", json=entity, headers=headers, timeout=timeout
+            )
+            if res.status_code in [201, 204]:
+                logger.info(f"Created entity {entity.get('id')}")
                 return True
             else:
                 logger.warning(
-                    f"Orion /version responded with status {res.status_code}"
+                    f"Failed to create entity {entity.get('id')}: {res.status_code} {res.text}"
                 )
-        except (ConnectionError, Timeout) as e:
-            logger.warning(f"Waiting for Orion: {e}")
+                return False
         except Exception as e:
-            logger.warning(f"Unexpected error while waiting for Orion: {e}")
-        time.sleep(retry_interval)
+            logger.error(
+                f"Error creating entity {entity.get('id')}: {e}", exc_info=True
+            )
+            return False
+
+    def iter_entity_pages(
+        self,
+        entity_type=None,
+        attrs=None,
+        key_values=False,
+        page_size=ORION_PAGE_SIZE,
+        params=None,
+        timeout=None,
+    ):
+        """
+        Iterate over the pages of GET /v2/entities, following offset pagination.
+        Args:
+            entity_type (str, optional): Restrict the query to this entity type.
+            attrs (str or list, optional): Attributes to return (projection).
+            key_values (bool): Request the simplified keyValues representation.
+            page_size (int): Entities requested per page (Orion allows up to 1000).
+            params (dict, optional): Extra query parameters (q, georel, idPattern...).
+            timeout (float, optional): Overrides the client default timeout for each call.
+        Yields:
+            list: One page of entities at a time, fetching the next one on demand.
+        """
+        query = entity_query(entity_type, attrs, key_values, params)
+        query["limit"] = page_size
+
+        headers = {"Accept": "application/json"}
+        offset = 0
+        while True:
+            query["offset"] = offset
+            res = self.request(
+                "GET", "/v2/entities", params=query, headers=headers, timeout=timeout
+            )
+            res.raise_for_status()
+            page = res.json()
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            offset += len(page)
+
+    def iter_entities(
+        self,
+        entity_type=None,
+        attrs=None,
+        key_values=False,
+        page_size=ORION_PAGE_SIZE,
+        params=None,
+        timeout=None,
+    ):
+        """
+        Iterate over entities using GET /v2/entities. See iter_entity_pages.
+        Yields:
+            dict: One entity at a time, fetching the next page on demand.
+        """
+        for page in self.iter_entity_pages(
+            entity_type, attrs, key_values, page_size, params, timeout
+        ):
+            yield from page
+
+    def batch_delete(self, entity_type, entity_ids, max_entities=BATCH_MAX_ENTITIES):
+        """
+        Delete entities by ID with POST /v2/op/update actionType=delete.
+        Args:
+            entity_type (str): The type of the entities to delete.
+            entity_ids (list): IDs of the entities to delete.
+            max_entities (int): Maximum number of entities per request.
+        Returns:
+            BatchResult: Per-entity success and error report.
+        """
+        stubs = [{"id": entity_id, "type": entity_type} for entity_id in entity_ids]
+        return self.batch_upsert(stubs, action_type="delete", max_entities=max_entities)
+
+    def purge_entities(
+        self, type, batch_size=BATCH_MAX_ENTITIES, max_passes=PURGE_MAX_PASSES
+    ):
+        """
+        Deletes all entities of a specified type using batch delete operations.
+
+        Each pass lists only the IDs of the remaining entities (attrs=id, keyValues) and
+        deletes them in batches. Passes stop as soon as nothing is left, when a pass makes
+        no progress, or after max_passes, so the purge always terminates.
+
+        Args:
+            type (str): The type of entities to delete.
+            batch_size (int): Maximum number of entities per delete request.
+            max_passes (int): Maximum number of list/delete passes.
+        Returns:
+            PurgeResult: Deleted count, timing and the entities that could not be deleted.
+        Logging:
+            - Logs a summary with elapsed time and deletion rate.
+            - Logs each entity that could not be deleted.
+        """
+        result = PurgeResult(type)
+        start_time = time.time()
+        last_errors = {}
+        remaining = []
+
+        try:
+            remaining = self._list_ids(type)
+            logger.info(f"Found entities of type {type}: {len(remaining)}")
+            while remaining and result.passes < max_passes:
+                result.passes += 1
+                batch = self.batch_delete(type, remaining, max_entities=batch_size)
+                result.deleted += len(batch.succeeded)
+                last_errors = batch.errors
+                # Still present as far as we know, should the next listing fail.
+                deleted = set(batch.succeeded)
+                remaining = [i for i in remaining if i not in deleted]
+                remaining = self._list_ids(type)
+                if not batch.succeeded:
+                    logger.warning(
+                        f"Purge pass {result.passes} deleted no {type} entities, stopping."
+                    )
+                    break
+        except RequestException as e:
+            # Without a listing there is no telling what is left, so the purge is
+            # reported as failed rather than complete.
+            logger.error(f"Error listing entities of type {type}: {e}", exc_info=True)
+            result.error = f"could not list {type} entities: {e}"
+
+        result.failed = {
+            entity_id: last_errors.get(entity_id, "Not deleted")
+            for entity_id in remaining
+        }
+        result.elapsed = time.time() - start_time
+        logger.info(f"Purge {result.summary()}")
+        for entity_id, error in result.failed.items():
+            logger.warning(f"Could not delete entity {entity_id}: {error}")
+        return result
+
+    def _list_ids(self, entity_type):
+        return [
+            entity["id"]
+            for entity in self.iter_entities(entity_type, attrs="id", key_values=True)
+        ]
 
-    logger.error("Orion did not become available within 30 seconds.")
-    return False
+    def wait_for_orion(self):
+        """
+        Waits for the Orion Context Broker to become available by polling the /version endpoint.
+        Tries for up to 30 seconds, checking every second. Logs the status of each attempt.
+        Returns:
+            bool: True if Orion is available within the timeout, False otherwise.
+        Logging:
+            - Logs each attempt and the final result (success or failure).
+        """
+        timeout_seconds = 30
+        retry_interval = 1
+        start_time = time.time()
+
+        while time.time() - start_time < timeout_seconds:
+            try:
+                res = self.request("GET", "/version", timeout=5)
+                if res.status_code == 200:
+                    logger.info("Orion is available.")
+                    return True
+                else:
+                    logger.warning(
+                        f"Orion /version responded with status {res.status_code}"
+                    )
+            except (ConnectionError, Timeout) as e:
+                logger.warning(f"Waiting for Orion: {e}")
+            except Exception as e:
+                logger.warning(f"Unexpected error while waiting for Orion: {e}")
+            time.sleep(retry_interval)
+
+        logger.error("Orion did not become available within 30 seconds.")
+        return False
+
+    def register_subscription(self, subscription):
+        """
+        Registers a subscription in Orion Context Broker with retries for up to 30 seconds.
+        Args:
+            subscription (dict): The subscription payload to register.
+        Returns:
+            bool: True if the subscription was registered successfully, False otherwise.
+        Logging:
+            - Logs each attempt, success, or failure, including error details if any.
+        """
+        logger.info(
+            "Registering subscription to: " + json.dumps(subscription["subject"])
+        )
+
+        headers = {"Content-Type": "application/json", "Accept": "application/json"}
+
+        timeout_seconds = 30
+        retry_interval = 1
+        start_time = time.time()
+
+        subscriptions_url = f"{self.base_url}/v2/subscriptions"
+
+        while time.time() - start_time < timeout_seconds:
+            try:
+                res = self.request(
+                    "POST", "/v2/subscriptions", json=subscription, headers=headers
+                )
+                if res.status_code in [200, 201]:
+                    logger.info("Subscription registered.")
+                    return True
+                else:
+                    logger.warning(f"Subscription attempt failed: {res.status_code}")
+                    logger.warning(res.text)
+            except ConnectionError as ce:
+                logger.warning(f"Could not connect to orion: {subscriptions_url}")
+            except HTTPError as he:
+                logger.warning(f"Response error from Orion: {he}")
+            except Timeout as te:
+                logger.warning(f"Orion did not respond in time: {te}")
+            except RequestException as e:
+                logger.warning(f"Unexpected request error {e}")
+            except Exception as e:
+                logger.warning(f"Unknown error: {e}")
+
+            time.sleep(retry_interval)
+
+        logger.error("Failed to register subscription after 30 seconds.")
+        return False
+
+    def iter_subscriptions(self, page_size=ORION_PAGE_SIZE, timeout=None):
+        """
+        Iterate over all subscriptions using GET /v2/subscriptions, following offset pagination.
+        Yields:
+            dict: One subscription at a time.
+        """
+        headers = {"Accept": "application/json"}
+        offset = 0
+        while True:
+            res = self.request(
+                "GET",
+                "/v2/subscriptions",
+                params={"limit": page_size, "offset": offset},
+                headers=headers,
+                timeout=timeout,
+            )
+            res.raise_for_status()
+            page = res.json()
+            yield from page
+            if len(page) < page_size:
+                return
+            offset += len(page)
+
+    def reconcile_subscription(self, subscription, timeout_seconds=30):
+        """
+        Makes sure exactly one subscription like this one exists in Orion.
+
+        Existing subscriptions with the same callback URL and the same description or
+        subject are considered copies of it. The oldest copy with the same description
+        (lowest ID) survives and is PATCHed if it differs; the other copies are deleted;
+        a new subscription is created when there is none. Concurrent reconcilers on one
+        host are serialized with a file lock, and since every reconciler picks the same
+        survivor, concurrent runs on different hosts converge too. Retries for up to
+        timeout_seconds while Orion is unreachable.
+        Args:
+            subscription (dict): The desired subscription payload.
+        Returns:
+            str: ID of the subscription, or None if it could not be reconciled.
+        Logging:
+            - Logs whether the subscription was created, updated or already up to date,
+              and every duplicate deleted.
+        """
+        start_time = time.time()
+        while time.time() - start_time < timeout_seconds:
+            try:
+                with _subscription_lock(subscription):
+                    return self._reconcile_subscription(subscription)
+            except RequestException as e:
+                logger.warning(f"Could not reconcile subscription with Orion: {e}")
+            time.sleep(1)
+
+        logger.error(f"Failed to reconcile subscription after {timeout_seconds} seconds.")
+        return None
+
+    def _matching_subscriptions(self, subscription):
+        url = subscription_url(subscription)
+        description = subscription.get("description")
+        matches = [
+            existing
+            for existing in self.iter_subscriptions()
+            if subscription_url(existing) == url
+            and (
+                existing.get("description") == description
+                or is_subset(subscription.get("subject"), existing.get("subject"))
+            )
+        ]
+        # Same description first, then the oldest (Orion IDs grow over time).
+        matches.sort(key=lambda s: (s.get("description") != description, s["id"]))
+        return matches
+
+    def _reconcile_subscription(self, subscription):
+        headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        description = subscription.get("description")
+
+        matches = self._matching_subscriptions(subscription)
+        if not matches:
+            res = self.request(
+                "POST", "/v2/subscriptions", json=subscription, headers=headers
+            )
+            res.raise_for_status()
+            logger.info(f"Subscription '{description}' created.")
+            # Another host may have created one at the same time; converge on one.
+            matches = self._matching_subscriptions(subscription)
+            if not matches:
+                return res.headers.get("Location", "").rsplit("/", 1)[-1] or None
+
+        survivor, duplicates = matches[0], matches[1:]
+        for duplicate in duplicates:
+            res = self.request("DELETE", f"/v2/subscriptions/{duplicate['id']}")
+            if res.status_code not in (204, 404):
+                res.raise_for_status()
+            logger.info(f"Deleted duplicate subscription {duplicate['id']} of '{description}'.")
+
+        if is_subset(subscription, survivor):
+            logger.info(f"Subscription '{description}' is up to date ({survivor['id']}).")
+        else:
+            res = self.request(
+                "PATCH",
+                f"/v2/subscriptions/{survivor['id']}",
+                json=subscription,
+                headers=headers,
+            )
+            res.raise_for_status()
+            logger.info(f"Subscription '{description}' updated ({survivor['id']}).")
+        return survivor["id"]
+
+    def batch_upsert(
+        self,
+        entities,
+        action_type="append",
+        max_entities=BATCH_MAX_ENTITIES,
+        max_bytes=BATCH_MAX_BYTES,
+        timeout=None,
+    ):
+        """
+        Create or update many entities with NGSI v2 batch operations (POST /v2/op/update).
+
+        Entities are split into chunks bounded both by entity count and by serialized
+        payload size. When Orion rejects a chunk, the failing entities are taken from the
+        PartialUpdate description when possible; otherwise the chunk is bisected until
+        the offending entities are isolated, so every entity gets its own outcome.
+
+        Args:
+            entities (list): Entities in normalized NGSI v2 format.
+            action_type (str): append, appendStrict, update, replace or delete.
+            max_entities (int): Maximum number of entities per request.
+            max_bytes (int): Maximum request payload size in bytes.
+            timeout (float, optional): Overrides the client default timeout for each call.
+        Returns:
+            BatchResult: Per-entity success and error report.
+        Logging:
+            - Logs a summary of the operation and each rejected entity.
+        """
+        if action_type not in BATCH_ACTION_TYPES:
+            raise ValueError(f"Unsupported batch actionType: {action_type}")
+
+        result = BatchResult(action_type)
+        start_time = time.time()
+
+        for chunk in chunk_entities(entities, max_entities, max_bytes, result):
+            self._send_batch(action_type, chunk, result, timeout)
+
+        result.elapsed = time.time() - start_time
+        logger.info(f"Batch {result.summary()}")
+        for entity_id, error in result.errors.items():
+            logger.warning(f"Batch {action_type} failed for {entity_id}: {error}")
+        return result
+
+    def _send_batch(self, action_type, chunk, result, timeout):
+        headers = {"Content-Type": "application/json"}
+        try:
+            res = self.request(
+                "POST",
+                "/v2/op/update",
+                data=batch_payload(action_type, chunk),
+                headers=headers,
+                timeout=timeout,
+            )
+        except RequestException as e:
+            for entity_id, _ in chunk:
+                result.errors[entity_id] = str(e)
+            return
+        finally:
+            result.requests += 1
+
+        for part in apply_batch_response(res.status_code, res.text, chunk, result):
+            self._send_batch(action_type, part, result, timeout)
+
+    def iter_entities_nearby(
+        self,
+        entity_type,
+        latitude,
+        longitude,
+        radius_meters=5000,
+        attrs=None,
+        key_values=False,
+        page_size=ORION_PAGE_SIZE,
+        timeout=None,
+    ):
+        """
+        Iterate over the pages of entities of a given type near a location, using
+        Orion's georel query. Pages come nearest first.
+        Yields:
+            list: One page of entities at a time. See iter_entity_pages.
+        """
+        return self.iter_entity_pages(
+            entity_type,
+            attrs,
+            key_values,
+            page_size,
+            nearby_params(latitude, longitude, radius_meters),
+            timeout,
+        )
+
+    def find_entities_nearby(
+        self,
+        entity_type,
+        latitude,
+        longitude,
+        radius_meters=5000,
+        attrs=None,
+        key_values=False,
+        page_size=ORION_PAGE_SIZE,
+        timeout=None,
+    ):
+        """
+        Find all entities of a given type near a location using Orion's georel query,
+        following pagination.
+        Args:
+            attrs (str or list, optional): Attributes to return (projection).
+            key_values (bool): Request the simplified keyValues representation.
+        Returns:
+            list: The entities (dicts), or an empty list if the query failed.
+        """
+        logger.info(
+            f"Searching for {entity_type} near: lat={latitude}, lon={longitude}, radius={radius_meters}m"
+        )
+        try:
+            entities = []
+            for page in self.iter_entities_nearby(
+                entity_type,
+                latitude,
+                longitude,
+                radius_meters,
+                attrs,
+                key_values,
+                page_size,
+                timeout,
+            ):
+                entities.extend(page)
+            logger.info(f"Total nearby {entity_type}: {len(entities)}")
+            return entities
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to search for {entity_type} with georel: {e}")
+            return []
+
+
+_client = None
+_client_pid = None
+
+
+def get_client():
+    """
+    Returns the process-wide FiwareClient, creating it on first use.
+
+    The client is recreated after a fork (e.g. gunicorn workers) so pooled
+    connections are never shared between processes.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = FiwareClient(ORION_URL)
+        _client_pid = os.getpid()
+    return _client
+
+
+def upsert_entity(entity):
+    """
+    Create or update an entity in Orion. If the entity already exists, update its attributes.
+    Returns the response object or None if an error occurs.
+    """
+    return get_client().upsert_entity(entity)
+
+
+def update_entity(entity_id, attrs):
+    """
+    Update attributes of an existing entity in Orion. See FiwareClient.update_entity.
+    """
+    return get_client().update_entity(entity_id, attrs)
+
+
+def create_entity(entity):
+    """
+    Create a new entity in Orion. See FiwareClient.create_entity.
+    """
+    return get_client().create_entity(entity)
+
+
+def delete_all_entities(type):
+    """
+    Deletes all entities of a specified type from Orion with batch deletes.
+    See FiwareClient.purge_entities. Returns a PurgeResult.
+    """
+    return get_client().purge_entities(type)
+
+
+def batch_delete(entity_type, entity_ids):
+    """
+    Delete entities by ID with batch operations. See FiwareClient.batch_delete.
+    Returns a BatchResult.
+    """
+    return get_client().batch_delete(entity_type, entity_ids)
+
+
+def iter_entities(entity_type=None, attrs=None, key_values=False, params=None):
+    """
+    Iterate over all entities matching the query, page by page. See FiwareClient.iter_entities.
+    """
+    return get_client().iter_entities(
+        entity_type, attrs=attrs, key_values=key_values, params=params
+    )
+
+
+def wait_for_orion():
+    """
+    Waits for Orion to become available. See FiwareClient.wait_for_orion.
+    """
+    return get_client().wait_for_orion()
 
 
 def register_subscription(subscription):
     """
-    Registers a subscription in Orion Context Broker with retries for up to 30 seconds.
-    Args:
-        subscription (dict): The subscription payload to register.
-    Returns:
-        bool: True if the subscription was registered successfully, False otherwise.
-    Logging:
-        - Logs each attempt, success, or failure, including error details if any.
+    Registers a subscription in Orion. See FiwareClient.register_subscription.
     """
-    logger.info("Registering subscription to: " + json.dumps(subscription["subject"]))
+    return get_client().register_subscription(subscription)
 
-    headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
-    timeout_seconds = 30
-    retry_interval = 1
-    start_time = time.time()
+def reconcile_subscription(subscription):
+    """
+    Makes sure exactly one subscription like this one exists in Orion.
+    See FiwareClient.reconcile_subscription. Returns the subscription ID or None.
+    """
+    return get_client().reconcile_subscription(subscription)
 
-    subscriptions_url = f"{ORION_URL}/v2/subscriptions"
 
-    while time.time() - start_time < timeout_seconds:
-        try:
-            res = requests.post(subscriptions_url, json=subscription, headers=headers)
-            if res.status_code in [200, 201]:
-                logger.info("Subscription registered.")
-                return True
-            else:
-                logger.warning(f"Subscription attempt failed: {res.status_code}")
-                logger.warning(res.text)
-        except ConnectionError as ce:
-            logger.warning(f"Could not connect to orion: {subscriptions_url}")
-        except HTTPError as he:
-            logger.warning(f"Response error from Orion: {he}")
-        except Timeout as te:
-            logger.warning(f"Orion did not respond in time: {te}")
-        except RequestException as e:
-            logger.warning(f"Unexpected request error {e}")
-        except Exception as e:
-            logger.warning(f"Unknown error: {e}")
+def batch_upsert(entities, action_type="append"):
+    """
+    Create or update many entities with NGSI v2 batch operations. See FiwareClient.batch_upsert.
+    Returns a BatchResult.
+    """
+    return get_client().batch_upsert(entities, action_type)
 
-        time.sleep(retry_interval)
 
-    logger.error("Failed to register subscription after 30 seconds.")
-    return False
+def find_entities_nearby(
+    entity_type, latitude, longitude, radius_meters=5000, attrs=None, key_values=False
+):
+    """
+    Find all entities of a given type near a location using Orion's georel query.
+    See FiwareClient.find_entities_nearby. Returns a list of entities (dicts).
+    """
+    return get_client().find_entities_nearby(
+        entity_type,
+        latitude,
+        longitude,
+        radius_meters,
+        attrs=attrs,
+        key_values=key_values,
+    )
 
 
-def find_entities_nearby(entity_type, latitude, longitude, radius_meters=5000):
+def iter_entities_nearby(
+    entity_type, latitude, longitude, radius_meters=5000, attrs=None, key_values=False
+):
     """
-    Find entities of a given type near a location using Orion's georel query.
-    Returns a list of entities (dicts).
+    Iterate over the pages of entities near a location, nearest first.
+    See FiwareClient.iter_entities_nearby.
     """
-    logger.info(
-        f"Searching for {entity_type} near: lat={latitude}, lon={longitude}, radius={radius_meters}m"
+    return get_client().iter_entities_nearby(
+        entity_type,
+        latitude,
+        longitude,
+        radius_meters,
+        attrs=attrs,
+        key_values=key_values,
     )
-    try:
-        params_geo = {
-            "type": entity_type,
-            "georel": f"near;maxDistance:{radius_meters}",
-            "geometry": "point",
-            "coords": f"{latitude},{longitude}",
-        }
-        response_geo = requests.get(f"{ORION_URL}/v2/entities", params=params_geo)
-        response_geo.raise_for_status()
-        entities = response_geo.json()
-        logger.info(f"Total nearby {entity_type}: {len(entities)}")
-        return entities
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to search for {entity_type} with georel: {e}")
-        return []
@@ -0,0 +1,410 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import weakref
+import httpx
+import metrics
+from fiware import (
+    ORION_URL,
+    ORION_POOL_SIZE,
+    ORION_TIMEOUT,
+    ORION_RETRIES,
+    ORION_BACKOFF,
+    RETRY_STATUS_CODES,
+    RETRY_METHODS,
+    BATCH_MAX_ENTITIES,
+    BATCH_MAX_BYTES,
+    BATCH_ACTION_TYPES,
+    ORION_PAGE_SIZE,
+    BatchResult,
+    chunk_entities,
+    batch_payload,
+    apply_batch_response,
+    entity_query,
+    nearby_params,
+)
+
+logger = logging.getLogger("fiware")
+
+ORION_CONCURRENCY = int(os.environ.get("ORION_CONCURRENCY", "20"))
+
+
+class AsyncFiwareClient:
+    """
+    asyncio variant of fiware.FiwareClient built on httpx.AsyncClient.
+
+    Connections to Orion are pooled and kept alive, and a semaphore caps the number
+    of requests in flight so a burst of notifications cannot flood Orion. Requests
+    carry a timeout and are retried with exponential backoff on connection errors,
+    and idempotent requests (fiware.RETRY_METHODS) also on other transport errors
+    and 5xx responses.
+
+    Args:
+        base_url (str): Orion base URL, e.g. http://orion:1026.
+        pool_size (int): Maximum number of pooled connections kept open to Orion.
+        concurrency (int): Maximum number of concurrent requests to Orion.
+        timeout (float): Default timeout in seconds applied to every request.
+        retries (int): Number of retries on transport errors and 5xx responses.
+        backoff_factor (float): Backoff factor between retries (0.5 -> 0.5s, 1s, 2s...).
+    """
+
+    def __init__(
+        self,
+        base_url,
+        pool_size=ORION_POOL_SIZE,
+        concurrency=ORION_CONCURRENCY,
+        timeout=ORION_TIMEOUT,
+        retries=ORION_RETRIES,
+        backoff_factor=ORION_BACKOFF,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.http = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+        )
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def request(self, method, path, timeout=None, **kwargs):
+        """
+        Send a request to Orion, honouring the concurrency limit and retry policy.
+        Args:
+            method (str): HTTP method.
+            path (str): Path relative to the Orion base URL, e.g. /v2/entities.
+            timeout (float, optional): Overrides the client default timeout for this call.
+        Returns:
+            httpx.Response: The response returned by Orion.
+        """
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    started = time.perf_counter()
+                    status = None
+                    try:
+                        res = await self.http.request(
+                            method, path, timeout=timeout or self.timeout, **kwargs
+                        )
+                        status = res.status_code
+                    finally:
+                        metrics.observe_orion(method, path, status, started)
+                if (
+                    res.status_code not in RETRY_STATUS_CODES
+                    or method.upper() not in RETRY_METHODS
+                    or attempt >= self.retries
+                ):
+                    return res
+                logger.warning(
+                    f"Orion {method} {path} responded {res.status_code}, retrying."
+                )
+            except httpx.TransportError as e:
+                # See fiware.RETRY_METHODS: only a failed connect is safe to retry
+                # for every method.
+                retryable = method.upper() in RETRY_METHODS or isinstance(
+                    e, httpx.ConnectError
+                )
+                if not retryable or attempt >= self.retries:
+                    raise
+                logger.warning(f"Orion {method} {path} failed ({e!r}), retrying.")
+            await asyncio.sleep(self.backoff_factor * (2**attempt))
+            attempt += 1
+
+    async def upsert_entity(self, entity, timeout=None):
+        """
+        Create or update an entity in Orion. If the entity already exists, update its attributes.
+        Returns the response object or None if an error occurs.
+        """
+        try:
+            headers = {"Content-Type": "application/json"}
+            res = await self.request(
+                "POST", "/v2/entities", json=entity, headers=headers, timeout=timeout
+            )
+            if res.status_code == 422 and "Already Exists" in res.text:
+                # Entity exists, update its attributes
+                alert_id = entity.get("id")
+                if not alert_id:
+                    logger.error("Entity ID missing for update.")
+                    return None
+                update_entity = entity.copy()
+                update_entity.pop("id", None)
+                update_entity.pop("type", None)
+                res = await self.request(
+                    "PUT",
+                    f"/v2/entities/{alert_id}/attrs",
+                    headers=headers,
+                    json=update_entity,
+                    timeout=timeout,
+                )
+            return res
+        except Exception as e:
+            logger.error(f"Error upserting entity {entity.get('id', 'Unknown')}: {e}")
+            raise
+
+    async def update_entity(self, entity_id, attrs, timeout=None):
+        """
+        Update attributes of an existing entity in Orion using POST /v2/entities/{entity_id}/attrs.
+        Args:
+            entity_id (str): The ID of the entity to update.
+            attrs (dict): The attributes to update in the entity.
+            timeout (float, optional): Overrides the client default timeout for this call.
+        Logging:
+            - Logs success or error for the update operation.
+        """
+        try:
+            headers = {"Content-Type": "application/json"}
+            await self.request(
+                "POST",
+                f"/v2/entities/{entity_id}/attrs",
+                json=attrs,
+                headers=headers,
+                timeout=timeout,
+            )
+            logger.info(
+                f"Updated entity {entity_id} with {json.dumps(attrs)} attributes."
+            )
+        except Exception as e:
+            logger.error(f"Error updating entity {entity_id}: {e}", exc_info=True)
+            raise
+
+    async def batch_upsert(
+        self,
+        entities,
+        action_type="append",
+        max_entities=BATCH_MAX_ENTITIES,
+        max_bytes=BATCH_MAX_BYTES,
+        timeout=None,
+    ):
+        """
+        Create or update many entities with NGSI v2 batch operations (POST /v2/op/update).
+        Chunks are sent concurrently, within the client concurrency limit.
+        See fiware.FiwareClient.batch_upsert for chunking and error reporting.
+        Returns:
+            BatchResult: Per-entity success and error report.
+        """
+        if action_type not in BATCH_ACTION_TYPES:
+            raise ValueError(f"Unsupported batch actionType: {action_type}")
+
+        result = BatchResult(action_type)
+        start_time = time.time()
+
+        chunks = chunk_entities(entities, max_entities, max_bytes, result)
+        await asyncio.gather(
+            *(self._send_batch(action_type, chunk, result, timeout) for chunk in chunks)
+        )
+
+        result.elapsed = time.time() - start_time
+        logger.info(f"Batch {result.summary()}")
+        for entity_id, error in result.errors.items():
+            logger.warning(f"Batch {action_type} failed for {entity_id}: {error}")
+        return result
+
+    async def _send_batch(self, action_type, chunk, result, timeout):
+        headers = {"Content-Type": "application/json"}
+        try:
+            res = await self.request(
+                "POST",
+                "/v2/op/update",
+                content=batch_payload(action_type, chunk),
+                headers=headers,
+                timeout=timeout,
+            )
+        except httpx.HTTPError as e:
+            for entity_id, _ in chunk:
+                result.errors[entity_id] = str(e)
+            return
+        finally:
+            result.requests += 1
+
+        for part in apply_batch_response(res.status_code, res.text, chunk, result):
+            await self._send_batch(action_type, part, result, timeout)
+
+    async def iter_entity_pages(
+        self,
+        entity_type=None,
+        attrs=None,
+        key_values=False,
+        page_size=ORION_PAGE_SIZE,
+        params=None,
+        timeout=None,
+    ):
+        """
+        Iterate over the pages of GET /v2/entities, following offset pagination.
+        See fiware.FiwareClient.iter_entity_pages.
+        Yields:
+            list: One page of entities at a time, fetching the next one on demand.
+        """
+        query = entity_query(entity_type, attrs, key_values, params)
+        query["limit"] = page_size
+
+        headers = {"Accept": "application/json"}
+        offset = 0
+        while True:
+            query["offset"] = offset
+            res = await self.request(
+                "GET", "/v2/entities", params=query, headers=headers, timeout=timeout
+            )
+            res.raise_for_status()
+            page = res.json()
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            offset += len(page)
+
+    def iter_entities_nearby(
+        self,
+        entity_type,
+        latitude,
+        longitude,
+        radius_meters=5000,
+        attrs=None,
+        key_values=False,
+        page_size=ORION_PAGE_SIZE,
+        timeout=None,
+    ):
+        """
+        Iterate over the pages of entities of a given type near a location, using
+        Orion's georel query. Pages come nearest first.
+        """
+        return self.iter_entity_pages(
+            entity_type,
+            attrs,
+            key_values,
+            page_size,
+            nearby_params(latitude, longitude, radius_meters),
+            timeout,
+        )
+
+    async def find_entities_nearby(
+        self,
+        entity_type,
+        latitude,
+        longitude,
+        radius_meters=5000,
+        attrs=None,
+        key_values=False,
+        page_size=ORION_PAGE_SIZE,
+        timeout=None,
+    ):
+        """
+        Find all entities of a given type near a location using Orion's georel query,
+        following pagination.
+        Args:
+            attrs (str or list, optional): Attributes to return (projection).
+            key_values (bool): Request the simplified keyValues representation.
+        Returns:
+            list: The entities (dicts), or an empty list if the query failed.
+        """
+        logger.info(
+            f"Searching for {entity_type} near: lat={latitude}, lon={longitude}, radius={radius_meters}m"
+        )
+        try:
+            entities = []
+            async for page in self.iter_entities_nearby(
+                entity_type,
+                latitude,
+                longitude,
+                radius_meters,
+                attrs,
+                key_values,
+                page_size,
+                timeout,
+            ):
+                entities.extend(page)
+            logger.info(f"Total nearby {entity_type}: {len(entities)}")
+            return entities
+        except httpx.HTTPError as e:
+            logger.error(f"Failed to search for {entity_type} with georel: {e}")
+            return []
+
+
+# httpx connections are bound to the event loop that opened them, so each
+# running loop gets its own pooled client.
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    """
+    Returns the AsyncFiwareClient bound to the running event loop, creating it on first use.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = AsyncFiwareClient(ORION_URL)
+        _clients[loop] = client
+    return client
+
+
+async def close_client():
+    """
+    Closes the client bound to the running event loop, if any.
+    Call it before a short-lived event loop (e.g. a Flask async view) finishes.
+    """
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def upsert_entity(entity):
+    """
+    Create or update an entity in Orion. See AsyncFiwareClient.upsert_entity.
+    """
+    return await get_client().upsert_entity(entity)
+
+
+async def update_entity(entity_id, attrs):
+    """
+    Update attributes of an existing entity in Orion. See AsyncFiwareClient.update_entity.
+    """
+    return await get_client().update_entity(entity_id, attrs)
+
+
+async def batch_upsert(entities, action_type="append"):
+    """
+    Create or update many entities with NGSI v2 batch operations.
+    See AsyncFiwareClient.batch_upsert. Returns a BatchResult.
+    """
+    return await get_client().batch_upsert(entities, action_type)
+
+
+async def find_entities_nearby(
+    entity_type, latitude, longitude, radius_meters=5000, attrs=None, key_values=False
+):
+    """
+    Find all entities of a given type near a location using Orion's georel query.
+    See AsyncFiwareClient.find_entities_nearby. Returns a list of entities (dicts).
+    """
+    return await get_client().find_entities_nearby(
+        entity_type,
+        latitude,
+        longitude,
+        radius_meters,
+        attrs=attrs,
+        key_values=key_values,
+    )
+
+
+def iter_entities_nearby(
+    entity_type, latitude, longitude, radius_meters=5000, attrs=None, key_values=False
+):
+    """
+    Asynchronously iterate over the pages of entities near a location, nearest
+    first. See AsyncFiwareClient.iter_entities_nearby.
+    """
+    return get_client().iter_entities_nearby(
+        entity_type,
+        latitude,
+        longitude,
+        radius_meters,
+        attrs=attrs,
+        key_values=key_values,
+    )
@@ -0,0 +1,421 @@
+import logging
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger("influx_convert")
+
+NUMERIC_TYPES = ("Number", "Integer", "Float")
+# NGSI types whose fields are integers from the first write on.
+INTEGER_TYPES = ("Integer",)
+STRUCTURED_TYPES = ("StructuredValue",)
+GEO_TYPES = ("geo:json",)
+# Nested StructuredValue keys deeper than this are not flattened.
+MAX_FLATTEN_DEPTH = 3
+
+# Suffix of the measurement holding the current state of each entity, one row per
+# entity (see InfluxConverter.latest_point).
+LATEST_SUFFIX = "_latest"
+
+# Distinct values a tag may take before new values are written as "other".
+MAX_TAG_VALUES = 1000
+OTHER_TAG_VALUE = "other"
+
+
+def program_code(course_code):
+    """
+    Program prefix of a course code, e.g. "PPGA" for "PPGA0050".
+    """
+    match = re.match(r"[A-Za-z]+", str(course_code))
+    return match.group(0).upper() if match else None
+
+
+# Attributes written as tags, per entity type: tag key -> attribute name, or
+# (attribute name, function deriving the tag value). Only low-cardinality values
+# belong here; every other attribute is a field. entity_id is always a tag.
+TAG_SCHEMA = {
+    "CourseInstance": {
+        "courseType": "courseType",
+        "program": ("courseCode", program_code),
+        "status": "status",
+        "building": "locationText",
+    },
+    "Alert": {
+        "category": "category",
+        "subCategory": "subCategory",
+        "severity": "severity",
+    },
+}
+
+
+def _number(value):
+    # bool is an int subclass; it must not end up in a numeric field.
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+def _scalar(value):
+    """
+    Returns value as an Influx field value: numbers, booleans and strings are kept,
+    anything else is None. FieldPlan reconciles ints and floats per field.
+    """
+    if isinstance(value, (bool, str)):
+        return value
+    return _number(value)
+
+
+def _extract_number(name, value):
+    number = _number(value)
+    return [] if number is None else [(name, number)]
+
+
+def _extract_scalar(name, value):
+    scalar = _scalar(value)
+    return [] if scalar is None else [(name, scalar)]
+
+
+def _extract_structured(name, value, depth=1):
+    if not isinstance(value, dict):
+        return _extract_scalar(name, value)
+    fields = []
+    for key, item in value.items():
+        field = f"{name}_{key}"
+        if isinstance(item, dict):
+            if depth < MAX_FLATTEN_DEPTH:
+                fields.extend(_extract_structured(field, item, depth + 1))
+        else:
+            fields.extend(_extract_scalar(field, item))
+    return fields
+
+
+def _extract_geo(name, value):
+    # GeoJSON points are [lon, lat]; other geometries have no single coordinate.
+    if not isinstance(value, dict) or value.get("type") != "Point":
+        return []
+    coordinates = value.get("coordinates") or []
+    if len(coordinates) < 2:
+        return []
+    lon, lat = _number(coordinates[0]), _number(coordinates[1])
+    if lat is None or lon is None:
+        return []
+    return [(f"{name}_lat", lat), (f"{name}_lon", lon)]
+
+
+def _extract_geo_point(name, value):
+    # geo:point is a "lat, lon" string.
+    try:
+        lat, lon = (float(part) for part in str(value).split(","))
+    except ValueError:
+        return []
+    return [(f"{name}_lat", lat), (f"{name}_lon", lon)]
+
+
+def _choose_extractor(ngsi_type, value):
+    if ngsi_type in NUMERIC_TYPES:
+        return _extract_number
+    if ngsi_type in GEO_TYPES:
+        return _extract_geo
+    if ngsi_type == "geo:point":
+        return _extract_geo_point
+    if ngsi_type in STRUCTURED_TYPES or isinstance(value, dict):
+        return _extract_structured
+    return _extract_scalar
+
+
+class FieldPlan:
+    """
+    How the attributes of one entity type become Influx tags and fields.
+
+    The extractor of each attribute is chosen from its NGSI type the first time the
+    attribute is seen and reused afterwards. The type of every field is pinned by
+    field_types (the types InfluxDB already holds), else by INTEGER_TYPES, else on
+    first write. Later numbers are converted to the pinned type when that loses
+    nothing (an int into a float field, a whole float into an integer field); any
+    other value of another type is dropped instead of making InfluxDB reject the
+    whole point with a field type conflict.
+    """
+
+    def __init__(self, entity_type, tag_schema=None, field_types=None):
+        self.entity_type = entity_type
+        self.extractors = {}
+        self.field_types = dict(field_types or {})
+        self.conflicts = 0
+        self.tag_sources = {}
+        for tag, source in (tag_schema or {}).items():
+            attr, derive = source if isinstance(source, tuple) else (source, None)
+            self.tag_sources[tag] = (attr, derive)
+        # Attributes copied verbatim into a tag are not fields too; attributes a tag
+        # is derived from (e.g. program from courseCode) stay fields.
+        self.tag_attrs = {
+            attr for attr, derive in self.tag_sources.values() if derive is None
+        }
+        self.tag_values = {tag: set() for tag in self.tag_sources}
+        self.capped_tags = 0
+
+    def tags(self, attrs):
+        """
+        Returns the tags found in attrs. A tag that already has MAX_TAG_VALUES distinct
+        values gets OTHER_TAG_VALUE for any new value, which bounds series cardinality.
+        """
+        tags = {}
+        for tag, (attr_name, derive) in self.tag_sources.items():
+            attr = attrs.get(attr_name)
+            value = attr.get("value") if isinstance(attr, dict) else None
+            if derive and value is not None:
+                value = derive(value)
+            if value is None or value == "":
+                continue
+            value = str(value)
+            seen = self.tag_values[tag]
+            if value not in seen:
+                if len(seen) >= MAX_TAG_VALUES:
+                    self.capped_tags += 1
+                    value = OTHER_TAG_VALUE
+                else:
+                    seen.add(value)
+            tags[tag] = value
+        return tags
+
+    def fields(self, attrs, names=None):
+        """
+        Args:
+            attrs (dict): Attribute name -> {"type", "value", ...}.
+            names (iterable): Attributes to convert, all of them when None.
+        Returns:
+            dict: Influx field name -> value.
+        """
+        fields = {}
+        for name in attrs if names is None else names:
+            if name in self.tag_attrs:
+                continue
+            attr = attrs[name]
+            if not isinstance(attr, dict):
+                continue
+            value = attr.get("value")
+            if value is None:
+                continue
+            key = (name, attr.get("type"))
+            extractor = self.extractors.get(key)
+            if extractor is None:
+                extractor = self.extractors[key] = _choose_extractor(key[1], value)
+            for field, field_value in extractor(name, value):
+                if key[1] in INTEGER_TYPES:
+                    self.field_types.setdefault(field, int)
+                field_value = self._coerce(field, field_value)
+                if field_value is not None:
+                    fields[field] = field_value
+        return fields
+
+    def _coerce(self, field, value):
+        value_type = type(value)
+        field_type = self.field_types.setdefault(field, value_type)
+        if field_type is value_type:
+            return value
+        if field_type is float and value_type is int:
+            return float(value)
+        if field_type is int and value_type is float and value.is_integer():
+            return int(value)
+        self.conflicts += 1
+        if self.conflicts == 1 or self.conflicts % 1000 == 0:
+            logger.warning(
+                f"{self.entity_type}.{field}: dropping {type(value).__name__} value, "
+                f"field is {field_type.__name__} ({self.conflicts} conflicts)"
+            )
+        return None
+
+
+class InfluxConverter:
+    """
+    Converts NGSI entities into Influx points using one FieldPlan per entity type.
+
+    With skip_unchanged, the modification time of every attribute is remembered per
+    entity and attributes that did not change since the previous conversion are left
+    out of the point. Call reset() when points were lost (e.g. a failed write) so the
+    next conversion writes every attribute again.
+
+    Args:
+        skip_unchanged (bool): Leave out attributes whose modification time is
+            unchanged.
+        max_entities (int): Entities whose modification times are remembered (LRU).
+        tag_schema (dict): Entity type -> tag definitions, TAG_SCHEMA by default.
+        field_types (dict): Entity type -> {field: int, float, str or bool}, the field
+            types already stored in InfluxDB (see pin_field_types).
+    """
+
+    def __init__(
+        self,
+        skip_unchanged=True,
+        max_entities=100000,
+        tag_schema=None,
+        field_types=None,
+    ):
+        self.skip_unchanged = skip_unchanged
+        self.max_entities = max_entities
+        self.tag_schema = TAG_SCHEMA if tag_schema is None else tag_schema
+        self.field_types = {
+            entity_type: dict(types)
+            for entity_type, types in (field_types or {}).items()
+        }
+        self.plans = {}
+        self.converted = 0
+        self.skipped_attrs = 0
+        self._mdates = OrderedDict()
+        self._tags = OrderedDict()
+        self._lock = threading.Lock()
+
+    def plan(self, entity_type):
+        plan = self.plans.get(entity_type)
+        if plan is None:
+            plan = self.plans[entity_type] = FieldPlan(
+                entity_type,
+                self.tag_schema.get(entity_type),
+                self.field_types.get(entity_type),
+            )
+        return plan
+
+    def pin_field_types(self, field_types):
+        """
+        Pins fields to the types InfluxDB already stores for them, so a restart keeps
+        writing e.g. an integer enrollments field as integers.
+        Args:
+            field_types (dict): Entity type -> {field: int, float, str or bool}.
+        """
+        with self._lock:
+            for entity_type, types in field_types.items():
+                self.field_types.setdefault(entity_type, {}).update(types)
+                plan = self.plans.get(entity_type)
+                if plan is not None:
+                    plan.field_types.update(types)
+
+    def convert(self, entity_id, entity_type, attrs, timestamp, mdates=None, only=None):
+        """
+        Args:
+            entity_id (str): Entity ID, written as the entity_id tag.
+            entity_type (str): Entity type, used as the measurement.
+            attrs (dict): Attribute name -> {"type", "value", ...}.
+            timestamp (str): Point time.
+            mdates (dict): Attribute name -> modification time, used by skip_unchanged.
+            only (iterable): Attributes written as fields, all of attrs by default.
+                Tags are still read from every attribute in attrs.
+        Returns:
+            dict: The Influx point, or None when nothing changed. When only tag values
+            changed the point has no fields: it is only valid for latest_point().
+        """
+        names = self._changed(entity_type, entity_id, attrs, mdates)
+        if only is not None:
+            only = set(only)
+            names = [
+                name for name in (attrs if names is None else names) if name in only
+            ]
+        with self._lock:
+            plan = self.plan(entity_type)
+            tags, tags_changed = self._entity_tags(
+                entity_type, entity_id, plan.tags(attrs)
+            )
+            # New tag values start a new series, which gets every field.
+            fields = plan.fields(attrs, only if tags_changed else names)
+        if not fields and not tags_changed:
+            return None
+        self.converted += 1
+        return {
+            "measurement": entity_type,
+            "tags": {"entity_id": entity_id, **tags},
+            "time": timestamp,
+            "fields": fields,
+        }
+
+    def latest_point(self, point):
+        """
+        Returns the point for the <measurement>_latest measurement: tagged by entity_id
+        only, with the tags stored as fields and a fixed timestamp, so every write
+        overwrites the entity's single row (InfluxDB merges the fields of points with
+        the same series and time). Must be written to a retention policy without expiry.
+        """
+        tags = dict(point["tags"])
+        entity_id = tags.pop("entity_id")
+        return {
+            "measurement": point["measurement"] + LATEST_SUFFIX,
+            "tags": {"entity_id": entity_id},
+            "time": 0,
+            "fields": {**tags, **point["fields"]},
+        }
+
+    def _entity_tags(self, entity_type, entity_id, tags):
+        # Notifications only carry changed attributes, so tags seen earlier are kept.
+        key = (entity_type, entity_id)
+        previous = self._tags.pop(key, {})
+        known = {**previous, **tags}
+        if known:
+            self._tags[key] = known
+            while len(self._tags) > self.max_entities:
+                self._tags.popitem(last=False)
+        return known, known != previous
+
+    def convert_mongo(self, doc):
+        """
+        Converts an entity document from Orion's MongoDB collection. The point time is
+        the epoch seconds of the "timestamp" attribute when present, else now.
+        """
+        _id = doc.get("_id", {})
+        attrs = doc.get("attrs", {})
+
+        timestamp = None
+        if "timestamp" in attrs and "value" in attrs["timestamp"]:
+            try:
+                ts_val = attrs["timestamp"]["value"]
+                timestamp = datetime.utcfromtimestamp(ts_val).isoformat()
+            except (TypeError, ValueError, OverflowError, OSError):
+                timestamp = datetime.utcnow().isoformat()
+        else:
+            timestamp = datetime.utcnow().isoformat()
+
+        mdates = {
+            name: attr.get("mdate")
+            for name, attr in attrs.items()
+            if isinstance(attr, dict)
+        }
+        return self.convert(
+            _id.get("id", "unknown"),
+            _id.get("type", "UnknownType"),
+            attrs,
+            timestamp,
+            mdates,
+        )
+
+    def _changed(self, entity_type, entity_id, attrs, mdates):
+        if not self.skip_unchanged or not mdates:
+            return None
+        key = (entity_type, entity_id)
+        with self._lock:
+            previous = self._mdates.pop(key, {})
+            current = dict(previous)
+            names = []
+            for name in attrs:
+                mdate = mdates.get(name)
+                if mdate is not None and previous.get(name) == mdate:
+                    self.skipped_attrs += 1
+                    continue
+                names.append(name)
+                current[name] = mdate
+            self._mdates[key] = current
+            while len(self._mdates) > self.max_entities:
+                self._mdates.popitem(last=False)
+        return names
+
+    def reset(self):
+        """
+        Forgets the remembered modification times, so every attribute is written again.
+        """
+        with self._lock:
+            self._mdates.clear()
+
+    def stats(self):
+        return {
+            "entity_types": len(self.plans),
+            "converted": self.converted,
+            "skipped_unchanged_attrs": self.skipped_attrs,
+            "type_conflicts": sum(plan.conflicts for plan in self.plans.values()),
+            "capped_tag_values": sum(plan.capped_tags for plan in self.plans.values()),
+        }
@@ -0,0 +1,258 @@
+import logging
+import os
+from collections import namedtuple
+
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from requests.exceptions import RequestException
+
+import influx_writer
+
+logger = logging.getLogger("influx_schema")
+
+INFLUX_SETUP_SCHEMA = os.environ.get("INFLUX_SETUP_SCHEMA", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Raw points land in the default "raw" policy and are kept for days; continuous
+# queries downsample them into rollup policies kept for months.
+RAW_RP = "raw"
+RAW_RETENTION = os.environ.get("INFLUX_RAW_RETENTION", "7d")
+
+Rollup = namedtuple("Rollup", ["rp", "interval", "retention", "max_range_ms"])
+
+DAY_MS = 24 * 60 * 60 * 1000
+ROLLUPS = [
+    Rollup(
+        "rollup_5m",
+        "5m",
+        os.environ.get("INFLUX_ROLLUP_5M_RETENTION", "30d"),
+        30 * DAY_MS,
+    ),
+    Rollup(
+        "rollup_1h", "1h", os.environ.get("INFLUX_ROLLUP_1H_RETENTION", "52w"), None
+    ),
+]
+# Dashboards read the raw points up to this range, rollups beyond it.
+RAW_MAX_RANGE_MS = 2 * DAY_MS
+
+# Numeric fields downsampled per measurement. Rollups keep the field names (mean,
+# or last for CATEGORICAL_FIELDS) and add <field>_max, so a panel query works on
+# any retention policy.
+ROLLUP_FIELDS = {
+    "WeatherStation": ["weathercode"],
+    "CourseInstance": [
+        "enrollments",
+        "capacity",
+        "currentWeather_temperature",
+        "currentWeather_windspeed",
+        "currentWeather_weathercode",
+    ],
+}
+# WMO weather codes are categories, not quantities: their rollup keeps the last
+# code of each interval instead of a meaningless mean.
+CATEGORICAL_FIELDS = {"weathercode", "currentWeather_weathercode"}
+
+# Policy without expiry for the rp_config lookup used by the Grafana "rp" variable
+# and for the <type>_latest current-state measurements (written at time 0).
+RP_CONFIG_RP = "forever"
+LATEST_RP = RP_CONFIG_RP
+RP_CONFIG_MEASUREMENT = "rp_config"
+
+# Points written before the tiered policies existed live in InfluxDB's autogen
+# policy. They are copied once into raw and the rollups; a row in
+# SCHEMA_MIGRATIONS_MEASUREMENT records the copy.
+AUTOGEN_RP = "autogen"
+SCHEMA_MIGRATIONS_MEASUREMENT = "schema_migrations"
+AUTOGEN_MIGRATION = "autogen_to_tiers"
+# Python field types -> InfluxQL casts.
+CASTS = {int: "integer", float: "float", str: "string", bool: "boolean"}
+
+
+def ensure_retention_policy(client, database, name, duration, default=False):
+    existing = {
+        rp["name"]: rp for rp in client.get_list_retention_policies(database)
+    }
+    if name in existing:
+        client.alter_retention_policy(
+            name, database=database, duration=duration, default=default or None
+        )
+    else:
+        client.create_retention_policy(
+            name, duration, 1, database=database, default=default
+        )
+
+
+def continuous_query(database, measurement, fields, rollup, source=None, where=""):
+    """
+    Returns the SELECT INTO downsampling fields of measurement into rollup, from the
+    raw policy by default or from source (a measurement or a subquery).
+    """
+    selects = ", ".join(
+        f'{"last" if field in CATEGORICAL_FIELDS else "mean"}("{field}") '
+        f'AS "{field}", max("{field}") AS "{field}_max"'
+        for field in fields
+    )
+    source = source or f'"{database}"."{RAW_RP}"."{measurement}"'
+    return (
+        f'SELECT {selects} INTO "{database}"."{rollup.rp}"."{measurement}" '
+        f"FROM {source} {where}GROUP BY time({rollup.interval}), *"
+    )
+
+
+def _casts(fields):
+    return ", ".join(
+        f'"{field}"::{CASTS[field_type]} AS "{field}"'
+        for field, field_type in sorted(fields.items())
+    )
+
+
+def _since(retention):
+    # Points older than a policy's duration would be rejected by InfluxDB.
+    return "" if retention.upper() == "INF" else f"WHERE time > now() - {retention} "
+
+
+def ensure_continuous_queries(client, database):
+    """
+    (Re)creates one continuous query per measurement and rollup. Continuous queries
+    cannot be altered, so existing ones are dropped first.
+    """
+    existing = set()
+    for entry in client.get_list_continuous_queries():
+        existing.update(cq["name"] for cq in entry.get(database, []))
+
+    for measurement, fields in ROLLUP_FIELDS.items():
+        for rollup in ROLLUPS:
+            name = f"cq_{measurement}_{rollup.interval}"
+            if name in existing:
+                client.drop_continuous_query(name, database)
+            client.create_continuous_query(
+                name, continuous_query(database, measurement, fields, rollup), database
+            )
+
+
+def migrate_autogen(client, database):
+    """
+    Copies the points of the autogen policy into raw, and downsamples them into the
+    rollups, so the history written before the tiered policies existed stays visible
+    once raw is the default policy. Runs once per database.
+    Returns:
+        bool: True when the copy ran, False when it was already done.
+    """
+    done = client.query(
+        f'SELECT "done" FROM "{database}"."{RP_CONFIG_RP}".'
+        f'"{SCHEMA_MIGRATIONS_MEASUREMENT}" WHERE "name" = \'{AUTOGEN_MIGRATION}\'',
+        database=database,
+    )
+    if list(done.get_points()):
+        return False
+
+    policies = {rp["name"] for rp in client.get_list_retention_policies(database)}
+    if AUTOGEN_RP in policies:
+        logger.info(f"Copying {AUTOGEN_RP} points into {RAW_RP} and the rollups")
+        # Every field is cast to the type the converter keeps writing (see
+        # influx_writer.read_field_types), so the copy cannot put another type
+        # than the new points into the current shards.
+        autogen_types = influx_writer.read_field_types(client, database, (AUTOGEN_RP,))
+        for measurement, fields in sorted(autogen_types.items()):
+            client.query(
+                f'SELECT {_casts(fields)} INTO "{database}"."{RAW_RP}"."{measurement}" '
+                f'FROM "{database}"."{AUTOGEN_RP}"."{measurement}" '
+                f"{_since(RAW_RETENTION)}GROUP BY *",
+                database=database,
+                method="POST",
+            )
+        for measurement, rollup_fields in ROLLUP_FIELDS.items():
+            fields = {
+                field: field_type
+                for field, field_type in autogen_types.get(measurement, {}).items()
+                if field in rollup_fields
+            }
+            if not fields:
+                continue
+            for rollup in ROLLUPS:
+                where = _since(rollup.retention)
+                source = (
+                    f"(SELECT {_casts(fields)} "
+                    f'FROM "{database}"."{AUTOGEN_RP}"."{measurement}" '
+                    f"{where}GROUP BY *)"
+                )
+                query = continuous_query(
+                    database, measurement, sorted(fields), rollup, source, where
+                )
+                client.query(query, database=database, method="POST")
+
+    client.write_points(
+        [
+            {
+                "measurement": SCHEMA_MIGRATIONS_MEASUREMENT,
+                "tags": {"name": AUTOGEN_MIGRATION},
+                "time": 0,
+                "fields": {"done": True},
+            }
+        ],
+        database=database,
+        retention_policy=RP_CONFIG_RP,
+    )
+    return True
+
+
+def field_types(client, database=influx_writer.INFLUX_DB):
+    """
+    Types of the fields already stored in raw, or in autogen for the fields raw does
+    not hold yet, for InfluxConverter.pin_field_types.
+    """
+    return influx_writer.load_field_types(client, database, (RAW_RP, AUTOGEN_RP))
+
+
+def write_rp_config(client, database):
+    tiers = [(RAW_RP, RAW_MAX_RANGE_MS)] + [
+        (rollup.rp, rollup.max_range_ms) for rollup in ROLLUPS
+    ]
+    points = []
+    min_range = 0
+    for index, (rp, max_range) in enumerate(tiers):
+        max_range = max_range or 10**15
+        points.append(
+            {
+                "measurement": RP_CONFIG_MEASUREMENT,
+                "tags": {"idx": str(index)},
+                "time": 0,
+                "fields": {
+                    "rp": rp,
+                    "min_range_ms": float(min_range),
+                    "max_range_ms": float(max_range),
+                },
+            }
+        )
+        min_range = max_range
+    client.write_points(points, database=database, retention_policy=RP_CONFIG_RP)
+
+
+def setup_schema(client, database=influx_writer.INFLUX_DB):
+    """
+    Creates the database, the raw/rollup/forever retention policies, the downsampling
+    continuous queries and the rp_config lookup the dashboard uses to pick a policy,
+    and copies the autogen history into them the first time. Safe to run on every
+    start.
+    Returns:
+        bool: True on success, False when InfluxDB could not be configured.
+    """
+    try:
+        client.create_database(database)
+        ensure_retention_policy(client, database, RAW_RP, RAW_RETENTION, default=True)
+        for rollup in ROLLUPS:
+            ensure_retention_policy(client, database, rollup.rp, rollup.retention)
+        ensure_retention_policy(client, database, RP_CONFIG_RP, "INF")
+        ensure_continuous_queries(client, database)
+        migrate_autogen(client, database)
+        write_rp_config(client, database)
+    except (InfluxDBClientError, InfluxDBServerError, RequestException) as e:
+        logger.error(f"Could not set up InfluxDB retention policies: {e}")
+        return False
+    logger.info(
+        f"InfluxDB schema ready: {RAW_RP} ({RAW_RETENTION}), "
+        + ", ".join(f"{r.rp} ({r.retention})" for r in ROLLUPS)
+    )
+    return True
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+from flask import Flask, Response, jsonify, request
+import asgi
+import fiware
+import influx_convert
+import influx_schema
+import influx_writer
+import metrics
+
+app = Flask(__name__)
+
+CALLBACK_URL = os.environ.get("CALLBACK_URL")
+SINK_ENTITY_TYPES = [
+    entity_type.strip()
+    for entity_type in os.environ.get(
+        "SINK_ENTITY_TYPES", "WeatherStation,CourseInstance,Alert"
+    ).split(",")
+    if entity_type.strip()
+]
+subscription_created = False
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter("[%(levelname)s] %(asctime)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.propagate = False
+
+# Notifications only carry the attributes that changed, each with its own
+# dateModified, so there is nothing left for the converter to skip.
+converter = influx_convert.InfluxConverter(skip_unchanged=False)
+writer = influx_writer.InfluxBatchWriter(influx_writer.open_client())
+writer.start()
+# One row per entity in <type>_latest, for current-state panels.
+latest_writer = influx_writer.InfluxBatchWriter(
+    writer.client, retention_policy=influx_schema.LATEST_RP
+)
+latest_writer.start()
+
+
+@app.route("/notify", methods=["POST"])
+def notify():
+    status = handle_notification(request.json)
+    return "", status
+
+
+async def receive_notification(payload):
+    return handle_notification(payload)
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(collect_stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+async def handle_stats(_payload):
+    return 200, json.dumps(collect_stats()), "application/json"
+
+
+def collect_stats():
+    return {
+        "writer": writer.stats(),
+        "latest_writer": latest_writer.stats(),
+        "converter": converter.stats(),
+    }
+
+
+def handle_notification(payload):
+    """
+    Converts the entities of an Orion notification into Influx points and buffers
+    them; the writer sends them to InfluxDB in batches from its own thread.
+    Returns:
+        int: 204, the notification is never retried by Orion.
+    """
+    data = (payload or {}).get("data")
+    if not data:
+        logger.warning("Payload does not contain 'data' key")
+        return 204
+
+    with metrics.timed(metrics.NOTIFY_SECONDS, service="influx_sink"):
+        points = []
+        for entity in data:
+            points.extend(entity_points(entity))
+            observe_traces(entity)
+        # A point without fields only carries new tag values for the latest row.
+        writer.add_many([point for point in points if point["fields"]])
+        latest_writer.add_many([converter.latest_point(point) for point in points])
+    return 204
+
+
+def observe_traces(entity):
+    """
+    Records the time from the source update to the sink for every attribute that
+    carries a traceContext (weathercode of the simulator, dateIssued of alerts).
+    """
+    stage = f"sink_{entity.get('type')}"
+    for attr in entity.values():
+        metrics.observe_trace(metrics.trace_context(attr), stage)
+
+
+def entity_points(entity):
+    """
+    Builds one point per distinct attribute modification time, so each value is
+    stored at the moment it changed in Orion rather than when it was received.
+    Attributes without a dateModified metadata are stamped with the current time.
+    """
+    entity_id = entity.get("id")
+    entity_type = entity.get("type")
+    if not entity_id or not entity_type:
+        logger.warning(f"Ignoring entity without id or type: {entity}")
+        return []
+
+    attrs = {
+        name: attr
+        for name, attr in entity.items()
+        if name not in ("id", "type") and isinstance(attr, dict)
+    }
+    received = datetime.now(timezone.utc).isoformat()
+    names_by_time = {}
+    for name, attr in attrs.items():
+        timestamp = attr.get("metadata", {}).get("dateModified", {}).get("value")
+        names_by_time.setdefault(timestamp or received, []).append(name)
+
+    points = []
+    for timestamp, names in names_by_time.items():
+        point = converter.convert(entity_id, entity_type, attrs, timestamp, only=names)
+        if point:
+            points.append(point)
+    return points
+
+
+def register_subscription():
+    global subscription_created
+    if subscription_created:
+        return
+
+    subscription = {
+        "description": "Stream entity changes to InfluxDB",
+        "subject": {
+            "entities": [
+                {"idPattern": ".*", "type": entity_type}
+                for entity_type in SINK_ENTITY_TYPES
+            ],
+        },
+        "notification": {
+            "http": {"url": CALLBACK_URL},
+            "metadata": ["dateModified", "traceContext"],
+            "onlyChangedAttrs": True,
+        },
+    }
+
+    subscription_created = fiware.reconcile_subscription(subscription)
+
+    if not subscription_created:
+        logger.error("Failed to create Influx sink subscription.")
+
+
+with app.app_context():
+    if influx_schema.INFLUX_SETUP_SCHEMA:
+        influx_schema.setup_schema(writer.client)
+    converter.pin_field_types(influx_schema.field_types(writer.client))
+    register_subscription()
+
+asgi_app = asgi.make_asgi_app(
+    {
+        ("POST", "/notify"): receive_notification,
+        ("GET", "/stats"): handle_stats,
+        ("GET", "/metrics"): metrics.handle_metrics,
+    }
+)
+
+if __name__ != "__main__":
+    gunicorn_logger = logging.getLogger("gunicorn.error")
+    app.logger.handlers = gunicorn_logger.handlers
+    app.logger.setLevel(gunicorn_logger.level)
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5000)
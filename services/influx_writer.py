@@ -0,0 +1,283 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from requests.exceptions import RequestException
+
+logger = logging.getLogger("influx_writer")
+
+INFLUX_HOST = os.environ.get("INFLUX_HOST", "influxdb")
+INFLUX_PORT = int(os.environ.get("INFLUX_PORT", "8086"))
+INFLUX_DB = os.environ.get("INFLUX_DB", "smartcampus")
+INFLUX_BATCH_SIZE = int(os.environ.get("INFLUX_BATCH_SIZE", "5000"))
+INFLUX_FLUSH_INTERVAL = float(os.environ.get("INFLUX_FLUSH_INTERVAL", "1.0"))
+INFLUX_GZIP = os.environ.get("INFLUX_GZIP", "false").lower() in ("1", "true", "yes")
+INFLUX_TIMEOUT = float(os.environ.get("INFLUX_TIMEOUT", "10"))
+# Points kept while InfluxDB is unreachable before the oldest ones are dropped.
+INFLUX_MAX_BUFFER = int(os.environ.get("INFLUX_MAX_BUFFER", "100000"))
+
+# SHOW FIELD KEYS field types -> Python types of the converter's field values.
+FIELD_TYPES = {"integer": int, "float": float, "string": str, "boolean": bool}
+
+
+def open_client(
+    host=INFLUX_HOST,
+    port=INFLUX_PORT,
+    database=INFLUX_DB,
+    gzip=INFLUX_GZIP,
+    timeout=INFLUX_TIMEOUT,
+):
+    """
+    Returns an InfluxDB client bound to database. With gzip, request bodies (line
+    protocol) are compressed, which cuts the upload size of large batches several times.
+    """
+    return InfluxDBClient(
+        host=host, port=port, database=database, gzip=gzip, timeout=timeout
+    )
+
+
+def read_field_types(client, database=INFLUX_DB, retention_policies=(None,)):
+    """
+    Reads the type of every field InfluxDB already stores.
+    Args:
+        retention_policies (tuple): Policies to read, None for the default one. A
+            field found in several keeps the type of the first policy listed.
+    Returns:
+        dict: Measurement -> {field: int, float, str or bool}. A field stored both as
+        integer and float (in different shards) is a float.
+    Raises:
+        InfluxDBClientError, InfluxDBServerError, RequestException: When InfluxDB
+        could not be queried.
+    """
+    field_types = {}
+    for rp in retention_policies:
+        source = f' FROM "{rp}"./.*/' if rp else ""
+        result = client.query(f'SHOW FIELD KEYS ON "{database}"{source}')
+        found = {}
+        for (measurement, _), keys in result.items():
+            for key in keys:
+                field_type = FIELD_TYPES.get(key["fieldType"])
+                if field_type is None:
+                    continue
+                fields = found.setdefault(measurement, {})
+                known = fields.setdefault(key["fieldKey"], field_type)
+                if {known, field_type} == {int, float}:
+                    fields[key["fieldKey"]] = float
+        for measurement, fields in found.items():
+            for field, field_type in fields.items():
+                field_types.setdefault(measurement, {}).setdefault(field, field_type)
+    return field_types
+
+
+def load_field_types(client, database=INFLUX_DB, retention_policies=(None,)):
+    """
+    Like read_field_types, for the converter to keep writing each field with the
+    type InfluxDB already stores. Returns an empty dict when InfluxDB could not be
+    queried, so the types are then pinned on first write.
+    """
+    try:
+        return read_field_types(client, database, retention_policies)
+    except (InfluxDBClientError, InfluxDBServerError, RequestException) as e:
+        logger.warning(f"Could not read the Influx field types: {e}")
+        return {}
+
+
+class InfluxBatchWriter:
+    """
+    Buffers Influx points and writes them in batches instead of one request per point.
+
+    The buffer is flushed when it reaches batch_size points or when flush_interval
+    seconds have passed since the last flush, whichever comes first. Thread-safe.
+    After start(), flushes run on a background thread and add() never blocks on
+    InfluxDB, which suits request handlers.
+
+    Args:
+        client (InfluxDBClient): Client used for the writes.
+        batch_size (int): Points per write request.
+        flush_interval (float): Maximum seconds a point waits in the buffer
+            (checked on add() and flush_if_due()).
+        max_buffer (int): Points kept while writes fail; older points are dropped.
+        retention_policy (str): Retention policy to write to, None for the default.
+    """
+
+    def __init__(
+        self,
+        client,
+        batch_size=INFLUX_BATCH_SIZE,
+        flush_interval=INFLUX_FLUSH_INTERVAL,
+        max_buffer=INFLUX_MAX_BUFFER,
+        retention_policy=None,
+    ):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.retention_policy = retention_policy
+
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+        self.points_written = 0
+        self.points_dropped = 0
+        self.requests = 0
+        self.failed_requests = 0
+        self._started = None
+        self._flush_time = 0.0
+        self._flush_max = 0.0
+        self._flush_last = 0.0
+
+        self._background = False
+        self._wake = threading.Event()
+        self._pid = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def add(self, point):
+        self.add_many([point])
+
+    def add_many(self, points):
+        """
+        Buffers points. Full batches are written right away, by the caller or by the
+        background flusher after start().
+        """
+        with self._lock:
+            if self._started is None:
+                self._started = time.monotonic()
+            self._buffer.extend(points)
+            overflow = len(self._buffer) - self.max_buffer
+            for _ in range(max(overflow, 0)):
+                self._buffer.popleft()
+                self.points_dropped += 1
+            if overflow > 0:
+                logger.warning(f"Influx buffer full, dropped {overflow} oldest points")
+            ready = len(self._buffer) >= self.batch_size
+        if self._background:
+            self._ensure_started()
+            if ready:
+                self._wake.set()
+        elif ready:
+            self.flush(full_batches_only=True)
+        else:
+            self.flush_if_due()
+
+    def start(self):
+        """
+        Moves flushing to a daemon thread that writes every flush_interval seconds,
+        or as soon as a full batch is buffered.
+        """
+        self._background = True
+        self._ensure_started()
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so the flusher starts lazily in each process.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name="influx-flush", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"Influx flush failed, {len(self._buffer)} points kept: {e}")
+
+    def flush_if_due(self):
+        if self._buffer and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self, full_batches_only=False):
+        """
+        Writes the buffered points in batch_size requests. A batch InfluxDB rejects as
+        invalid (4xx) is dropped and logged; on any other error the unsent points stay
+        buffered and the exception is raised.
+        Returns:
+            int: Number of points written.
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    if not self._buffer or (
+                        full_batches_only and len(self._buffer) < self.batch_size
+                    ):
+                        break
+                    count = min(self.batch_size, len(self._buffer))
+                    batch = [self._buffer.popleft() for _ in range(count)]
+
+                start = time.monotonic()
+                try:
+                    self.client.write_points(
+                        batch, retention_policy=self.retention_policy
+                    )
+                except InfluxDBClientError as e:
+                    if e.code is not None and 400 <= e.code < 500:
+                        logger.error(f"InfluxDB rejected {len(batch)} points: {e}")
+                        self._record(start, failed=True)
+                        self.points_dropped += len(batch)
+                        continue
+                    self._requeue(batch, start)
+                    raise
+                except Exception:
+                    self._requeue(batch, start)
+                    raise
+                self._record(start)
+                self.points_written += len(batch)
+                written += len(batch)
+            self._last_flush = time.monotonic()
+        return written
+
+    def _requeue(self, batch, start):
+        self._record(start, failed=True)
+        with self._lock:
+            self._buffer.extendleft(reversed(batch))
+
+    def _record(self, start, failed=False):
+        latency = time.monotonic() - start
+        self.requests += 1
+        self.failed_requests += failed
+        self._flush_time += latency
+        self._flush_max = max(self._flush_max, latency)
+        self._flush_last = latency
+
+    def discard(self):
+        """
+        Drops every buffered point (e.g. before re-reading them from the source).
+        """
+        with self._lock:
+            self.points_dropped += len(self._buffer)
+            self._buffer.clear()
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        return {
+            "buffered": len(self._buffer),
+            "points_written": self.points_written,
+            "points_dropped": self.points_dropped,
+            "requests": self.requests,
+            "failed_requests": self.failed_requests,
+            "points_per_second": self.points_written / elapsed if elapsed else 0.0,
+            "flush_latency_seconds": {
+                "avg": self._flush_time / self.requests if self.requests else 0.0,
+                "max": self._flush_max,
+                "last": self._flush_last,
+            },
+        }
+
+    def summary(self):
+        stats = self.stats()
+        latency = stats["flush_latency_seconds"]
+        return (
+            f"{stats['points_written']} points in {stats['requests']} writes "
+            f"({stats['points_per_second']:.0f} points/s, flush avg "
+            f"{latency['avg'] * 1000:.1f}ms max {latency['max'] * 1000:.1f}ms)"
+        )
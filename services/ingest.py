@@ -0,0 +1,427 @@
+import argparse
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date
+import fiware
+import metrics
+from schedule_index import WEEKDAY_INDEX, parse_minutes
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+formatter = logging.Formatter("[%(levelname)s] %(asctime)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.propagate = False
+
+# A directory of one-entity JSON files (the scraper output) or a JSONL stream.
+INGEST_SOURCE = os.environ.get("INGEST_SOURCE") or os.environ.get(
+    "ENTITIES_DIR", "./entities"
+)
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", str(os.cpu_count() or 2)))
+# Files or lines handed to a worker per task.
+INGEST_CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", "64"))
+INGEST_BATCH_SIZE = int(
+    os.environ.get("INGEST_BATCH_SIZE", str(fiware.BATCH_MAX_ENTITIES))
+)
+INGEST_REJECT_FILE = os.environ.get("INGEST_REJECT_FILE", "ingest_rejects.jsonl")
+
+_HH_MM = re.compile(r"^\d{2}:\d{2}$")
+
+
+def loads(data):
+    """
+    Parses JSON with orjson when it is installed, else with the standard library.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _check_text(value):
+    if not isinstance(value, str):
+        return "must be a string"
+
+
+def _check_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return "must be a number"
+
+
+def _check_point(value):
+    if not isinstance(value, dict) or value.get("type") != "Point":
+        return "must be a GeoJSON Point"
+    coordinates = value.get("coordinates")
+    if not isinstance(coordinates, list) or len(coordinates) != 2:
+        return "coordinates must be [lon, lat]"
+    lon, lat = coordinates
+    if _check_number(lon) or _check_number(lat):
+        return "coordinates must be numbers"
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        return f"coordinates out of range: {coordinates}"
+
+
+def _check_class_schedule(value):
+    if not isinstance(value, list):
+        return "must be a list"
+    for i, slot in enumerate(value):
+        if not isinstance(slot, dict):
+            return f"[{i}] must be an object"
+        if slot.get("day") not in WEEKDAY_INDEX:
+            return f"[{i}].day is not a weekday: {slot.get('day')!r}"
+        times = []
+        for key in ("startTime", "endTime"):
+            text = slot.get(key)
+            try:
+                if not isinstance(text, str) or not _HH_MM.match(text):
+                    raise ValueError
+                times.append(parse_minutes(text))
+            except ValueError:
+                return f"[{i}].{key} is not HH:MM: {text!r}"
+        if times[0] >= times[1]:
+            return f"[{i}] ends before it starts"
+        days = []
+        for key in ("startPeriod", "endPeriod"):
+            # Missing or empty bounds leave the period open (see compile_schedule).
+            if not slot.get(key):
+                continue
+            try:
+                days.append(date.fromisoformat(slot[key]))
+            except (TypeError, ValueError):
+                return f"[{i}].{key} is not YYYY-MM-DD: {slot[key]!r}"
+        if len(days) == 2 and days[0] > days[1]:
+            return f"[{i}] period ends before it starts"
+
+
+_VALUE_CHECKS = {
+    "Text": _check_text,
+    "Number": _check_number,
+    "geo:json": _check_point,
+}
+
+# Attribute name -> (NGSI type, required, extra value check).
+COURSE_INSTANCE_SCHEMA = {
+    "courseCode": ("Text", True, None),
+    "courseName": ("Text", True, None),
+    "status": ("Text", False, None),
+    "enrollments": ("Number", False, None),
+    "capacity": ("Number", False, None),
+    "classSchedule": ("StructuredValue", True, _check_class_schedule),
+    "location": ("geo:json", False, None),
+}
+
+
+def compile_validator(entity_type, schema):
+    """
+    Compiles an attribute schema into a single validation function, so the per-entity
+    work is a flat list of checks with no schema interpretation.
+    Returns:
+        callable: validate(entity) -> list of error strings (empty when valid).
+    """
+    checks = []
+    for name, (ngsi_type, required, extra) in schema.items():
+        value_checks = [c for c in (_VALUE_CHECKS.get(ngsi_type), extra) if c]
+
+        def check(
+            entity,
+            errors,
+            name=name,
+            ngsi_type=ngsi_type,
+            required=required,
+            value_checks=value_checks,
+        ):
+            attr = entity.get(name)
+            if attr is None:
+                if required:
+                    errors.append(f"{name}: missing")
+                return
+            if not isinstance(attr, dict) or "value" not in attr:
+                errors.append(f"{name}: not an NGSI attribute")
+                return
+            if attr.get("type") != ngsi_type:
+                errors.append(
+                    f"{name}: type {attr.get('type')!r}, expected {ngsi_type!r}"
+                )
+                return
+            for value_check in value_checks:
+                error = value_check(attr["value"])
+                if error:
+                    errors.append(f"{name}: {error}")
+                    return
+
+        checks.append(check)
+
+    def validate(entity):
+        errors = []
+        if not str(entity.get("id", "")).startswith(f"{entity_type}:"):
+            errors.append(f"id must start with '{entity_type}:'")
+        for check in checks:
+            check(entity, errors)
+        return errors
+
+    return validate
+
+
+VALIDATORS = {
+    "CourseInstance": compile_validator("CourseInstance", COURSE_INSTANCE_SCHEMA)
+}
+
+
+def validate_entity(entity):
+    if not isinstance(entity, dict):
+        return ["not a JSON object"]
+    if not isinstance(entity.get("id"), str) or not isinstance(entity.get("type"), str):
+        return ["id and type must be strings"]
+    validator = VALIDATORS.get(entity["type"])
+    return validator(entity) if validator else []
+
+
+def process_chunk(items):
+    """
+    Worker task: reads, parses and validates a chunk of (source, path, text) items.
+    Items read from a directory have a path and no text.
+    Returns:
+        tuple: (results, timings) where results are (source, entity, errors, raw) and
+        timings maps stage -> (seconds, bytes).
+    """
+    results = []
+    timings = {"read": [0.0, 0], "parse": [0.0, 0], "validate": [0.0, 0]}
+    for source, path, text in items:
+        start = time.perf_counter()
+        if path is not None:
+            try:
+                with open(path, "rb") as file:
+                    text = file.read()
+            except OSError as e:
+                results.append((source, None, [f"read: {e}"], None))
+                continue
+        timings["read"][0] += time.perf_counter() - start
+        timings["read"][1] += len(text)
+
+        start = time.perf_counter()
+        try:
+            entity = loads(text)
+        except ValueError as e:
+            results.append((source, None, [f"parse: {e}"], _raw(text)))
+            continue
+        finally:
+            timings["parse"][0] += time.perf_counter() - start
+        timings["parse"][1] += len(text)
+
+        start = time.perf_counter()
+        errors = validate_entity(entity)
+        timings["validate"][0] += time.perf_counter() - start
+        timings["validate"][1] += len(text)
+        if errors:
+            results.append((source, None, errors, _raw(text)))
+        else:
+            results.append((source, entity, errors, None))
+    return results, timings
+
+
+def _raw(text):
+    return text.decode("utf-8", "replace") if isinstance(text, bytes) else text
+
+
+def iter_chunks(source, chunk_size):
+    """
+    Yields chunks of (source, path, text) items from a directory of .json files or
+    from a JSONL file (one entity per line, blank lines ignored).
+    """
+    chunk = []
+    if os.path.isdir(source):
+        for filename in sorted(os.listdir(source)):
+            if filename.endswith(".json"):
+                chunk.append((filename, os.path.join(source, filename), None))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+    else:
+        with open(source, "rb") as file:
+            for lineno, line in enumerate(file, 1):
+                if line.strip():
+                    chunk.append((f"{os.path.basename(source)}:{lineno}", None, line))
+                    if len(chunk) >= chunk_size:
+                        yield chunk
+                        chunk = []
+    if chunk:
+        yield chunk
+
+
+class StageStats:
+    """
+    Items, bytes and busy time of one pipeline stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def add(self, items, seconds, size=0):
+        self.items += items
+        self.seconds += seconds
+        self.bytes += size
+
+    def summary(self):
+        rate = self.items / self.seconds if self.seconds else 0.0
+        summary = (
+            f"{self.name}: {self.items} items in {self.seconds:.3f}s busy "
+            f"({rate:.0f} items/s"
+        )
+        if self.bytes and self.seconds:
+            summary += f", {self.bytes / self.seconds / 1e6:.1f} MB/s"
+        return summary + ")"
+
+
+class Ingest:
+    """
+    Streams entities from a source through parse/validate workers into Orion.
+
+    Chunks are parsed and validated in a process pool while the main process sends
+    valid entities to Orion in batches of batch_size (fiware.batch_upsert also bounds
+    each request by payload size). At most two chunks per worker are in flight, so
+    memory stays bounded for sources of any size. Invalid entities, and entities Orion
+    rejects, are appended to the reject file as JSON lines.
+    """
+
+    def __init__(
+        self, source, workers, chunk_size, batch_size, reject_path, dry_run=False
+    ):
+        self.source = source
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.reject_path = reject_path
+        self.dry_run = dry_run
+        self.stages = {
+            name: StageStats(name) for name in ("read", "parse", "validate", "upload")
+        }
+        self.accepted = 0
+        self.rejected = 0
+        self._pending = []
+        self._rejects = None
+
+    def run(self):
+        start = time.perf_counter()
+        with open(self.reject_path, "w", encoding="utf-8") as self._rejects:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                in_flight = set()
+                for chunk in iter_chunks(self.source, self.chunk_size):
+                    if len(in_flight) >= self.workers * 2:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self._collect(*future.result())
+                    in_flight.add(pool.submit(process_chunk, chunk))
+                for future in in_flight:
+                    self._collect(*future.result())
+            self._flush()
+        elapsed = time.perf_counter() - start
+        total = self.accepted + self.rejected
+        rate = total / elapsed if elapsed else 0.0
+
+        logger.info(
+            f"Ingested {self.source}: {self.accepted} accepted, "
+            f"{self.rejected} rejected in {elapsed:.2f}s ({rate:.0f} entities/s)"
+        )
+        for stage in self.stages.values():
+            logger.info(stage.summary())
+        if self.rejected:
+            logger.warning(f"Rejected entities written to {self.reject_path}")
+        return self.rejected == 0
+
+    def _collect(self, results, timings):
+        for name, (seconds, size) in timings.items():
+            self.stages[name].add(len(results), seconds, size)
+        for source, entity, errors, raw in results:
+            if entity is None:
+                self._reject(source, errors, raw)
+            else:
+                self._pending.append((source, entity))
+                if len(self._pending) >= self.batch_size:
+                    self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        if self.dry_run:
+            self.accepted += len(batch)
+            return
+        start = time.perf_counter()
+        result = fiware.batch_upsert(
+            [entity for _, entity in batch], action_type="append"
+        )
+        self.stages["upload"].add(len(batch), time.perf_counter() - start)
+        for source, entity in batch:
+            error = result.errors.get(entity["id"])
+            if error:
+                self._reject(source, [f"orion: {error}"], entity)
+            else:
+                self.accepted += 1
+
+    def _reject(self, source, errors, raw):
+        self.rejected += 1
+        logger.debug(f"Rejected {source}: {'; '.join(errors)}")
+        self._rejects.write(
+            json.dumps(
+                {"source": source, "errors": errors, "entity": raw}, ensure_ascii=False
+            )
+            + "\n"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Validate and load entities into Orion."
+    )
+    parser.add_argument(
+        "source",
+        nargs="?",
+        default=INGEST_SOURCE,
+        help="Directory of .json entity files or a .jsonl file.",
+    )
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=INGEST_CHUNK_SIZE)
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--reject-file", default=INGEST_REJECT_FILE)
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Parse and validate only, do not write to Orion.",
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        logger.error(f"Source '{args.source}' not found.")
+        return 1
+    if not args.dry_run:
+        metrics.start_reporter("ingest")
+        fiware.wait_for_orion()
+
+    logger.info(
+        f"JSON parser: {'orjson' if orjson else 'json'}, {args.workers} workers"
+    )
+    ingest = Ingest(
+        args.source,
+        args.workers,
+        args.chunk_size,
+        args.batch_size,
+        args.reject_file,
+        args.dry_run,
+    )
+    return 0 if ingest.run() else 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
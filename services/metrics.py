@@ -0,0 +1,239 @@
+import atexit
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    push_to_gateway,
+)
+
+logger = logging.getLogger("metrics")
+
+# Script services have no /metrics endpoint: they push to a Prometheus Pushgateway
+# when METRICS_PUSHGATEWAY is set (host:port), else log a summary when METRICS_LOG is set.
+METRICS_PUSHGATEWAY = os.environ.get("METRICS_PUSHGATEWAY")
+METRICS_LOG = os.environ.get("METRICS_LOG", "false").lower() in ("1", "true", "yes")
+METRICS_REPORT_INTERVAL = float(os.environ.get("METRICS_REPORT_INTERVAL", "30"))
+
+# Latencies range from sub-millisecond cache lookups to multi-second end-to-end paths.
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+NOTIFY_SECONDS = Histogram(
+    "smartcampus_notify_seconds",
+    "Time spent handling an Orion notification.",
+    ["service"],
+    buckets=LATENCY_BUCKETS,
+)
+ORION_REQUEST_SECONDS = Histogram(
+    "smartcampus_orion_request_seconds",
+    "Latency of Orion requests per operation.",
+    ["operation", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+EXTERNAL_API_SECONDS = Histogram(
+    "smartcampus_external_api_seconds",
+    "Latency of external API requests.",
+    ["api", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+TRACE_SECONDS = Histogram(
+    "smartcampus_trace_seconds",
+    "Time from the source update carrying a traceContext to each pipeline stage.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+ALERTS = Counter(
+    "smartcampus_alerts_total",
+    "Alerts handled by the weather alert service.",
+    ["result"],
+)
+QUEUE_BATCHES = Counter(
+    "smartcampus_queue_batches_total",
+    "Batches handled by the notification work queues, per result (ok or failed).",
+    ["queue", "result"],
+)
+QUEUE_DROPPED = Counter(
+    "smartcampus_queue_dropped_total",
+    "Queued entities dropped after their batch failed every retry.",
+    ["queue"],
+)
+CACHE_LOOKUPS = Counter(
+    "smartcampus_cache_lookups_total",
+    "Cache lookups per cache and result (hit or miss).",
+    ["cache", "result"],
+)
+
+# Entity IDs in Orion paths become placeholders so the operation label stays bounded.
+_ORION_PATH_IDS = (
+    (re.compile(r"^/v2/entities/[^/]+"), "/v2/entities/{id}"),
+    (re.compile(r"^/v2/subscriptions/[^/]+"), "/v2/subscriptions/{id}"),
+)
+
+
+def orion_operation(method, path):
+    """
+    Operation label of an Orion request, e.g. "POST /v2/entities/{id}/attrs".
+    """
+    path = path.split("?", 1)[0]
+    for pattern, replacement in _ORION_PATH_IDS:
+        path = pattern.sub(replacement, path)
+    return f"{method} {path}"
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """
+    Observes the duration of the block in histogram.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - started)
+
+
+def observe_orion(method, path, status, started):
+    """
+    Records an Orion request that started at time.perf_counter() value started.
+    status is the HTTP status code, or None when the request failed without one.
+    """
+    ORION_REQUEST_SECONDS.labels(
+        orion_operation(method, path), str(status) if status is not None else "error"
+    ).observe(time.perf_counter() - started)
+
+
+def count_lookup(cache_name, hit):
+    CACHE_LOOKUPS.labels(cache_name, "hit" if hit else "miss").inc()
+
+
+def new_trace_context():
+    """
+    Returns a trace context for an update at its source: a random trace ID and the
+    wall clock time the update was sent.
+    """
+    return {"traceId": uuid.uuid4().hex, "sentAt": time.time()}
+
+
+def trace_metadata(context):
+    """
+    NGSI attribute metadata carrying a trace context. Orion forwards attribute
+    metadata in notifications, so downstream services can measure the time since
+    the source update without changing any subscription.
+    """
+    return {"traceContext": {"type": "StructuredValue", "value": context}}
+
+
+def trace_context(attr):
+    """
+    Returns the trace context in the metadata of an NGSI attribute, or None.
+    """
+    if not isinstance(attr, dict):
+        return None
+    context = (attr.get("metadata") or {}).get("traceContext", {}).get("value")
+    if isinstance(context, dict) and isinstance(context.get("sentAt"), (int, float)):
+        return context
+    return None
+
+
+def observe_trace(context, stage):
+    """
+    Records the time from the source update of context to stage.
+    """
+    if context:
+        TRACE_SECONDS.labels(stage).observe(max(time.time() - context["sentAt"], 0.0))
+
+
+def _registry():
+    # With several gunicorn/uvicorn workers, PROMETHEUS_MULTIPROC_DIR makes every
+    # worker write its samples there, and a scrape aggregates all of them.
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render():
+    """
+    Returns:
+        tuple: (body, content_type) of the Prometheus text exposition.
+    """
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+async def handle_metrics(_payload):
+    """
+    GET /metrics handler for asgi.make_asgi_app.
+    """
+    body, content_type = render()
+    return 200, body, content_type
+
+
+def summary_lines(registry=REGISTRY):
+    """
+    One line per histogram series with its count and average, for services that log
+    their metrics instead of being scraped.
+    """
+    lines = []
+    for family in registry.collect():
+        if family.type != "histogram":
+            continue
+        series = {}
+        for sample in family.samples:
+            key = tuple(sorted(sample.labels.items()))
+            if sample.name.endswith("_count"):
+                series.setdefault(key, {})["count"] = sample.value
+            elif sample.name.endswith("_sum"):
+                series.setdefault(key, {})["sum"] = sample.value
+        for key, values in sorted(series.items()):
+            count = values.get("count", 0)
+            if not count:
+                continue
+            labels = ",".join(f"{k}={v}" for k, v in key if k != "le")
+            avg_ms = values.get("sum", 0.0) / count * 1000
+            lines.append(f"{family.name}{{{labels}}} count={count:.0f} avg={avg_ms:.1f}ms")
+    return lines
+
+
+def report(job):
+    """
+    Pushes the metrics to METRICS_PUSHGATEWAY, or logs their summary when METRICS_LOG
+    is set. Does nothing otherwise.
+    """
+    try:
+        if METRICS_PUSHGATEWAY:
+            push_to_gateway(METRICS_PUSHGATEWAY, job=job, registry=REGISTRY)
+        elif METRICS_LOG:
+            for line in summary_lines():
+                logger.info(f"[METRICS] {line}")
+    except Exception as e:
+        logger.warning(f"Could not report metrics: {e}")
+
+
+def start_reporter(job, interval=METRICS_REPORT_INTERVAL):
+    """
+    Reports the metrics of a script service every interval seconds and once more at
+    exit. See report().
+    """
+    if not METRICS_PUSHGATEWAY and not METRICS_LOG:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            report(job)
+
+    threading.Thread(target=run, name="metrics-reporter", daemon=True).start()
+    atexit.register(report, job)
@@ -1,78 +1,265 @@
-from pymongo import MongoClient
-from influxdb import InfluxDBClient
-from datetime import datetime
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from requests.exceptions import RequestException
+import json
+import os
 import time
+import influx_convert
+import influx_schema
+import influx_writer
 
-mongo_client = MongoClient("mongodb://mongo:27017")
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://mongo:27017")
+# Documents read per round trip to Mongo.
+MONGO_BATCH_SIZE = int(os.environ.get("MONGO_BATCH_SIZE", "1000"))
+
+# "incremental" only converts entities changed since the last run (change stream
+# when Mongo runs as a replica set, modDate watermark otherwise); "full" rescans
+# the whole collection on every cycle.
+SYNC_MODE = os.environ.get("SYNC_MODE", "incremental")
+SYNC_STATE_FILE = os.environ.get("SYNC_STATE_FILE", "sync_state.json")
+SYNC_INTERVAL = int(os.environ.get("SYNC_INTERVAL", "30"))
+# Consecutive change stream failures (Mongo, InfluxDB or network errors) retried
+# before falling back to polling modDate.
+CHANGE_STREAM_RETRIES = int(os.environ.get("CHANGE_STREAM_RETRIES", "5"))
+SKIP_UNCHANGED_ATTRS = os.environ.get("SKIP_UNCHANGED_ATTRS", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+mongo_client = MongoClient(MONGO_URL)
 mongo_db = mongo_client["orion"]
 collection = mongo_db["entities"]
 
-influx_client = InfluxDBClient(host="influxdb", port=8086)
-influx_client.switch_database("smartcampus")
+# convert_to_influx only needs the entity id/type and its attributes; modDate drives
+# the incremental sync. Orion's other bookkeeping fields are never transferred.
+PROJECTION = {"_id": 1, "attrs": 1, "modDate": 1}
 
-def convert_to_influx(doc):
-    _id = doc.get("_id", {})
-    entity_id = _id.get("id", "unknown")
-    measurement = _id.get("type", "UnknownType")
-    attrs = doc.get("attrs", {})
+influx_client = influx_writer.open_client()
+writer = influx_writer.InfluxBatchWriter(influx_client)
+# One row per entity in <type>_latest, for current-state panels.
+latest_writer = influx_writer.InfluxBatchWriter(
+    influx_client, retention_policy=influx_schema.LATEST_RP
+)
+# Structured and geo:json attributes are flattened into typed numeric fields, and
+# attributes whose mdate did not change since the last sync are left out.
+converter = influx_convert.InfluxConverter(skip_unchanged=SKIP_UNCHANGED_ATTRS)
 
-    timestamp = None
-    if "timestamp" in attrs and "value" in attrs["timestamp"]:
-        try:
-            ts_val = attrs["timestamp"]["value"]
-            timestamp = datetime.utcfromtimestamp(ts_val).isoformat()
-        except:
-            timestamp = datetime.utcnow().isoformat()
-    else:
-        timestamp = datetime.utcnow().isoformat()
-
-    fields = {}
-    for key, val in attrs.items():
-        value = val.get("value")
-        if isinstance(value, (int, float, str, bool)):
-            fields[key] = value
-        elif isinstance(value, dict):
-            # Converte dicts geo para string
-            fields[key] = str(value)
-
-    if not fields:
-        print(f"[IGNORADO] {entity_id} - Nenhum campo numérico ou textual válido.")
-        return None
-
-    point = {
-        "measurement": measurement,
-        "tags": {
-            "entity_id": entity_id
-        },
-        "time": timestamp,
-        "fields": fields
-    }
+def convert_to_influx(doc):
+    point = converter.convert_mongo(doc)
+    if point is None:
+        entity_id = doc.get("_id", {}).get("id", "unknown")
+        print(f"[IGNORADO] {entity_id} - Nenhum campo alterado ou válido.")
     return point
 
-print("Inspeção do primeiro documento:")
-first_doc = collection.find_one()
-print(first_doc)
+def write_docs(docs):
+    """
+    Converts docs and hands the points to the batch writer, which sends them
+    INFLUX_BATCH_SIZE at a time. Call flush_writers() to write the remainder.
+    """
+    count = 0
+    for doc in docs:
+        point = convert_to_influx(doc)
+        if point:
+            if point["fields"]:
+                writer.add(point)
+            latest_writer.add(converter.latest_point(point))
+            count += 1
+    return count
+
+def flush_writers():
+    writer.flush()
+    latest_writer.flush()
+
+def load_state():
+    """
+    Reads the persisted sync position: the modDate watermark, the ids already
+    synced at that exact modDate, and the change stream resume token.
+    """
+    try:
+        with open(SYNC_STATE_FILE, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        print(f"[WARN] Ignoring unreadable sync state {SYNC_STATE_FILE}: {e}")
+        return {}
+
+def save_state(state):
+    # Write then rename, so a crash never leaves a truncated state file behind.
+    tmp_path = f"{SYNC_STATE_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(state, file)
+    os.replace(tmp_path, SYNC_STATE_FILE)
+
+def sync_full():
+    count = write_docs(collection.find({}, PROJECTION, batch_size=MONGO_BATCH_SIZE))
+    flush_writers()
+    print(
+        f"Full sync: {count} documents written. "
+        f"{writer.summary()} {converter.stats()}"
+    )
+
+def advance_watermark(state, doc):
+    """
+    Records doc as synced: moves the modDate watermark forward and tracks the ids
+    already synced at exactly that modDate.
+    """
+    mod_date = doc.get("modDate")
+    if mod_date is None:
+        return
+    watermark = state.get("watermark")
+    if watermark is None or mod_date > watermark:
+        state["watermark"] = mod_date
+        state["boundary_ids"] = []
+    if mod_date == state["watermark"]:
+        entity_id = doc.get("_id", {}).get("id")
+        if entity_id not in state["boundary_ids"]:
+            state["boundary_ids"].append(entity_id)
 
-docs = collection.find()
-count = 0
+def sync_since_watermark(state):
+    """
+    Converts the entities whose modDate is at or after the watermark. Entities
+    already synced at exactly the watermark are skipped, so nothing modified
+    within the same second is lost or written twice.
+    """
+    watermark = state.get("watermark")
+    boundary_ids = set(state.get("boundary_ids", []))
 
-for doc in docs:
-    point = convert_to_influx(doc)
-    if point:
-        influx_client.write_points([point])
-        count += 1
+    query = {"modDate": {"$gte": watermark}} if watermark is not None else {}
+    cursor = collection.find(query, PROJECTION, batch_size=MONGO_BATCH_SIZE)
+    synced = []
+    count = 0
+    for doc in cursor.sort("modDate", ASCENDING):
+        entity_id = doc.get("_id", {}).get("id")
+        if doc.get("modDate") == watermark and entity_id in boundary_ids:
+            continue
+        count += write_docs([doc])
+        synced.append({"_id": doc.get("_id"), "modDate": doc.get("modDate")})
 
-print(f"\n{count} documentos migrados do Mongo para o Influx.")
+    # Only move the watermark once every point has reached InfluxDB.
+    flush_writers()
+    for doc in synced:
+        advance_watermark(state, doc)
+    save_state(state)
+    print(
+        f"Incremental sync: {count} changed documents written "
+        f"(modDate >= {watermark}). {writer.summary()}"
+    )
+
+def sync_change_stream(state):
+    """
+    Follows the MongoDB change stream and buffers each changed entity as it
+    arrives. Whenever the writer flushes (full batch or INFLUX_FLUSH_INTERVAL),
+    the resume token is persisted so a restart continues where it left off.
+    The modDate watermark is kept up to date too, so falling back to polling
+    does not rewrite history. Raises OperationFailure when change streams are
+    unavailable (standalone Mongo) or the resume token has expired.
+    """
+    options = {"full_document": "updateLookup", "max_await_time_ms": 1000}
+    if state.get("resume_token"):
+        options["resume_after"] = state["resume_token"]
+
+    pipeline = [
+        {"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}},
+        {"$project": {f"fullDocument.{field}": 1 for field in PROJECTION}},
+    ]
+    with collection.watch(pipeline, **options) as stream:
+        if not state.get("resume_token"):
+            # First run: catch up on what changed before the stream was opened.
+            sync_since_watermark(state)
+        print("Following MongoDB change stream...")
+        pending = []
+        token = None
+        while stream.alive:
+            change = stream.try_next()
+            if change is not None:
+                doc = change.get("fullDocument")
+                if doc:
+                    write_docs([doc])
+                    pending.append(doc)
+                token = change["_id"]
+            writer.flush_if_due()
+            latest_writer.flush_if_due()
+            if token is not None and not len(writer) and not len(latest_writer):
+                # Everything received so far is in InfluxDB: checkpoint.
+                for doc in pending:
+                    advance_watermark(state, doc)
+                state["resume_token"] = token
+                save_state(state)
+                pending, token = [], None
+                print(f"Change stream: {writer.summary()}")
+
+def follow_change_stream(state):
+    """
+    Runs sync_change_stream, resuming from the last checkpoint after transient
+    Mongo, InfluxDB or network errors. Returns when change streams are unavailable,
+    when the stream ends, or after CHANGE_STREAM_RETRIES consecutive failures, so
+    the caller falls back to polling modDate.
+    """
+    failures = 0
+    while True:
+        token = state.get("resume_token")
+        try:
+            sync_change_stream(state)
+            return
+        except OperationFailure as e:
+            print(f"Change stream unavailable ({e}), polling modDate instead.")
+            state.pop("resume_token", None)
+            return
+        except (
+            PyMongoError,
+            RequestException,
+            InfluxDBClientError,
+            InfluxDBServerError,
+        ) as e:
+            # Nothing after the saved resume token is checkpointed, so the buffered
+            # points are dropped and the stream re-reads those changes.
+            writer.discard()
+            latest_writer.discard()
+            converter.reset()
+            failures = 1 if state.get("resume_token") != token else failures + 1
+            if failures > CHANGE_STREAM_RETRIES:
+                print(f"[ERROR] Change stream failed ({e}), polling modDate instead.")
+                return
+            print(f"[ERROR] Change stream failed ({e}), resuming in {SYNC_INTERVAL}s.")
+            time.sleep(SYNC_INTERVAL)
+
+def ensure_indexes():
+    try:
+        collection.create_index([("modDate", ASCENDING)], name="modDate_1")
+    except PyMongoError as e:
+        print(f"[WARN] Could not create modDate index: {e}")
 
 def main_loop():
-    print("Starting continuous sync between MongoDB and InfluxDB...")
+    print(f"Starting continuous sync between MongoDB and InfluxDB ({SYNC_MODE})...")
+    if influx_schema.INFLUX_SETUP_SCHEMA:
+        influx_schema.setup_schema(influx_client)
+    converter.pin_field_types(influx_schema.field_types(influx_client))
+    if SYNC_MODE == "full":
+        while True:
+            sync_full()
+            print(f"Waiting {SYNC_INTERVAL} seconds...")
+            time.sleep(SYNC_INTERVAL)
+
+    ensure_indexes()
+    state = load_state()
+    follow_change_stream(state)
+
     while True:
-        for doc in collection.find():
-            point = convert_to_influx(doc)
-            if point:
-                influx_client.write_points([point])
-        print("Waiting 30 seconds...")
-        time.sleep(30)
+        try:
+            sync_since_watermark(state)
+        except Exception as e:
+            # The watermark did not move, so the next cycle re-reads these documents.
+            print(f"[ERROR] Sync failed: {e}")
+            writer.discard()
+            latest_writer.discard()
+            converter.reset()
+        print(f"Waiting {SYNC_INTERVAL} seconds...")
+        time.sleep(SYNC_INTERVAL)
 
 if __name__ == "__main__":
-    main_loop()
\ No newline at end of file
+    print("Inspeção do primeiro documento:")
+    print(collection.find_one())
+    main_loop()
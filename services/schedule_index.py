@@ -0,0 +1,178 @@
+import bisect
+import logging
+import threading
+from collections import namedtuple
+from datetime import date, timedelta
+
+logger = logging.getLogger("schedule_index")
+
+WEEKDAYS = [
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+]
+WEEKDAY_INDEX = {name: i for i, name in enumerate(WEEKDAYS)}
+
+# One weekly class slot, compiled from a classSchedule entry.
+Slot = namedtuple("Slot", "start end course_id first_day last_day")
+
+# A concrete class occurrence with timezone-aware start and end datetimes.
+Session = namedtuple("Session", "course_id start end")
+
+
+def parse_minutes(time_str):
+    """
+    Converts HH:MM into minutes since midnight. Raises ValueError on bad input.
+    """
+    hours, minutes = time_str.split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"Invalid time {time_str}")
+    return hours * 60 + minutes
+
+
+def compile_schedule(course_id, schedules):
+    """
+    Compiles the classSchedule value of a course into (weekday, Slot) pairs.
+    Entries with missing or malformed fields are logged and skipped. startPeriod and
+    endPeriod (YYYY-MM-DD) bound the dates the slot applies to; missing bounds are open.
+    """
+    slots = []
+    if not isinstance(schedules, list):
+        logger.error(f"'classSchedule.value' is not a list in course {course_id}")
+        return slots
+
+    for schedule in schedules:
+        weekday = WEEKDAY_INDEX.get(schedule.get("day"))
+        start_time = schedule.get("startTime")
+        end_time = schedule.get("endTime")
+        if weekday is None or not start_time or not end_time:
+            logger.warning(f"Incomplete data in course {course_id}")
+            continue
+        try:
+            start = parse_minutes(start_time)
+            end = parse_minutes(end_time)
+            first_day = schedule.get("startPeriod")
+            last_day = schedule.get("endPeriod")
+            first_day = date.fromisoformat(first_day) if first_day else date.min
+            last_day = date.fromisoformat(last_day) if last_day else date.max
+        except ValueError as e:
+            logger.error(f"Error converting times in course {course_id}: {e}")
+            continue
+        slots.append((weekday, Slot(start, end, course_id, first_day, last_day)))
+    return slots
+
+
+class ScheduleIndex:
+    """
+    Weekly interval index of class slots keyed by weekday and minute of day.
+
+    Slots of every course are kept per weekday, sorted by start minute. Finding the
+    classes that start or are running in a time window is a bisect per day in the
+    window instead of re-parsing each course schedule. Courses can be updated or
+    removed individually when their classSchedule changes. The index is thread-safe.
+    """
+
+    def __init__(self):
+        self._days = [[] for _ in WEEKDAYS]
+        self._starts = [[] for _ in WEEKDAYS]
+        self._courses = {}
+        self._max_duration = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._courses)
+
+    def update(self, course_id, schedules):
+        """
+        Replaces the slots of a course with its compiled classSchedule.
+        """
+        compiled = compile_schedule(course_id, schedules)
+        with self._lock:
+            self._remove(course_id)
+            for weekday, slot in compiled:
+                position = bisect.bisect_right(self._starts[weekday], slot.start)
+                self._starts[weekday].insert(position, slot.start)
+                self._days[weekday].insert(position, slot)
+                self._max_duration = max(self._max_duration, slot.end - slot.start)
+            self._courses[course_id] = compiled
+
+    def remove(self, course_id):
+        with self._lock:
+            self._remove(course_id)
+
+    def _remove(self, course_id):
+        for weekday, slot in self._courses.pop(course_id, []):
+            position = self._days[weekday].index(slot)
+            del self._days[weekday][position]
+            del self._starts[weekday][position]
+
+    def upcoming(self, now, hours_ahead, course_ids=None):
+        """
+        Finds the classes that are running at now or start within hours_ahead.
+        Args:
+            now (datetime): Timezone-aware reference time.
+            hours_ahead (float): Size of the look-ahead window in hours.
+            course_ids (iterable, optional): Restrict the result to these courses.
+        Returns:
+            dict: course_id -> earliest matching Session.
+        """
+        found = {}
+        for session in self.sessions(now, hours_ahead, course_ids):
+            current = found.get(session.course_id)
+            if current is None or session.start < current.start:
+                found[session.course_id] = session
+        return found
+
+    def sessions(self, now, hours_ahead, course_ids=None):
+        """
+        Lists every class session running at now or starting within hours_ahead.
+        Args:
+            now (datetime): Timezone-aware reference time.
+            hours_ahead (float): Size of the look-ahead window in hours.
+            course_ids (iterable, optional): Restrict the result to these courses.
+        Returns:
+            list: Sessions, by day then start minute.
+        """
+        wanted = set(course_ids) if course_ids is not None else None
+        window_end = now + timedelta(hours=hours_ahead)
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        found = []
+
+        with self._lock:
+            day = midnight
+            while day <= window_end:
+                weekday = day.weekday()
+                lo = (now - day).total_seconds() / 60
+                hi = (window_end - day).total_seconds() / 60
+                starts = self._starts[weekday]
+                first = bisect.bisect_left(starts, lo - self._max_duration)
+                last = bisect.bisect_right(starts, hi)
+                for slot in self._days[weekday][first:last]:
+                    if slot.end < lo:
+                        continue
+                    if wanted is not None and slot.course_id not in wanted:
+                        continue
+                    if not slot.first_day <= day.date() <= slot.last_day:
+                        continue
+                    start = day + timedelta(minutes=slot.start)
+                    end = day + timedelta(minutes=slot.end)
+                    found.append(Session(slot.course_id, start, end))
+                day += timedelta(days=1)
+        return found
+
+
+def build_schedule_index(courses):
+    """
+    Builds a ScheduleIndex from CourseInstance entities in normalized format.
+    """
+    index = ScheduleIndex()
+    for course in courses:
+        course_id = course.get("id")
+        if course_id:
+            index.update(course_id, course.get("classSchedule", {}).get("value", []))
+    return index
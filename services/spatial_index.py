@@ -0,0 +1,128 @@
+import math
+import threading
+
+EARTH_RADIUS_METERS = 6371000
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_METERS / 180
+
+
+def haversine_meters(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in meters between two WGS84 points.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = (
+        math.sin(dphi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+def entity_coordinates(entity):
+    """
+    Returns (lat, lon) of an entity with a geo:json Point location, or None.
+    Accepts both normalized and keyValues representations.
+    """
+    location = entity.get("location") or {}
+    if "value" in location:
+        location = location["value"] or {}
+    coords = location.get("coordinates")
+    if not coords or len(coords) < 2:
+        return None
+    return coords[1], coords[0]
+
+
+class GeoGridIndex:
+    """
+    In-memory grid bucket index of point entities for radius lookups.
+
+    Points are hashed into square cells of cell_size_deg degrees. A radius query only
+    visits the cells overlapping the bounding box of the circle and then filters the
+    candidates by exact haversine distance. The index is thread-safe.
+
+    Args:
+        cell_size_deg (float): Cell size in degrees (0.01 is roughly 1.1 km).
+    """
+
+    def __init__(self, cell_size_deg=0.01):
+        self.cell_size_deg = cell_size_deg
+        self.ready = False
+        self._cells = {}
+        self._points = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell(self, lat, lon):
+        return (
+            math.floor(lat / self.cell_size_deg),
+            math.floor(lon / self.cell_size_deg),
+        )
+
+    def upsert(self, entity_id, lat, lon, entity):
+        """
+        Insert or move an entity in the index, storing entity as its payload.
+        """
+        cell = self._cell(lat, lon)
+        with self._lock:
+            self._remove(entity_id)
+            self._points[entity_id] = (lat, lon, cell, entity)
+            self._cells.setdefault(cell, set()).add(entity_id)
+
+    def remove(self, entity_id):
+        with self._lock:
+            self._remove(entity_id)
+
+    def _remove(self, entity_id):
+        previous = self._points.pop(entity_id, None)
+        if previous is None:
+            return
+        bucket = self._cells.get(previous[2])
+        if bucket is not None:
+            bucket.discard(entity_id)
+            if not bucket:
+                del self._cells[previous[2]]
+
+    def get(self, entity_id):
+        point = self._points.get(entity_id)
+        return point[3] if point else None
+
+    def replace_all(self, points):
+        """
+        Atomically replace the whole index content.
+        Args:
+            points (iterable): (entity_id, lat, lon, entity) tuples.
+        """
+        cells, indexed = {}, {}
+        for entity_id, lat, lon, entity in points:
+            cell = self._cell(lat, lon)
+            indexed[entity_id] = (lat, lon, cell, entity)
+            cells.setdefault(cell, set()).add(entity_id)
+        with self._lock:
+            self._cells, self._points = cells, indexed
+            self.ready = True
+
+    def query_radius(self, lat, lon, radius_meters):
+        """
+        Returns the payloads of the entities within radius_meters of (lat, lon),
+        nearest first.
+        """
+        dlat = radius_meters / METERS_PER_DEGREE
+        cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+        dlon = min(dlat / cos_lat, 180)
+        min_cell = self._cell(lat - dlat, lon - dlon)
+        max_cell = self._cell(lat + dlat, lon + dlon)
+
+        matches = []
+        with self._lock:
+            for i in range(min_cell[0], max_cell[0] + 1):
+                for j in range(min_cell[1], max_cell[1] + 1):
+                    for entity_id in self._cells.get((i, j), ()):
+                        p_lat, p_lon, _, entity = self._points[entity_id]
+                        distance = haversine_meters(lat, lon, p_lat, p_lon)
+                        if distance <= radius_meters:
+                            matches.append((distance, entity_id, entity))
+        matches.sort(key=lambda match: (match[0], match[1]))
+        return [entity for _, _, entity in matches]
@@ -0,0 +1,103 @@
+import numpy as np
+from alert_planner import (
+    HEAVY_RAIN_MM,
+    HOUR,
+    alert_content_hash,
+    build_alert,
+    forecast_cell,
+    rain_windows,
+)
+
+T0 = 1742198400  # 2025-03-17T08:00:00Z
+HOUR_STARTS = T0 + HOUR * np.arange(4)
+
+
+def windows(starts, ends, precipitation, cells=None, threshold=0.2):
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+    cells = np.zeros(len(starts), dtype=int) if cells is None else np.asarray(cells)
+    return rain_windows(
+        starts,
+        ends,
+        cells,
+        np.asarray(precipitation, dtype=float),
+        HOUR_STARTS,
+        threshold,
+    )
+
+
+def test_rain_window_is_clipped_to_the_session():
+    rainy, start, end, peak, total = windows(
+        [T0 + HOUR // 2], [T0 + 3 * HOUR], [[1.0, 0.0, 3.0, 5.0]]
+    )
+
+    assert rainy.tolist() == [True]
+    assert start[0] == T0 + HOUR // 2
+    assert end[0] == T0 + 3 * HOUR
+    assert peak[0] == 3.0
+    assert total[0] == 4.0
+
+
+def test_hours_below_threshold_or_unknown_are_dry():
+    rainy, _, _, peak, total = windows(
+        [T0, T0], [T0 + 4 * HOUR, T0 + 2 * HOUR], [[0.1, np.nan, 0.0, 2.0]]
+    )
+
+    assert rainy.tolist() == [True, False]
+    assert peak.tolist() == [2.0, 0.0]
+    assert total.tolist() == [2.0, 0.0]
+
+
+def test_rain_window_spans_first_to_last_wet_hour():
+    rainy, start, end, _, total = windows(
+        [T0], [T0 + 4 * HOUR], [[0.0, 1.0, 0.0, 1.0]]
+    )
+
+    assert rainy[0]
+    assert start[0] == T0 + HOUR
+    assert end[0] == T0 + 4 * HOUR
+    assert total[0] == 2.0
+
+
+def test_each_session_reads_its_own_cell():
+    precipitation = [[0.0, 0.0, 0.0, 0.0], [0.0, 5.0, 0.0, 0.0]]
+
+    rainy, start, _, _, _ = windows(
+        [T0, T0], [T0 + 2 * HOUR, T0 + 2 * HOUR], precipitation, cells=[0, 1]
+    )
+
+    assert rainy.tolist() == [False, True]
+    assert start[1] == T0 + HOUR
+
+
+def test_session_outside_the_forecast_is_dry():
+    rainy, _, _, _, _ = windows(
+        [T0 + 5 * HOUR], [T0 + 6 * HOUR], [[9.0, 9.0, 9.0, 9.0]]
+    )
+
+    assert rainy.tolist() == [False]
+
+
+def test_nearby_points_share_a_forecast_cell():
+    cell, lat, lon = forecast_cell(-5.8421, -35.1975, cell_deg=0.01)
+
+    assert forecast_cell(-5.8479, -35.1902, cell_deg=0.01)[0] == cell
+    assert forecast_cell(-5.8521, -35.1975, cell_deg=0.01)[0] != cell
+    assert (lat, lon) == (-5.845, -35.195)
+
+
+def test_alert_severity_and_content_hash():
+    course = {
+        "id": "CourseInstance:UFRN:PPGA0050:2025.1",
+        "location": {"type": "geo:json", "value": {"type": "Point"}},
+    }
+    medium = build_alert(course, T0, T0 + HOUR, 1.0, 1.0, "2025-03-17T07:00:00Z")
+    heavy = build_alert(course, T0, T0 + HOUR, HEAVY_RAIN_MM, 9.0, "now")
+    reissued = build_alert(course, T0, T0 + HOUR, 1.0, 1.0, "2025-03-17T08:00:00Z")
+
+    assert medium["id"] == "Alert:Forecast:CourseInstance:UFRN:PPGA0050:2025.1"
+    assert medium["validFrom"]["value"] == "2025-03-17T08:00:00Z"
+    assert medium["severity"]["value"] == "medium"
+    assert heavy["severity"]["value"] == "high"
+    assert alert_content_hash(medium) == alert_content_hash(reissued)
+    assert alert_content_hash(medium) != alert_content_hash(heavy)
@@ -0,0 +1,156 @@
+import json
+import pytest
+import fiware
+from bench.fake_orion import FakeOrion
+
+
+@pytest.fixture
+def orion():
+    with FakeOrion() as orion:
+        yield orion
+
+
+@pytest.fixture
+def client(orion):
+    client = fiware.FiwareClient(orion.url, retries=0)
+    yield client
+    client.close()
+
+
+def entity(entity_id, **attrs):
+    return {
+        "id": entity_id,
+        "type": "Thing",
+        **{name: {"type": "Number", "value": value} for name, value in attrs.items()},
+    }
+
+
+def chunk(*entity_ids):
+    return [(entity_id, json.dumps(entity(entity_id))) for entity_id in entity_ids]
+
+
+def test_partial_update_description_names_failing_entities():
+    result = fiware.BatchResult("update")
+    description = "do not exist: E2 - [ ], E3 - [ A, B ]"
+    body = json.dumps({"error": "PartialUpdate", "description": description})
+
+    resend = fiware.apply_batch_response(404, body, chunk("E1", "E2", "E3"), result)
+
+    assert resend == []
+    assert result.succeeded == ["E1"]
+    assert set(result.errors) == {"E2", "E3"}
+
+
+def test_unexplained_rejection_is_bisected():
+    result = fiware.BatchResult("append")
+
+    resend = fiware.apply_batch_response(
+        400, '{"error": "BadRequest"}', chunk("E1", "E2", "E3"), result
+    )
+
+    assert [[entity_id for entity_id, _ in part] for part in resend] == [
+        ["E1"],
+        ["E2", "E3"],
+    ]
+    assert not result.succeeded and not result.errors
+
+
+def test_single_entity_rejection_is_an_error():
+    result = fiware.BatchResult("append")
+
+    resend = fiware.apply_batch_response(400, "bad", chunk("E1"), result)
+
+    assert resend == []
+    assert result.errors == {"E1": "400 bad"}
+
+
+def test_chunks_are_bounded_by_count_and_size():
+    result = fiware.BatchResult("append")
+    entities = [entity(f"E{i}", value=i) for i in range(10)]
+    size = len(json.dumps(entities[0], separators=(",", ":"))) + 1
+
+    chunks = list(fiware.chunk_entities(entities, 4, size * 3, result))
+
+    assert [len(c) for c in chunks] == [3, 3, 3, 1]
+    assert not result.errors
+
+
+def test_entities_without_id_or_too_large_are_errors():
+    result = fiware.BatchResult("append")
+    entities = [entity("E1"), {"type": "Thing"}, entity("E2", blob="x" * 1000)]
+
+    chunks = list(fiware.chunk_entities(entities, 10, 500, result))
+
+    assert [[entity_id for entity_id, _ in c] for c in chunks] == [["E1"]]
+    assert set(result.errors) == {"<missing id #1>", "E2"}
+
+
+def test_batch_upsert_reports_every_entity(client, orion):
+    orion.batch("append", [entity("E1", value=1)])
+    entities = [entity("E1", value=2), entity("E2", value=3), {"type": "Thing"}]
+
+    result = client.batch_upsert(entities, action_type="update", max_entities=2)
+
+    assert result.succeeded == ["E1"]
+    assert set(result.errors) == {"E2", "<missing id #2>"}
+    assert orion.entities["E1"]["value"]["value"] == 2
+    assert "E2" not in orion.entities
+
+
+def test_purge_deletes_every_entity(client, orion):
+    orion.batch("append", [entity(f"E{i}") for i in range(25)])
+
+    result = client.purge_entities("Thing", batch_size=10)
+
+    assert result.ok
+    assert result.deleted == 25
+    assert not orion.entities
+
+
+def test_purge_fails_when_listing_fails():
+    client = fiware.FiwareClient("http://127.0.0.1:9", retries=0, timeout=1)
+
+    result = client.purge_entities("Thing")
+
+    assert not result.ok
+    assert result.error
+    assert result.deleted == 0
+
+
+def subscription(
+    description="Weather changes", url="http://alert:5000/notify", **extra
+):
+    return {
+        "description": description,
+        "subject": {"entities": [{"idPattern": ".*", "type": "WeatherStation"}]},
+        "notification": {"http": {"url": url}, "attrs": ["weathercode"]},
+        **extra,
+    }
+
+
+def test_reconcile_creates_a_missing_subscription(orion, client):
+    subscription_id = client.reconcile_subscription(subscription())
+
+    assert list(orion.subscriptions) == [subscription_id]
+    assert fiware.is_subset(subscription(), orion.subscriptions[subscription_id])
+
+
+def test_reconcile_keeps_an_up_to_date_subscription(orion, client):
+    existing = orion.add_subscription({**subscription(), "status": "active"})
+    orion.add_subscription(subscription(url="http://other:5000/notify"))
+
+    assert client.reconcile_subscription(subscription()) == existing
+    assert len(orion.subscriptions) == 2
+
+
+def test_reconcile_deletes_duplicates_and_patches_the_survivor(orion, client):
+    renamed = orion.add_subscription(subscription("Old name"))
+    survivor = orion.add_subscription(subscription(throttling=5))
+    duplicate = orion.add_subscription(subscription(throttling=5))
+
+    desired = subscription(throttling=10)
+    assert client.reconcile_subscription(desired) == survivor
+
+    assert set(orion.subscriptions) == {survivor}
+    assert orion.subscriptions[survivor]["throttling"] == 10
+    assert renamed not in orion.subscriptions and duplicate not in orion.subscriptions
@@ -0,0 +1,262 @@
+from influxdb.resultset import ResultSet
+
+import influx_writer
+from influx_convert import (
+    LATEST_SUFFIX,
+    OTHER_TAG_VALUE,
+    FieldPlan,
+    InfluxConverter,
+    program_code,
+)
+
+TIME = "2025-03-17T09:00:00"
+
+
+def attr(value, type="Text", mdate=None):
+    result = {"type": type, "value": value}
+    if mdate is not None:
+        result["mdate"] = mdate
+    return result
+
+
+def doc(entity_id, entity_type, **attrs):
+    return {"_id": {"id": entity_id, "type": entity_type}, "attrs": attrs}
+
+
+def test_program_code():
+    assert program_code("PPGA0050") == "PPGA"
+    assert program_code("dim0120") == "DIM"
+    assert program_code("0050") is None
+
+
+def test_fields_are_extracted_by_ngsi_type():
+    converter = InfluxConverter(tag_schema={})
+    point = converter.convert(
+        "WeatherStation:1",
+        "WeatherStation",
+        {
+            "weathercode": attr(61, "Integer"),
+            "enabled": attr(True, "Boolean"),
+            "name": attr("Natal"),
+            "location": attr(
+                {"type": "Point", "coordinates": [-35.2, -5.8]}, "geo:json"
+            ),
+            "position": attr("-5.8, -35.2", "geo:point"),
+            "context": attr({"rain": {"mm": 2}, "hot": False}, "StructuredValue"),
+            "empty": attr(None),
+        },
+        TIME,
+    )
+
+    assert point["measurement"] == "WeatherStation"
+    assert point["tags"] == {"entity_id": "WeatherStation:1"}
+    assert point["time"] == TIME
+    assert point["fields"] == {
+        "weathercode": 61,
+        "enabled": True,
+        "name": "Natal",
+        "location_lat": -5.8,
+        "location_lon": -35.2,
+        "position_lat": -5.8,
+        "position_lon": -35.2,
+        "context_rain_mm": 2,
+        "context_hot": False,
+    }
+    assert type(point["fields"]["weathercode"]) is int
+
+
+def typed(fields):
+    return {name: (value, type(value)) for name, value in fields.items()}
+
+
+def test_field_type_is_pinned_on_first_write():
+    plan = FieldPlan("WeatherStation")
+
+    assert typed(plan.fields({"weathercode": attr(61, "Number")})) == {
+        "weathercode": (61, int)
+    }
+    assert plan.fields({"weathercode": attr("rain", "Number")}) == {}
+    assert plan.fields({"label": attr("rain")}) == {"label": "rain"}
+    assert plan.fields({"label": attr(3)}) == {}
+    assert plan.conflicts == 1
+
+
+def test_numbers_are_converted_to_the_pinned_type_when_lossless():
+    plan = FieldPlan("CourseInstance")
+    plan.fields(
+        {"enrollments": attr(30, "Number"), "temperature": attr(25.5, "Number")}
+    )
+
+    fields = plan.fields(
+        {"enrollments": attr(31.0, "Number"), "temperature": attr(26, "Number")}
+    )
+
+    assert typed(fields) == {"enrollments": (31, int), "temperature": (26.0, float)}
+    assert plan.fields({"enrollments": attr(31.5, "Number")}) == {}
+    assert plan.conflicts == 1
+
+
+def test_integer_ngsi_type_pins_integer_fields():
+    plan = FieldPlan("WeatherStation")
+
+    fields = plan.fields({"weathercode": attr(61.0, "Integer")})
+
+    assert typed(fields) == {"weathercode": (61, int)}
+
+
+def test_field_types_stored_in_influx_win_over_first_write():
+    converter = InfluxConverter(tag_schema={})
+    converter.convert("S:1", "Sensor", {"count": attr(1.5, "Number")}, TIME)
+    converter.pin_field_types({"Sensor": {"count": int, "level": float}})
+
+    attrs = {"count": attr(2.0, "Number"), "level": attr(3, "Number")}
+    point = converter.convert("S:1", "Sensor", attrs, TIME)
+
+    assert typed(point["fields"]) == {"count": (2, int), "level": (3.0, float)}
+
+
+def test_load_field_types_reads_show_field_keys():
+    def series(name, *keys):
+        return {"name": name, "columns": ["fieldKey", "fieldType"], "values": keys}
+
+    responses = {
+        "raw": [series("CourseInstance", ["enrollments", "integer"])],
+        "autogen": [
+            series(
+                "CourseInstance",
+                ["enrollments", "float"],
+                ["temperature", "integer"],
+                ["temperature", "float"],
+                ["courseCode", "string"],
+            ),
+            series("WeatherStation", ["weathercode", "integer"]),
+        ],
+    }
+
+    class Client:
+        def query(self, query):
+            rp = query.split('"')[3]
+            return ResultSet({"statement_id": 0, "series": responses[rp]})
+
+    field_types = influx_writer.load_field_types(Client(), "db", ("raw", "autogen"))
+
+    assert field_types == {
+        "CourseInstance": {"enrollments": int, "temperature": float, "courseCode": str},
+        "WeatherStation": {"weathercode": int},
+    }
+
+
+def test_tags_from_schema_and_derived_tags_stay_fields():
+    converter = InfluxConverter()
+    point = converter.convert(
+        "CourseInstance:1",
+        "CourseInstance",
+        {
+            "courseCode": attr("PPGA0050"),
+            "status": attr("active"),
+            "enrolled": attr(30, "Number"),
+        },
+        TIME,
+    )
+
+    assert point["tags"] == {
+        "entity_id": "CourseInstance:1",
+        "program": "PPGA",
+        "status": "active",
+    }
+    assert point["fields"] == {"courseCode": "PPGA0050", "enrolled": 30}
+
+
+def test_tag_values_are_capped(monkeypatch):
+    monkeypatch.setattr("influx_convert.MAX_TAG_VALUES", 2)
+    plan = FieldPlan("Alert", {"severity": "severity"})
+
+    values = [
+        plan.tags({"severity": attr(severity)})["severity"]
+        for severity in ("low", "high", "critical", "low")
+    ]
+
+    assert values == ["low", "high", OTHER_TAG_VALUE, "low"]
+    assert plan.capped_tags == 1
+
+
+def test_unchanged_attributes_are_skipped_until_reset():
+    converter = InfluxConverter(tag_schema={})
+    first = doc(
+        "WeatherStation:1",
+        "WeatherStation",
+        weathercode=attr(61, "Integer", mdate=1),
+        temperature=attr(25, "Number", mdate=1),
+    )
+    second = doc(
+        "WeatherStation:1",
+        "WeatherStation",
+        weathercode=attr(61, "Integer", mdate=1),
+        temperature=attr(26, "Number", mdate=2),
+    )
+
+    every_field = {"weathercode", "temperature"}
+    assert set(converter.convert_mongo(first)["fields"]) == every_field
+    assert converter.convert_mongo(first) is None
+    assert converter.convert_mongo(second)["fields"] == {"temperature": 26}
+    assert converter.stats()["skipped_unchanged_attrs"] == 3
+
+    converter.reset()
+    assert set(converter.convert_mongo(second)["fields"]) == every_field
+
+
+def test_new_tag_value_writes_every_field():
+    converter = InfluxConverter()
+    attrs = {"status": attr("active", mdate=1), "enrolled": attr(30, "Number", mdate=1)}
+    converter.convert(
+        "CourseInstance:1", "CourseInstance", attrs, TIME, {"status": 1, "enrolled": 1}
+    )
+
+    attrs["status"] = attr("closed", mdate=2)
+    point = converter.convert(
+        "CourseInstance:1",
+        "CourseInstance",
+        attrs,
+        TIME,
+        {"status": 2, "enrolled": 1},
+    )
+
+    assert point["tags"]["status"] == "closed"
+    assert point["fields"] == {"enrolled": 30}
+
+
+def test_notification_keeps_known_tags():
+    converter = InfluxConverter()
+    converter.convert("Alert:1", "Alert", {"severity": attr("high")}, TIME)
+
+    point = converter.convert("Alert:1", "Alert", {"description": attr("Rain")}, TIME)
+
+    assert point["tags"] == {"entity_id": "Alert:1", "severity": "high"}
+    assert point["fields"] == {"description": "Rain"}
+
+
+def test_latest_point():
+    converter = InfluxConverter()
+    point = converter.convert(
+        "Alert:1",
+        "Alert",
+        {"severity": attr("high"), "description": attr("Rain")},
+        TIME,
+    )
+
+    assert converter.latest_point(point) == {
+        "measurement": "Alert" + LATEST_SUFFIX,
+        "tags": {"entity_id": "Alert:1"},
+        "time": 0,
+        "fields": {"severity": "high", "description": "Rain"},
+    }
+
+
+def test_mongo_timestamp_becomes_point_time():
+    converter = InfluxConverter(tag_schema={})
+    point = converter.convert_mongo(
+        doc("Sensor:1", "Sensor", timestamp=attr(0, "Number"), value=attr(1, "Number"))
+    )
+
+    assert point["time"] == "1970-01-01T00:00:00"
+    assert point["fields"] == {"timestamp": 0, "value": 1}
@@ -0,0 +1,137 @@
+import re
+from influxdb.resultset import ResultSet
+
+import influx_schema
+from influx_convert import InfluxConverter
+
+# Field types written by the converter before the tiered policies existed.
+AUTOGEN_FIELDS = {
+    "WeatherStation": [["weathercode", "integer"]],
+    "CourseInstance": [
+        ["enrollments", "integer"],
+        ["capacity", "integer"],
+        ["courseCode", "string"],
+        ["currentWeather_temperature", "integer"],
+        ["currentWeather_temperature", "float"],
+    ],
+}
+
+
+class FakeInflux:
+    """
+    Answers the queries of migrate_autogen and field_types; records the rest.
+    """
+
+    def __init__(self, fields=AUTOGEN_FIELDS):
+        self.fields = {"autogen": fields, "raw": {}}
+        self.queries = []
+        self.points = []
+
+    def query(self, query, database=None, method="GET"):
+        match = re.match(r'SHOW FIELD KEYS ON "\w+" FROM "(\w+)"', query)
+        if match:
+            series = [
+                {"name": name, "columns": ["fieldKey", "fieldType"], "values": keys}
+                for name, keys in self.fields[match.group(1)].items()
+            ]
+            return ResultSet({"statement_id": 0, "series": series})
+        if query.startswith('SELECT "done"'):
+            series = [
+                {
+                    "name": point["measurement"],
+                    "columns": ["time", "done"],
+                    "values": [[0, True]],
+                }
+                for point in self.points
+            ]
+            return ResultSet({"statement_id": 0, "series": series})
+        self.queries.append((method, query))
+        return ResultSet({"statement_id": 0})
+
+    def get_list_retention_policies(self, database):
+        return [{"name": "autogen"}, {"name": "raw"}]
+
+    def write_points(self, points, database=None, retention_policy=None):
+        self.points.extend(points)
+
+
+def test_migration_casts_integer_history_to_the_converter_types():
+    client = FakeInflux()
+
+    assert influx_schema.migrate_autogen(client, "db")
+
+    copies = [query for _, query in client.queries if '"raw"' in query]
+    assert copies == [
+        'SELECT "capacity"::integer AS "capacity", "courseCode"::string AS '
+        '"courseCode", "currentWeather_temperature"::float AS '
+        '"currentWeather_temperature", "enrollments"::integer AS "enrollments" '
+        'INTO "db"."raw"."CourseInstance" FROM "db"."autogen"."CourseInstance" '
+        "WHERE time > now() - 7d GROUP BY *",
+        'SELECT "weathercode"::integer AS "weathercode" '
+        'INTO "db"."raw"."WeatherStation" FROM "db"."autogen"."WeatherStation" '
+        "WHERE time > now() - 7d GROUP BY *",
+    ]
+    assert all(method == "POST" for method, _ in client.queries)
+    assert "SELECT *" not in " ".join(query for _, query in client.queries)
+
+
+def test_rollup_backfill_reads_cast_fields_and_keeps_the_last_weather_code():
+    client = FakeInflux()
+
+    influx_schema.migrate_autogen(client, "db")
+
+    rollups = [query for _, query in client.queries if "rollup_1h" in query]
+    weather = next(query for query in rollups if "WeatherStation" in query)
+    assert weather == (
+        'SELECT last("weathercode") AS "weathercode", max("weathercode") AS '
+        '"weathercode_max" INTO "db"."rollup_1h"."WeatherStation" FROM '
+        '(SELECT "weathercode"::integer AS "weathercode" FROM '
+        '"db"."autogen"."WeatherStation" WHERE time > now() - 52w GROUP BY *) '
+        "WHERE time > now() - 52w GROUP BY time(1h), *"
+    )
+    course = next(query for query in rollups if "CourseInstance" in query)
+    assert "courseCode" not in course
+    assert '"currentWeather_temperature"::float' in course
+
+
+def test_migration_runs_once():
+    client = FakeInflux()
+
+    assert influx_schema.migrate_autogen(client, "db")
+    copied = len(client.queries)
+
+    assert not influx_schema.migrate_autogen(client, "db")
+    assert len(client.queries) == copied
+    assert client.points[0]["measurement"] == "schema_migrations"
+
+
+def test_converter_keeps_writing_the_migrated_integer_types():
+    client = FakeInflux()
+    influx_schema.migrate_autogen(client, "db")
+    converter = InfluxConverter(tag_schema={})
+    converter.pin_field_types(influx_schema.field_types(client, "db"))
+
+    point = converter.convert(
+        "CourseInstance:1",
+        "CourseInstance",
+        {
+            "enrollments": {"type": "Number", "value": 30.0},
+            "currentWeather_temperature": {"type": "Number", "value": 25},
+        },
+        "2025-03-17T09:00:00",
+    )
+
+    assert type(point["fields"]["enrollments"]) is int
+    assert type(point["fields"]["currentWeather_temperature"]) is float
+
+
+def test_continuous_query_reads_raw():
+    rollup = influx_schema.ROLLUPS[0]
+
+    query = influx_schema.continuous_query("db", "CourseInstance", ["capacity"], rollup)
+
+    assert query == (
+        'SELECT mean("capacity") AS "capacity", max("capacity") AS "capacity_max" '
+        'INTO "db"."rollup_5m"."CourseInstance" FROM "db"."raw"."CourseInstance" '
+        "GROUP BY time(5m), *"
+    )
@@ -0,0 +1,94 @@
+from datetime import datetime, timezone
+from schedule_index import ScheduleIndex, build_schedule_index, compile_schedule
+
+# A Monday.
+NOW = datetime(2025, 3, 17, 9, 0, tzinfo=timezone.utc)
+
+
+def slot(day, start, end, **period):
+    return {"day": day, "startTime": start, "endTime": end, **period}
+
+
+def test_running_and_upcoming_classes_are_found():
+    index = ScheduleIndex()
+    index.update("running", [slot("Monday", "08:00", "10:00")])
+    index.update("later", [slot("Monday", "14:00", "16:00")])
+    index.update("ended", [slot("Monday", "07:00", "08:30")])
+    index.update("tomorrow", [slot("Tuesday", "08:00", "09:00")])
+
+    found = index.upcoming(NOW, 12)
+
+    assert set(found) == {"running", "later"}
+    assert found["running"].start == NOW.replace(hour=8)
+    assert found["later"].end == NOW.replace(hour=16)
+
+
+def test_window_crosses_midnight_and_week_end():
+    index = ScheduleIndex()
+    index.update("course", [slot("Tuesday", "08:00", "09:00")])
+    sunday = datetime(2025, 3, 23, 20, 0, tzinfo=timezone.utc)
+
+    assert index.upcoming(NOW, 22) == {}
+    assert "course" in index.upcoming(NOW, 23.5)
+    assert index.upcoming(sunday, 24) == {}
+    assert index.upcoming(sunday, 40)["course"].start.day == 25
+
+
+def test_earliest_session_per_course_and_every_session_listed():
+    index = ScheduleIndex()
+    index.update(
+        "course",
+        [slot("Monday", "18:00", "20:00"), slot("Monday", "10:00", "12:00")],
+    )
+
+    assert index.upcoming(NOW, 24)["course"].start == NOW.replace(hour=10)
+    sessions = index.sessions(NOW, 24)
+    assert [s.start.hour for s in sessions] == [10, 18]
+
+
+def test_period_bounds_are_honoured():
+    index = ScheduleIndex()
+    index.update(
+        "course",
+        [slot("Monday", "10:00", "11:00", startPeriod="2025-03-18")],
+    )
+
+    assert index.upcoming(NOW, 12) == {}
+    assert index.sessions(NOW, 24 * 7 + 2)[0].start.date().isoformat() == (
+        "2025-03-24"
+    )
+
+
+def test_update_and_remove_replace_a_course():
+    index = ScheduleIndex()
+    index.update("course", [slot("Monday", "10:00", "11:00")])
+    index.update("course", [slot("Monday", "15:00", "16:00")])
+
+    assert index.upcoming(NOW, 12)["course"].start.hour == 15
+    index.remove("course")
+    assert index.upcoming(NOW, 12) == {}
+    assert len(index) == 0
+
+
+def test_course_filter():
+    schedule = {"value": [slot("Monday", "10:00", "11:00")]}
+    index = build_schedule_index(
+        [{"id": course_id, "classSchedule": schedule} for course_id in ("a", "b")]
+    )
+
+    assert set(index.upcoming(NOW, 12, ["b"])) == {"b"}
+
+
+def test_malformed_entries_are_skipped():
+    compiled = compile_schedule(
+        "course",
+        [
+            slot("Monday", "10:00", "11:00"),
+            slot("Someday", "10:00", "11:00"),
+            slot("Monday", "25:00", "26:00"),
+            {"day": "Monday"},
+        ],
+    )
+
+    assert len(compiled) == 1
+    assert compile_schedule("course", "not a list") == []
@@ -0,0 +1,103 @@
+import threading
+import time
+import metrics
+from work_queue import CoalescingQueue, enqueue_notification
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def dropped(name):
+    return metrics.REGISTRY.get_sample_value(
+        "smartcampus_queue_dropped_total", {"queue": name}
+    ) or 0
+
+
+def notification(*entity_ids):
+    return {"data": [{"id": entity_id} for entity_id in entity_ids]}
+
+
+def test_notification_is_queued_all_or_nothing():
+    # No workers: queued items stay pending.
+    queue = CoalescingQueue(lambda items: None, maxsize=3, workers=0)
+
+    assert enqueue_notification(queue, notification("E1", "E2")) == 202
+    assert enqueue_notification(queue, notification("E2", "E3", "E4")) == 503
+    assert enqueue_notification(queue, notification("E2", "E3")) == 202
+    assert enqueue_notification(queue, {"data": []}) == 204
+
+    stats = queue.stats()
+    assert stats["depth"] == 3
+    assert stats["accepted"] == 3
+    assert stats["merged"] == 1
+    assert stats["rejected"] == 3
+
+
+def test_failed_batch_is_retried():
+    calls = []
+
+    def handler(items):
+        calls.append([item["id"] for item in items])
+        if len(calls) == 1:
+            raise RuntimeError("Orion unavailable")
+
+    queue = CoalescingQueue(handler, workers=1, retry_delay=0.05, name="test-retry")
+    try:
+        queue.put("E1", {"id": "E1"})
+        wait_until(lambda: queue.stats()["processed"] == 1)
+    finally:
+        queue.stop()
+
+    assert calls == [["E1"], ["E1"]]
+    assert queue.stats()["retried"] == 1
+    assert queue.stats()["failed"] == 0
+
+
+def test_items_are_dropped_and_counted_after_the_last_retry():
+    def handler(items):
+        raise RuntimeError("Orion unavailable")
+
+    before = dropped("test-drop")
+    queue = CoalescingQueue(
+        handler, workers=1, retries=2, retry_delay=0.01, name="test-drop"
+    )
+    try:
+        queue.put("E1", {"id": "E1"})
+        wait_until(lambda: queue.stats()["failed"] == 1)
+    finally:
+        queue.stop()
+
+    assert queue.stats()["retried"] == 2
+    assert dropped("test-drop") == before + 1
+    assert metrics.REGISTRY.get_sample_value(
+        "smartcampus_queue_batches_total", {"queue": "test-drop", "result": "failed"}
+    ) >= 3
+
+
+def test_newer_item_replaces_a_failed_one():
+    seen = []
+    started, release = threading.Event(), threading.Event()
+
+    def handler(items):
+        seen.extend(item["version"] for item in items)
+        if items[0]["version"] == 1:
+            started.set()
+            release.wait()
+            raise RuntimeError("Orion unavailable")
+
+    queue = CoalescingQueue(handler, workers=1, retry_delay=0.01)
+    try:
+        queue.put("E1", {"id": "E1", "version": 1})
+        started.wait(5)
+        queue.put("E1", {"id": "E1", "version": 2})
+        release.set()
+        wait_until(lambda: queue.stats()["processed"] == 1)
+    finally:
+        queue.stop()
+
+    assert seen == [1, 2]
+    assert queue.stats()["retried"] == 0
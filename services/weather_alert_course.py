@@ -1,17 +1,68 @@
+import asyncio
 import logging
 import sys
+import hashlib
 import json
 import os
-from datetime import datetime, timedelta, timezone
-from flask import Flask, request
+import threading
+from datetime import datetime, timezone
+from flask import Flask, Response, jsonify, request
+import asgi
+import cache
+import capture
 import fiware
+import fiware_async
+import metrics
+import spatial_index
+import work_queue
+from schedule_index import ScheduleIndex, build_schedule_index
+import time
 import unicodedata
 
 app = Flask(__name__)
 
 ENTITY_ID = "WeatherStation:CampusNatal"
+# When set, alerts follow every WeatherStation whose id matches this pattern (e.g.
+# the stations of weather_simulator's load mode) instead of ENTITY_ID only.
+WEATHER_STATION_PATTERN = os.environ.get("WEATHER_STATION_PATTERN")
 CALLBACK_URL = os.environ.get("CALLBACK_URL")
+COURSE_CALLBACK_URL = os.environ.get("COURSE_CALLBACK_URL") or (
+    CALLBACK_URL.rsplit("/", 1)[0] + "/courses/notify" if CALLBACK_URL else None
+)
 subscription_created = False
+course_subscription_created = False
+
+# Attributes of CourseInstance kept in the local spatial index.
+COURSE_INDEX_ATTRS = ["location", "classSchedule"]
+COURSE_INDEX_CELL_DEG = float(os.environ.get("COURSE_INDEX_CELL_DEG", "0.01"))
+COURSE_INDEX_RETRY_SECONDS = 60
+# Orion sends each course notification to one worker only, so with several workers
+# every index is also rebuilt from Orion this often (0 disables the refresh).
+COURSE_INDEX_REFRESH_SECONDS = float(
+    os.environ.get("COURSE_INDEX_REFRESH_SECONDS", "300")
+)
+
+ALERT_HOURS_AHEAD = float(os.environ.get("ALERT_HOURS_AHEAD", "24"))
+
+ALERT_CACHE_SIZE = int(os.environ.get("ALERT_CACHE_SIZE", "10000"))
+ALERT_CACHE_TTL = float(os.environ.get("ALERT_CACHE_TTL", "600"))
+
+# Content hash of the last alert written to Orion, keyed by alert id, so that an
+# identical alert is not upserted again on every weathercode update.
+alert_cache = cache.TTLCache(ALERT_CACHE_SIZE, ALERT_CACHE_TTL)
+
+# Set with NOTIFY_CAPTURE_PATH; records notifications for offline replay.
+recorder = capture.open_recorder("weather_alert_course")
+
+course_index = spatial_index.GeoGridIndex(COURSE_INDEX_CELL_DEG)
+schedule_index = ScheduleIndex()
+course_index_last_attempt = 0.0
+course_index_loaded_at = 0.0
+course_index_lock = threading.Lock()
+# While warm_course_index rebuilds the indexes, /courses/notify updates are also
+# recorded here and replayed on the new indexes once they are swapped in.
+course_index_updates = None
+course_index_updates_lock = threading.Lock()
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -29,25 +80,37 @@ def remove_accents(text):
     return unicodedata.normalize("NFKD", text).encode("ASCII", "ignore").decode("ASCII")
 
 
-def format_iso_utc(time_str: str) -> str:
-    dt = datetime.strptime(time_str, "%H:%M").replace(
-        year=datetime.now().year,
-        month=datetime.now().month,
-        day=datetime.now().day,
-        tzinfo=timezone.utc,
-    )
-    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+def format_iso_utc(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
 @app.route("/notify", methods=["POST"])
 def notify_weather():
-    payload = request.json
+    if recorder:
+        recorder.record("/notify", request.json)
+    status = work_queue.enqueue_notification(notification_queue, request.json)
+    return "", status, work_queue.response_headers(status)
+
+
+async def receive_weather_notification(payload):
+    if recorder:
+        recorder.record("/notify", payload)
+    status = work_queue.enqueue_notification(notification_queue, payload)
+    return status, b"", "text/plain", work_queue.response_headers(status)
+
+
+async def process_weather_entities(entities):
+    with metrics.timed(metrics.NOTIFY_SECONDS, service="weather_alert"):
+        await handle_weather_notification({"data": entities})
+
+
+async def handle_weather_notification(payload):
     logger.info("[RECEIVED] /notify:")
     logger.info(json.dumps(payload, indent=2))
 
     if "data" not in payload:
         logger.warning("Payload does not contain 'data' key")
-        return "", 204
+        return 204
 
     for entity in payload["data"]:
         coords = entity.get("location", {}).get("value", {}).get("coordinates")
@@ -56,75 +119,44 @@ def notify_weather():
             continue
 
         lat, lon = coords[1], coords[0]
-        weekday = datetime.now(timezone.utc).strftime("%A")
         logger.info(f"Weather location: lat={lat}, lon={lon}")
 
-        course_instances = find_nearby_or_related_courses(lat, lon)
+        trace = metrics.trace_context(entity.get("weathercode"))
+        metrics.observe_trace(trace, "alert_notified")
+
+        course_instances = await find_nearby_or_related_courses(lat, lon)
         logger.info(f"{len(course_instances)} nearby courses found")
+        courses = {c["id"]: c for c in course_instances if c.get("id")}
+
+        schedules = schedule_index
+        if not course_index.ready:
+            schedules = build_schedule_index(course_instances)
+
+        now = datetime.now(timezone.utc)
+        sessions = schedules.upcoming(now, ALERT_HOURS_AHEAD, courses.keys())
+
+        alerts = []
+        for course_id, session in sessions.items():
+            logger.info(
+                f"Course '{course_id}' with class within {ALERT_HOURS_AHEAD}h "
+                f"({session.start:%H:%M} - {session.end:%H:%M})"
+            )
+            alerts.append(
+                send_alert(courses[course_id], session.start, session.end, trace)
+            )
+
+        without_class = len(courses) - len(sessions)
+        if without_class:
+            logger.info(
+                f"No valid class within {ALERT_HOURS_AHEAD}h in {without_class} nearby courses"
+            )
+
+        await asyncio.gather(*alerts)
+
+    return 200
 
-        for course in course_instances:
-            schedules = course.get("classSchedule", {}).get("value", [])
-            if not isinstance(schedules, list):
-                logger.error(
-                    f"'classSchedule.value' is not a list in course {course.get('id')}"
-                )
-                continue
 
-            now = datetime.now(timezone.utc)
-            found_valid_class = False
-            hours_ahead = 24
-            for schedule in schedules:
-                course_day = schedule.get("day")
-                start_time = schedule.get("startTime")
-                end_time = schedule.get("endTime")
-
-                if not course_day or not start_time or not end_time:
-                    logger.warning(f"Incomplete data in course {course.get('id')}")
-                    continue
-
-                if course_day != weekday:
-                    continue
-
-                try:
-                    start_dt = datetime.strptime(start_time, "%H:%M").replace(
-                        year=now.year,
-                        month=now.month,
-                        day=now.day,
-                        tzinfo=timezone.utc,
-                    )
-                    end_dt = datetime.strptime(end_time, "%H:%M").replace(
-                        year=now.year,
-                        month=now.month,
-                        day=now.day,
-                        tzinfo=timezone.utc,
-                    )
-                except ValueError as e:
-                    logger.error(
-                        f"Error converting times in course {course.get('id')}: {e}"
-                    )
-                    continue
-
-                if now + timedelta(hours=hours_ahead) >= start_dt and now <= end_dt:
-                    course_id = course.get("id", "Unknown")
-                    logger.info(
-                        f"Course '{course_id}' with class within {hours_ahead}h ({start_time} - {end_time})"
-                    )
-                    found_valid_class = True
-                    send_alert(course, start_time, end_time)
-                    logger.warning(
-                        f"Sending alert for course {course.get('id')} ({course_id})"
-                    )
-                    break
-
-            if not found_valid_class:
-                logger.info(
-                    f"No valid class within {hours_ahead}h in course {course.get('id', 'Unknown')}"
-                )
-
-    return "", 200
-
-
-def send_alert(course, start_time: str, end_time: str) -> None:
+async def send_alert(course, start: datetime, end: datetime, trace=None) -> None:
     course_id = course.get("id", "Unknown")
     course_id_value = course.get("id", "Unknown")
     coordinates = course.get("location", {}).get("value", {}).get("coordinates", [])
@@ -132,7 +164,7 @@ def send_alert(course, start_time: str, end_time: str) -> None:
         logger.error(f"Coordinates missing for course {course_id}")
         return
 
-    raw_description = f"Possible rain during the class of course '{course_id_value}' between {start_time} and {end_time}."
+    raw_description = f"Possible rain during the class of course '{course_id_value}' between {start:%H:%M} and {end:%H:%M}."
     description = remove_accents(raw_description).replace('"', "").replace("'", "")
 
     alert_id = f"Alert:Weather:{course_id}"
@@ -150,28 +182,223 @@ def send_alert(course, start_time: str, end_time: str) -> None:
             "type": "DateTime",
             "value": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
         },
-        "validFrom": {"type": "DateTime", "value": format_iso_utc(start_time)},
-        "validTo": {"type": "DateTime", "value": format_iso_utc(end_time)},
+        "validFrom": {"type": "DateTime", "value": format_iso_utc(start)},
+        "validTo": {"type": "DateTime", "value": format_iso_utc(end)},
         "alertSource": {"value": "Weather Monitoring System", "type": "Text"},
         "severity": {"value": "medium"},
         "affectedEntity": {"type": "Relationship", "value": course_id},
     }
+    if trace:
+        # Carries the weathercode update's trace to the Alert, so its consumers can
+        # measure the latency of the whole pipeline.
+        full_alert["dateIssued"]["metadata"] = metrics.trace_metadata(trace)
+
+    # Only the last content written is compared: an alert that goes A -> B -> A
+    # must be written back to A.
+    content_hash = alert_content_hash(full_alert)
+    unchanged = alert_cache.get(alert_id) == content_hash
+    metrics.count_lookup("alert", unchanged)
+    if unchanged:
+        metrics.ALERTS.labels("unchanged").inc()
+        logger.debug(f"Alert for course {course_id} unchanged, skipping upsert.")
+        return
 
-    logger.warning(f"Sending alert for course {course_id} ({course_id_value})")
+    trace_id = trace.get("traceId") if trace else None
+    logger.warning(
+        f"Sending alert for course {course_id} ({course_id_value}), trace {trace_id}"
+    )
 
     try:
-        fiware.upsert_entity(full_alert)
+        res = await fiware_async.upsert_entity(full_alert)
+        if res is not None and res.status_code < 300:
+            alert_cache.set(alert_id, content_hash)
+            metrics.ALERTS.labels("sent").inc()
+            metrics.observe_trace(trace, "alert_sent")
+        else:
+            metrics.ALERTS.labels("failed").inc()
         logger.info(f"Alert processed successfully for course '{course_id_value}'.")
     except Exception as exc:
+        metrics.ALERTS.labels("failed").inc()
         logger.exception(f"Error sending/updating alert: {exc}")
 
 
-def find_nearby_or_related_courses(
+def alert_content_hash(alert):
+    """
+    Hash of the alert fields that matter to consumers; dateIssued is left out so an
+    otherwise identical alert maps to the same hash.
+    """
+    content = [
+        alert[attr]["value"]
+        for attr in ("category", "subCategory", "validFrom", "validTo", "severity")
+    ]
+    return hashlib.sha1(json.dumps(content).encode("utf-8")).hexdigest()
+
+
+def collect_stats():
+    """
+    Service counters. For the alert cache, hits are alerts written before (changed
+    or not) and misses are alerts never written; smartcampus_alerts_total tells
+    the upserts skipped from the ones sent.
+    """
+    counters = {
+        "alert_cache": alert_cache.stats(),
+        "queue": notification_queue.stats(),
+        "course_index_age_seconds": (
+            round(time.time() - course_index_loaded_at, 1)
+            if course_index_loaded_at
+            else None
+        ),
+    }
+    if recorder:
+        counters["capture"] = recorder.stats()
+    return counters
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(collect_stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+async def handle_stats(_payload):
+    return 200, json.dumps(collect_stats()), "application/json"
+
+
+async def find_nearby_or_related_courses(
     latitude: float, longitude: float, radius_meters: int = 5000
 ):
-    return fiware.find_entities_nearby(
-        "CourseInstance", latitude, longitude, radius_meters
+    if not course_index.ready:
+        await asyncio.to_thread(warm_course_index)
+    else:
+        refresh_course_index()
+    if course_index.ready:
+        courses = course_index.query_radius(latitude, longitude, radius_meters)
+        logger.info(f"Total nearby CourseInstance (index): {len(courses)}")
+        return courses
+
+    return await fiware_async.find_entities_nearby(
+        "CourseInstance", latitude, longitude, radius_meters, attrs=COURSE_INDEX_ATTRS
+    )
+
+
+def warm_course_index():
+    """
+    Loads the location and schedule of every CourseInstance into the spatial and
+    schedule indexes with one paged query. Attempts are rate limited so a cold index
+    falls back to Orion's georel query instead of retrying on every notification.
+    Only one thread warms the index at a time; concurrent calls return at once.
+    Course updates received during the rebuild are replayed on the new indexes.
+    """
+    global course_index_last_attempt, course_index_loaded_at, schedule_index
+    global course_index_updates
+    if not course_index_lock.acquire(blocking=False):
+        return
+    try:
+        if time.time() - course_index_last_attempt < COURSE_INDEX_RETRY_SECONDS:
+            return
+        course_index_last_attempt = time.time()
+        with course_index_updates_lock:
+            course_index_updates = []
+
+        points = []
+        courses = list(fiware.iter_entities("CourseInstance", attrs=COURSE_INDEX_ATTRS))
+        for course in courses:
+            coords = spatial_index.entity_coordinates(course)
+            if coords:
+                points.append((course["id"], coords[0], coords[1], course))
+        schedules = build_schedule_index(courses)
+        with course_index_updates_lock:
+            schedule_index = schedules
+            course_index.replace_all(points)
+            for course in course_index_updates:
+                apply_course_update(course)
+            replayed = len(course_index_updates)
+        course_index_loaded_at = time.time()
+        logger.info(
+            f"Course index warmed with {len(points)} CourseInstance entities, "
+            f"{replayed} updates replayed."
+        )
+    except Exception as e:
+        logger.error(f"Failed to warm course index, using Orion georel queries: {e}")
+    finally:
+        with course_index_updates_lock:
+            course_index_updates = None
+        course_index_lock.release()
+
+
+def refresh_course_index():
+    """
+    Rebuilds the index in a background thread once it is older than
+    COURSE_INDEX_REFRESH_SECONDS, serving the current one in the meantime.
+    """
+    if not COURSE_INDEX_REFRESH_SECONDS or course_index_lock.locked():
+        return
+    now = time.time()
+    if now - course_index_loaded_at < COURSE_INDEX_REFRESH_SECONDS:
+        return
+    if now - course_index_last_attempt < COURSE_INDEX_RETRY_SECONDS:
+        return
+    threading.Thread(
+        target=warm_course_index, name="course-index-refresh", daemon=True
+    ).start()
+
+
+@app.route("/courses/notify", methods=["POST"])
+async def notify_courses():
+    status = await receive_course_notification(request.json)
+    return "", status
+
+
+async def receive_course_notification(payload):
+    if recorder:
+        recorder.record("/courses/notify", payload)
+    return await handle_course_notification(payload)
+
+
+async def handle_course_notification(payload):
+    """
+    Applies CourseInstance location/schedule changes to the spatial and schedule indexes.
+    """
+    with metrics.timed(metrics.NOTIFY_SECONDS, service="course_index"):
+        for course in payload.get("data", []):
+            if not course.get("id"):
+                continue
+            with course_index_updates_lock:
+                apply_course_update(course)
+                if course_index_updates is not None:
+                    course_index_updates.append(course)
+
+    return 204
+
+
+def apply_course_update(course):
+    """
+    Applies one notified CourseInstance to the spatial and schedule indexes.
+    Called with course_index_updates_lock held, so it never races an index swap.
+    """
+    course_id = course["id"]
+    alteration = course.get("alterationType", {})
+    coords = spatial_index.entity_coordinates(course)
+    if alteration.get("value") == "entityDelete" or not coords:
+        course_index.remove(course_id)
+        schedule_index.remove(course_id)
+        logger.info(f"Removed course {course_id} from index.")
+        return
+
+    if "classSchedule" in course:
+        schedule_index.update(course_id, course["classSchedule"].get("value", []))
+
+    indexed = dict(course_index.get(course_id) or {})
+    indexed.update(
+        {name: value for name, value in course.items() if name != "alterationType"}
     )
+    course_index.upsert(course_id, coords[0], coords[1], indexed)
+    logger.info(f"Indexed course {course_id} at {coords}.")
 
 
 def register_subscription():
@@ -179,10 +406,15 @@ def register_subscription():
     if subscription_created:
         return
 
+    station = (
+        {"idPattern": WEATHER_STATION_PATTERN, "type": "WeatherStation"}
+        if WEATHER_STATION_PATTERN
+        else {"id": ENTITY_ID, "type": "WeatherStation"}
+    )
     subscription = {
         "description": "Weather alert for classes",
         "subject": {
-            "entities": [{"id": ENTITY_ID, "type": "WeatherStation"}],
+            "entities": [station],
             "condition": {"attrs": ["weathercode"]},
         },
         "notification": {
@@ -192,16 +424,59 @@ def register_subscription():
         "throttling": 5,
     }
 
-    subscription_created = fiware.register_subscription(subscription)
+    subscription_created = fiware.reconcile_subscription(subscription)
 
     if subscription_created:
-        logger.info("Subscription created successfully.")
+        logger.info(f"Subscription {subscription_created} ready.")
     else:
         logger.error("Failed to create subscription.")
 
 
+def register_course_subscription():
+    global course_subscription_created
+    if course_subscription_created:
+        return
+
+    subscription = {
+        "description": "Course location index for weather alerts",
+        "subject": {
+            "entities": [{"idPattern": "^CourseInstance.*", "type": "CourseInstance"}],
+            "condition": {
+                "attrs": COURSE_INDEX_ATTRS,
+                "alterationTypes": ["entityCreate", "entityChange", "entityDelete"],
+            },
+        },
+        "notification": {
+            "http": {"url": COURSE_CALLBACK_URL},
+            "attrs": COURSE_INDEX_ATTRS + ["alterationType"],
+        },
+    }
+
+    course_subscription_created = fiware.reconcile_subscription(subscription)
+
+    if not course_subscription_created:
+        logger.error("Failed to create course index subscription.")
+
+
+# WeatherStation notifications are acknowledged right away and processed by a
+# worker pool; pending updates of the same station are merged.
+notification_queue = work_queue.CoalescingQueue(
+    process_weather_entities, name="weather-alert"
+)
+
 with app.app_context():
     register_subscription()
+    register_course_subscription()
+    warm_course_index()
+
+asgi_app = asgi.make_asgi_app(
+    {
+        ("POST", "/notify"): receive_weather_notification,
+        ("POST", "/courses/notify"): receive_course_notification,
+        ("GET", "/stats"): handle_stats,
+        ("GET", "/metrics"): metrics.handle_metrics,
+    }
+)
 
 if __name__ != "__main__":
     gunicorn_logger = logging.getLogger("gunicorn.error")
@@ -1,10 +1,21 @@
+import asyncio
 import logging
+import math
 import sys
 import json
 import os
-import requests
-from flask import Flask, request
+import time
+import weakref
+from datetime import datetime, timezone
+import httpx
+from flask import Flask, Response, jsonify, request
+import asgi
+import cache
+import capture
 import fiware
+import fiware_async
+import metrics
+import work_queue
 
 app = Flask(__name__)
 
@@ -23,11 +34,95 @@ logger.addHandler(handler)
 logger.propagate = False
 
 
+WEATHER_API_URL = os.environ.get(
+    "WEATHER_API_URL", "https://api.open-meteo.com/v1/forecast"
+)
+WEATHER_API_TIMEOUT = float(os.environ.get("WEATHER_API_TIMEOUT", "10"))
+WEATHER_API_MAX_LOCATIONS = int(os.environ.get("WEATHER_API_MAX_LOCATIONS", "100"))
+
+# Forecasts are cached per lat/lon grid cell: courses a few hundred meters apart
+# share one Open-Meteo call. Entries live until the API's next update interval.
+WEATHER_CACHE_BACKEND = os.environ.get("WEATHER_CACHE_BACKEND", "memory")
+WEATHER_CACHE_PATH = os.environ.get("WEATHER_CACHE_PATH", "weather_cache.sqlite3")
+WEATHER_CACHE_SIZE = int(os.environ.get("WEATHER_CACHE_SIZE", "4096"))
+WEATHER_CACHE_CELL_DEG = float(os.environ.get("WEATHER_CACHE_CELL_DEG", "0.01"))
+WEATHER_CACHE_DEFAULT_TTL = float(os.environ.get("WEATHER_CACHE_DEFAULT_TTL", "900"))
+WEATHER_CACHE_MIN_TTL = 60
+
+weather_cache = cache.open_cache(
+    WEATHER_CACHE_BACKEND,
+    WEATHER_CACHE_PATH,
+    WEATHER_CACHE_SIZE,
+    WEATHER_CACHE_DEFAULT_TTL,
+)
+weather_requests = cache.SingleFlight()
+
+# Existence checks before enriching are sent in chunks of this many IDs.
+EXISTING_IDS_CHUNK = 100
+
+# httpx connections are bound to the event loop that opened them, so each worker
+# loop keeps its own pooled Open-Meteo client, like fiware_async.get_client.
+_weather_clients = weakref.WeakKeyDictionary()
+
+# Set with NOTIFY_CAPTURE_PATH; records notifications for offline replay.
+recorder = capture.open_recorder("weather_context_enricher")
+
+
 @app.route("/notify", methods=["POST"])
 def notify():
-    payload = request.json
+    if recorder:
+        recorder.record("/notify", request.json)
+    status = work_queue.enqueue_notification(notification_queue, request.json)
+    return "", status, work_queue.response_headers(status)
+
+
+async def receive_notification(payload):
+    if recorder:
+        recorder.record("/notify", payload)
+    status = work_queue.enqueue_notification(notification_queue, payload)
+    return status, b"", "text/plain", work_queue.response_headers(status)
+
+
+async def process_entities(entities):
+    with metrics.timed(metrics.NOTIFY_SECONDS, service="enricher"):
+        await handle_notification({"data": entities})
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(collect_stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+async def handle_stats(_payload):
+    return 200, json.dumps(collect_stats()), "application/json"
+
+
+def collect_stats():
+    weather_stats = weather_cache.stats()
+    weather_stats["shared_requests"] = weather_requests.shared
+    counters = {"queue": notification_queue.stats(), "weather_cache": weather_stats}
+    if recorder:
+        counters["capture"] = recorder.stats()
+    return counters
+
+
+async def handle_notification(payload):
+    """
+    Enriches every CourseInstance of a notification batch with the current weather.
+    Coordinates are deduplicated by grid cell, missing cells are fetched in one
+    multi-location Open-Meteo request, and all entities are written back to Orion
+    in a single batch update.
+    """
     data = payload.get("data", [])
 
+    entity_cells = []
+    cells = {}
     for entity in data:
         entity_id = entity.get("id")
         location = entity.get("location", {}).get("value", {})
@@ -37,75 +132,267 @@ def notify():
             logger.warning(f"Missing coordinates in entity: {entity_id}")
             continue
 
-        weather = get_weather_info(lat, lon)
+        key, cell_lat, cell_lon = weather_cell(lat, lon)
+        cells[key] = (cell_lat, cell_lon)
+        entity_cells.append((entity, key))
+
+    if not entity_cells:
+        return 204
+
+    weather_by_cell = await get_cached_weather(get_weather_client(), cells)
+
+    updates = []
+    for entity, key in entity_cells:
+        entity_id = entity.get("id")
+        weather = weather_by_cell.get(key)
         logger.info(f"Weather data: {entity_id} {json.dumps(weather)}")
         if not weather:
             logger.warning(f"No weather data returned for entity: {entity_id}")
             continue
+        updates.append(
+            {"id": entity_id, "type": entity.get("type", ENTITY_ID), **weather}
+        )
+
+    if updates:
+        await write_weather(updates)
+
+    return 204
+
+
+async def write_weather(updates):
+    """
+    Appends currentWeather to the entities that still exist in Orion.
+
+    A batch append creates missing entities, and a queued enrichment can run after
+    its CourseInstance was deleted (e.g. by an incremental reload or a purge), so
+    the IDs are checked against Orion first and unknown ones are dropped rather
+    than recreated as entities holding only currentWeather.
+    """
+    existing = await existing_entity_ids(updates)
+    dropped = [entity["id"] for entity in updates if entity["id"] not in existing]
+    if dropped:
+        logger.info(f"Skipping weather for {len(dropped)} deleted entities: {dropped}")
+    updates = [entity for entity in updates if entity["id"] in existing]
+    if updates:
+        await fiware_async.batch_upsert(updates, action_type="append")
+
+
+async def existing_entity_ids(entities):
+    """
+    Returns the IDs of entities that exist in Orion, querying them by ID and type.
+    """
+    ids_by_type = {}
+    for entity in entities:
+        ids_by_type.setdefault(entity["type"], []).append(entity["id"])
+
+    client = fiware_async.get_client()
+    existing = set()
+    for entity_type, entity_ids in ids_by_type.items():
+        for first in range(0, len(entity_ids), EXISTING_IDS_CHUNK):
+            chunk = entity_ids[first : first + EXISTING_IDS_CHUNK]
+            async for page in client.iter_entity_pages(
+                entity_type,
+                attrs="id",
+                key_values=True,
+                params={"id": ",".join(chunk)},
+            ):
+                existing.update(entity["id"] for entity in page)
+    return existing
 
-        fiware.update_entity(entity_id, weather)
 
-    return "", 204
+def get_weather_client():
+    """
+    Returns the Open-Meteo client bound to the running event loop, creating it on
+    first use.
+    """
+    loop = asyncio.get_running_loop()
+    http = _weather_clients.get(loop)
+    if http is None:
+        http = httpx.AsyncClient(timeout=WEATHER_API_TIMEOUT)
+        _weather_clients[loop] = http
+    return http
 
 
-def get_weather_info(lat, lon):
+async def close_weather_client():
+    """
+    Closes the Open-Meteo client bound to the running event loop, if any.
+    """
+    http = _weather_clients.pop(asyncio.get_running_loop(), None)
+    if http is not None:
+        await http.aclose()
+
+
+def weather_cell(lat, lon):
+    """
+    Returns the cache key of the grid cell containing (lat, lon) and the cell center.
+    """
+    row = math.floor(lat / WEATHER_CACHE_CELL_DEG)
+    col = math.floor(lon / WEATHER_CACHE_CELL_DEG)
+    center_lat = round((row + 0.5) * WEATHER_CACHE_CELL_DEG, 6)
+    center_lon = round((col + 0.5) * WEATHER_CACHE_CELL_DEG, 6)
+    return f"{row}:{col}", center_lat, center_lon
+
+
+def weather_ttl(weather):
+    """
+    Seconds until Open-Meteo publishes the next current_weather value, based on the
+    reported observation time and its update interval.
+    """
+    current = weather["currentWeather"]["value"]
+    interval = current.get("interval") or WEATHER_CACHE_DEFAULT_TTL
+    try:
+        observed = datetime.fromisoformat(current["time"]).replace(tzinfo=timezone.utc)
+        remaining = observed.timestamp() + interval - datetime.now(timezone.utc).timestamp()
+    except (KeyError, TypeError, ValueError):
+        remaining = interval
+    return min(max(remaining, WEATHER_CACHE_MIN_TTL), interval)
+
+
+async def get_cached_weather(http, cells):
+    """
+    Returns the weather of each grid cell, served from the cache when possible.
+    Missing cells are fetched together; cells already being fetched by a concurrent
+    batch are awaited instead of requested again.
+    Args:
+        cells (dict): cache key -> (lat, lon) of the cell center.
+    Returns:
+        dict: cache key -> weather attributes (None when unavailable).
+    """
+    weather_by_cell = {}
+    missing = {}
+    for key, coords in cells.items():
+        weather = weather_cache.get(key)
+        metrics.count_lookup("weather", weather is not None)
+        if weather is not None:
+            weather_by_cell[key] = weather
+        else:
+            missing[key] = coords
+
+    async def fetch(keys):
+        fetched = await get_weather_info_batch(http, {k: missing[k] for k in keys})
+        for key, weather in fetched.items():
+            if weather:
+                weather_cache.set(key, weather, ttl=weather_ttl(weather))
+        return fetched
+
+    if missing:
+        weather_by_cell.update(await weather_requests.run_many(list(missing), fetch))
+    return weather_by_cell
+
+
+async def get_weather_info_batch(http, cells):
+    """
+    Fetches the current weather of many locations with Open-Meteo's comma separated
+    latitude/longitude lists, WEATHER_API_MAX_LOCATIONS locations per request.
+    Args:
+        cells (dict): cache key -> (lat, lon).
+    Returns:
+        dict: cache key -> weather attributes (None when the request failed).
+    """
+    keys = list(cells)
+    chunks = [
+        keys[i : i + WEATHER_API_MAX_LOCATIONS]
+        for i in range(0, len(keys), WEATHER_API_MAX_LOCATIONS)
+    ]
+    results = await asyncio.gather(
+        *(get_weather_info(http, [cells[key] for key in chunk]) for chunk in chunks)
+    )
+
+    weather_by_cell = {}
+    for chunk, weathers in zip(chunks, results):
+        for i, key in enumerate(chunk):
+            weather_by_cell[key] = weathers[i] if weathers else None
+    return weather_by_cell
+
+
+async def get_weather_info(http, locations):
+    """
+    Calls Open-Meteo for a list of (lat, lon) locations.
+    Returns:
+        list: Weather attributes per location, in request order, or None on failure.
+    """
     try:
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current_weather=true"
-        res = requests.get(url)
+        latitudes = ",".join(str(lat) for lat, _ in locations)
+        longitudes = ",".join(str(lon) for _, lon in locations)
+        url = f"{WEATHER_API_URL}?latitude={latitudes}&longitude={longitudes}&current_weather=true"
+        started = time.perf_counter()
+        status = "error"
+        try:
+            res = await http.get(url)
+            status = res.status_code
+        finally:
+            metrics.EXTERNAL_API_SECONDS.labels("open-meteo", str(status)).observe(
+                time.perf_counter() - started
+            )
         if res.status_code != 200:
             logger.warning(f"Failed weather API call. Status: {res.status_code}")
             return None
 
         data = res.json()
-        current = data.get("current_weather", {})
-        units = data.get("current_weather_units", {})
-
-        return {
-            "currentWeather": {
-                "type": "StructuredValue",
-                "value": {
-                    "time": current.get("time"),
-                    "temperature": current.get("temperature"),
-                    "windspeed": current.get("windspeed"),
-                    "winddirection": current.get("winddirection"),
-                    "interval": current.get("interval"),
-                    "is_day": current.get("is_day"),
-                    "weathercode": current.get("weathercode"),
-                },
-                "metadata": {
-                    "temperature_unit": {
-                        "type": "Text",
-                        "value": units.get("temperature", "°C"),
-                    },
-                    "windspeed_unit": {
-                        "type": "Text",
-                        "value": units.get("windspeed", "km/h"),
-                    },
-                    "winddirection_unit": {
-                        "type": "Text",
-                        "value": units.get("winddirection", "°"),
-                    },
-                    "interval_unit": {
-                        "type": "Text",
-                        "value": units.get("interval", "seconds"),
-                    },
-                    "weathercode_unit": {
-                        "type": "Text",
-                        "value": units.get("weathercode", "wmo code"),
-                    },
-                    "time_format": {
-                        "type": "Text",
-                        "value": units.get("time", "iso8601"),
-                    },
-                },
-            }
-        }
+        # A single location is returned as an object, several as a list.
+        if isinstance(data, dict):
+            data = [data]
+        if len(data) != len(locations):
+            logger.warning(
+                f"Weather API returned {len(data)} results for {len(locations)} locations"
+            )
+            return None
+        return [parse_weather(item) for item in data]
 
     except Exception as e:
         logger.error(f"Weather fetch error: {e}")
         return None
 
 
+def parse_weather(data):
+    """
+    Converts one Open-Meteo result into the currentWeather NGSI attribute.
+    """
+    current = data.get("current_weather", {})
+    units = data.get("current_weather_units", {})
+
+    return {
+        "currentWeather": {
+            "type": "StructuredValue",
+            "value": {
+                "time": current.get("time"),
+                "temperature": current.get("temperature"),
+                "windspeed": current.get("windspeed"),
+                "winddirection": current.get("winddirection"),
+                "interval": current.get("interval"),
+                "is_day": current.get("is_day"),
+                "weathercode": current.get("weathercode"),
+            },
+            "metadata": {
+                "temperature_unit": {
+                    "type": "Text",
+                    "value": units.get("temperature", "°C"),
+                },
+                "windspeed_unit": {
+                    "type": "Text",
+                    "value": units.get("windspeed", "km/h"),
+                },
+                "winddirection_unit": {
+                    "type": "Text",
+                    "value": units.get("winddirection", "°"),
+                },
+                "interval_unit": {
+                    "type": "Text",
+                    "value": units.get("interval", "seconds"),
+                },
+                "weathercode_unit": {
+                    "type": "Text",
+                    "value": units.get("weathercode", "wmo code"),
+                },
+                "time_format": {
+                    "type": "Text",
+                    "value": units.get("time", "iso8601"),
+                },
+            },
+        }
+    }
+
+
 def register_subscription():
     global subscription_created
     if subscription_created:
@@ -121,12 +408,24 @@ def register_subscription():
         "throttling": 30,
     }
 
-    subscription_created = fiware.register_subscription(subscription)
+    subscription_created = fiware.reconcile_subscription(subscription)
+
 
+# CourseInstance notifications are acknowledged right away and enriched by a
+# worker pool; pending location updates of the same course are merged.
+notification_queue = work_queue.CoalescingQueue(process_entities, name="enricher")
 
 with app.app_context():
     register_subscription()
 
+asgi_app = asgi.make_asgi_app(
+    {
+        ("POST", "/notify"): receive_notification,
+        ("GET", "/stats"): handle_stats,
+        ("GET", "/metrics"): metrics.handle_metrics,
+    }
+)
+
 if __name__ != "__main__":
     gunicorn_logger = logging.getLogger("gunicorn.error")
     app.logger.handlers = gunicorn_logger.handlers
@@ -1,10 +1,14 @@
 import requests
+import asyncio
+import itertools
 import time
 import logging
 import os
 from datetime import datetime, timezone
 import random
 import fiware
+import fiware_async
+import metrics
 
 # Logging configuration
 logger = logging.getLogger()
@@ -21,6 +25,30 @@ COORDS = [-35.2035, -5.8365]
 
 HEADERS = {"Content-Type": "application/json", "Accept": "application/json"}
 
+# "single" drives WeatherStation:CampusNatal; "load" drives many stations at a target
+# rate to find the saturation point of Orion and the notify services.
+SIMULATOR_MODE = os.environ.get("SIMULATOR_MODE", "single")
+
+LOAD_STATIONS = int(os.environ.get("LOAD_STATIONS", "100"))
+# min_lon,min_lat,max_lon,max_lat; defaults to the Natal area.
+LOAD_BBOX = os.environ.get("LOAD_BBOX", "-35.30,-5.90,-35.15,-5.75")
+LOAD_ID_PREFIX = os.environ.get("LOAD_ID_PREFIX", "WeatherStation:Load-")
+# Updates per second across all stations (the peak rate for the ramp profile).
+LOAD_RATE = float(os.environ.get("LOAD_RATE", "50"))
+LOAD_CONCURRENCY = int(os.environ.get("LOAD_CONCURRENCY", "20"))
+# steady: LOAD_RATE throughout; ramp: linear from LOAD_RAMP_START_RATE to LOAD_RATE;
+# burst: LOAD_RATE with LOAD_BURST_FACTOR times the rate for LOAD_BURST_SECONDS
+# every LOAD_BURST_PERIOD seconds.
+LOAD_PROFILE = os.environ.get("LOAD_PROFILE", "steady")
+LOAD_DURATION = float(os.environ.get("LOAD_DURATION", "300"))
+LOAD_RAMP_START_RATE = float(os.environ.get("LOAD_RAMP_START_RATE", "1"))
+LOAD_BURST_FACTOR = float(os.environ.get("LOAD_BURST_FACTOR", "5"))
+LOAD_BURST_SECONDS = float(os.environ.get("LOAD_BURST_SECONDS", "10"))
+LOAD_BURST_PERIOD = float(os.environ.get("LOAD_BURST_PERIOD", "60"))
+LOAD_REPORT_INTERVAL = float(os.environ.get("LOAD_REPORT_INTERVAL", "10"))
+LOAD_SEED = int(os.environ.get("LOAD_SEED", "42"))
+LOAD_PROFILES = ("steady", "ramp", "burst")
+
 
 def create_entity():
     entity = {
@@ -42,7 +70,11 @@ def create_entity():
 
 def upsert_weather_station(weathercode, timestamp):
     attrs = {
-        "weathercode": {"type": "Number", "value": weathercode},
+        "weathercode": {
+            "type": "Number",
+            "value": weathercode,
+            "metadata": metrics.trace_metadata(metrics.new_trace_context()),
+        },
         "timestamp": {"type": "DateTime", "value": timestamp},
         "location": {
             "type": "geo:json",
@@ -74,8 +106,254 @@ def simulate_weather_loop():
         i += 1
 
 
+def load_stations(count=LOAD_STATIONS, bbox=LOAD_BBOX, prefix=LOAD_ID_PREFIX, seed=LOAD_SEED):
+    """
+    Returns count WeatherStation entities placed at random inside bbox. The same seed
+    gives the same stations, so repeated runs update the same entities.
+    """
+    min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox.split(","))
+    rng = random.Random(seed)
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    stations = []
+    for i in range(count):
+        coords = [
+            round(rng.uniform(min_lon, max_lon), 6),
+            round(rng.uniform(min_lat, max_lat), 6),
+        ]
+        stations.append(
+            {
+                "id": f"{prefix}{i:05d}",
+                "type": "WeatherStation",
+                "weathercode": {"type": "Number", "value": 0},
+                "timestamp": {"type": "DateTime", "value": timestamp},
+                "location": {
+                    "type": "geo:json",
+                    "value": {"type": "Point", "coordinates": coords},
+                },
+            }
+        )
+    return stations
+
+
+def target_rate(profile, elapsed, rate=LOAD_RATE, duration=LOAD_DURATION):
+    """
+    Updates per second the profile asks for elapsed seconds into the run.
+    """
+    if profile == "ramp":
+        progress = min(elapsed / duration, 1.0) if duration > 0 else 1.0
+        return LOAD_RAMP_START_RATE + (rate - LOAD_RAMP_START_RATE) * progress
+    if profile == "burst":
+        if elapsed % LOAD_BURST_PERIOD < LOAD_BURST_SECONDS:
+            return rate * LOAD_BURST_FACTOR
+        return rate
+    return rate
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+class LoadStats:
+    """
+    Counters of a load run, kept for the whole run and per report interval.
+
+    "late" counts updates the schedule asked for while every sender was still busy:
+    a growing late count means the target rate is above what Orion sustains with
+    this concurrency.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.total = {"scheduled": 0, "sent": 0, "ok": 0, "errors": 0, "late": 0}
+        self.latencies = []
+        self.status_codes = {}
+        self._reset_interval()
+
+    def _reset_interval(self):
+        self.interval_started = time.monotonic()
+        self.interval = {"scheduled": 0, "sent": 0, "ok": 0, "errors": 0, "late": 0}
+        self.interval_latencies = []
+
+    def count(self, key):
+        self.total[key] += 1
+        self.interval[key] += 1
+
+    def record(self, status, latency):
+        self.count("sent")
+        self.count("ok" if status is not None and status < 400 else "errors")
+        key = str(status) if status is not None else "transport"
+        self.status_codes[key] = self.status_codes.get(key, 0) + 1
+        self.latencies.append(latency)
+        self.interval_latencies.append(latency)
+
+    @staticmethod
+    def _report(counts, latencies, seconds):
+        sent = counts["sent"]
+        return {
+            "seconds": round(seconds, 1),
+            "scheduled_rate": round(counts["scheduled"] / seconds, 1) if seconds else 0,
+            "achieved_rate": round(counts["ok"] / seconds, 1) if seconds else 0,
+            "error_rate": round(counts["errors"] / sent, 4) if sent else 0.0,
+            "late": counts["late"],
+            "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "latency_p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+            "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        }
+
+    def interval_report(self):
+        report = self._report(
+            self.interval,
+            self.interval_latencies,
+            time.monotonic() - self.interval_started,
+        )
+        self._reset_interval()
+        return report
+
+    def summary(self):
+        report = self._report(
+            self.total, self.latencies, time.monotonic() - self.started
+        )
+        report.update(self.total)
+        report["status_codes"] = self.status_codes
+        return report
+
+
+async def _send_updates(client, queue, stats):
+    headers = {"Content-Type": "application/json"}
+    while True:
+        station, weathercode = await queue.get()
+        attrs = {
+            "weathercode": {
+                "type": "Number",
+                "value": weathercode,
+                "metadata": metrics.trace_metadata(metrics.new_trace_context()),
+            },
+            "timestamp": {
+                "type": "DateTime",
+                "value": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            },
+            "location": station["location"],
+        }
+        started = time.monotonic()
+        try:
+            res = await client.request(
+                "POST", f"/v2/entities/{station['id']}/attrs", json=attrs, headers=headers
+            )
+            status = res.status_code
+        except Exception as e:
+            logger.debug(f"Update of {station['id']} failed: {e!r}")
+            status = None
+        stats.record(status, time.monotonic() - started)
+        queue.task_done()
+
+
+async def run_load(
+    profile=LOAD_PROFILE,
+    rate=LOAD_RATE,
+    duration=LOAD_DURATION,
+    stations=None,
+    concurrency=LOAD_CONCURRENCY,
+    report_interval=LOAD_REPORT_INTERVAL,
+):
+    """
+    Sends weathercode updates to many stations following a load profile.
+
+    Updates are scheduled open loop at the profile's target rate and handed to
+    `concurrency` senders; each update alternates the station between rain and sun
+    codes so that every one triggers the weathercode subscriptions. Requests are not
+    retried, so Orion errors show up in the error rate instead of being hidden.
+    Args:
+        profile (str): One of LOAD_PROFILES.
+        rate (float): Updates per second (peak rate for "ramp").
+        duration (float): Length of the run in seconds.
+        stations (list): Station entities, load_stations() by default.
+        concurrency (int): Number of concurrent senders.
+        report_interval (float): Seconds between progress reports.
+    Returns:
+        dict: Summary with achieved rate, error rate and latency percentiles.
+    """
+    if profile not in LOAD_PROFILES:
+        raise ValueError(f"Unknown load profile {profile!r}, expected one of {LOAD_PROFILES}")
+    stations = stations if stations is not None else load_stations()
+
+    client = fiware_async.AsyncFiwareClient(
+        fiware.ORION_URL, pool_size=concurrency, concurrency=concurrency, retries=0
+    )
+    try:
+        result = await client.batch_upsert(stations)
+        logger.info(f"Load stations: {result.summary()}")
+
+        rain_codes = [61, 80]
+        sun_codes = [0, 1]
+        rng = random.Random(LOAD_SEED)
+        raining = {}
+
+        stats = LoadStats()
+        queue = asyncio.Queue(maxsize=concurrency)
+        senders = [
+            asyncio.create_task(_send_updates(client, queue, stats))
+            for _ in range(concurrency)
+        ]
+        logger.info(
+            f"Load run: profile={profile} rate={rate}/s stations={len(stations)} "
+            f"concurrency={concurrency} duration={duration}s"
+        )
+
+        tick = 0.01
+        credit = 0.0
+        next_report = report_interval
+        station_cycle = itertools.cycle(stations)
+        elapsed = 0.0
+        last = time.monotonic()
+        while elapsed < duration:
+            await asyncio.sleep(tick)
+            now = time.monotonic()
+            credit += target_rate(profile, elapsed, rate, duration) * (now - last)
+            elapsed += now - last
+            last = now
+            while credit >= 1:
+                credit -= 1
+                stats.count("scheduled")
+                station = next(station_cycle)
+                rain = raining[station["id"]] = not raining.get(station["id"], False)
+                weathercode = rng.choice(rain_codes if rain else sun_codes)
+                try:
+                    queue.put_nowait((station, weathercode))
+                except asyncio.QueueFull:
+                    stats.count("late")
+            if elapsed >= next_report:
+                report = stats.interval_report()
+                logger.info(
+                    f"[LOAD] t={elapsed:.0f}s target={target_rate(profile, elapsed, rate, duration):.1f}/s "
+                    f"achieved={report['achieved_rate']}/s errors={report['error_rate']:.2%} "
+                    f"late={report['late']} p95={report['latency_p95_ms']}ms"
+                )
+                next_report += report_interval
+
+        await queue.join()
+        for sender in senders:
+            sender.cancel()
+        await asyncio.gather(*senders, return_exceptions=True)
+    finally:
+        await client.aclose()
+
+    summary = stats.summary()
+    summary.update({"profile": profile, "rate": rate, "stations": len(stations)})
+    logger.info(f"[LOAD] Summary: {summary}")
+    return summary
+
+
 def main():
+    metrics.start_reporter("weather_simulator")
     fiware.wait_for_orion()
+    if SIMULATOR_MODE == "load":
+        # One httpx log line per request would dominate the run.
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        asyncio.run(run_load())
+        return
     create_entity()
     simulate_weather_loop()
 
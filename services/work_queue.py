@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import metrics
+
+logger = logging.getLogger("work_queue")
+
+NOTIFY_QUEUE_SIZE = int(os.environ.get("NOTIFY_QUEUE_SIZE", "1000"))
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS", "4"))
+NOTIFY_BATCH_SIZE = int(os.environ.get("NOTIFY_BATCH_SIZE", "50"))
+# Times the items of a failed batch are queued again before they are dropped.
+NOTIFY_RETRIES = int(os.environ.get("NOTIFY_RETRIES", "2"))
+RETRY_AFTER_SECONDS = 1
+
+
+class CoalescingQueue:
+    """
+    Bounded in-process work queue served by a pool of worker threads.
+
+    Items are queued under a key (the NGSI entity id). An item whose key is still
+    waiting replaces the pending one, so only the latest state of an entity is
+    processed, and it keeps its place in the queue. A key is never handed to two
+    workers at once, which keeps writes for the same entity in order.
+
+    Each worker owns a long-lived asyncio event loop, so coroutine handlers reuse the
+    per-loop pooled Orion client across batches.
+
+    When the handler raises, the items of the batch are queued again after
+    retry_delay seconds, up to retries times, unless a newer item of the same key
+    arrived meanwhile; then they are dropped and counted.
+
+    Args:
+        handler (callable): Called with a list of items; may be a coroutine function.
+        maxsize (int): Maximum number of pending keys before put() rejects new ones.
+        workers (int): Number of worker threads.
+        batch_size (int): Maximum number of items handed to one handler call.
+        name (str): Name used for the worker threads, logs and metrics.
+        retries (int): Times the items of a failed batch are queued again.
+        retry_delay (float): Seconds before a failed item is handed out again.
+    """
+
+    def __init__(
+        self,
+        handler,
+        maxsize=NOTIFY_QUEUE_SIZE,
+        workers=NOTIFY_WORKERS,
+        batch_size=NOTIFY_BATCH_SIZE,
+        name="notify",
+        retries=NOTIFY_RETRIES,
+        retry_delay=RETRY_AFTER_SECONDS,
+    ):
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = workers
+        self.batch_size = batch_size
+        self.name = name
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._pending = OrderedDict()
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._pid = None
+        self._stopping = False
+
+        self.accepted = 0
+        self.merged = 0
+        self.rejected = 0
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+        self._latencies = deque(maxlen=1000)
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so workers start lazily in each process.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._stopping = False
+        self._threads = [
+            threading.Thread(
+                target=self._run, name=f"{self.name}-worker-{i}", daemon=True
+            )
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, key, item):
+        """
+        Queue an item, merging it with a pending item of the same key.
+        Returns:
+            bool: False when the queue is full and the item was rejected.
+        """
+        return not self.put_many([(key, item)])
+
+    def put_many(self, keyed_items):
+        """
+        Queue several (key, item) pairs at once, so workers see them as one batch.
+        All or nothing: when the new keys do not all fit, none of the items is
+        queued, so a sender retrying the whole set does not repeat accepted items.
+        Returns:
+            list: Keys rejected because the queue is full, empty when all were queued.
+        """
+        with self._cond:
+            self._ensure_started()
+            new_keys = {key for key, _ in keyed_items if key not in self._pending}
+            if len(self._pending) + len(new_keys) > self.maxsize:
+                self.rejected += len(keyed_items)
+                return [key for key, _ in keyed_items]
+            now = time.monotonic()
+            for key, item in keyed_items:
+                if key in self._pending:
+                    # A newer item replaces a pending retry too: it starts afresh.
+                    enqueued_at, _, _, _ = self._pending[key]
+                    self._pending[key] = (enqueued_at, item, 0, now)
+                    self.merged += 1
+                else:
+                    self._pending[key] = (now, item, 0, now)
+                    self.accepted += 1
+            self._cond.notify_all()
+        return []
+
+    def stop(self, timeout=5):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _take_batch(self):
+        """
+        Returns:
+            tuple: (batch, wait) where wait is the number of seconds until a retried
+            item becomes ready when the batch is empty, else None.
+        """
+        batch = []
+        now = time.monotonic()
+        wait = None
+        for key in list(self._pending):
+            if key in self._in_flight:
+                continue
+            enqueued_at, item, attempts, ready_at = self._pending[key]
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                continue
+            del self._pending[key]
+            self._in_flight.add(key)
+            batch.append((key, enqueued_at, item, attempts))
+            if len(batch) >= self.batch_size:
+                break
+        return batch, None if batch else wait
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            while True:
+                with self._cond:
+                    batch, wait = self._take_batch()
+                    while not batch and not self._stopping:
+                        self._cond.wait(wait)
+                        batch, wait = self._take_batch()
+                    if not batch:
+                        return
+                self._process(loop, batch)
+        finally:
+            loop.close()
+
+    def _process(self, loop, batch):
+        items = [item for _, _, item, _ in batch]
+        try:
+            result = self.handler(items)
+            if asyncio.iscoroutine(result):
+                loop.run_until_complete(result)
+            succeeded = True
+        except Exception as e:
+            logger.exception(f"[{self.name}] Error processing {len(items)} items: {e}")
+            succeeded = False
+        metrics.QUEUE_BATCHES.labels(self.name, "ok" if succeeded else "failed").inc()
+
+        done_at = time.monotonic()
+        dropped = 0
+        with self._cond:
+            for key, enqueued_at, item, attempts in batch:
+                self._in_flight.discard(key)
+                if not succeeded:
+                    if key in self._pending:
+                        # A newer item of this key is queued; it supersedes this one.
+                        continue
+                    if attempts < self.retries:
+                        ready_at = done_at + self.retry_delay
+                        self._pending[key] = (enqueued_at, item, attempts + 1, ready_at)
+                        self.retried += 1
+                        continue
+                    dropped += 1
+                latency = done_at - enqueued_at
+                self._latencies.append(latency)
+                self._latency_sum += latency
+                self._latency_max = max(self._latency_max, latency)
+            if succeeded:
+                self.processed += len(batch)
+            self.failed += dropped
+            # Keys skipped while in flight may be ready for another worker now.
+            self._cond.notify_all()
+        if dropped:
+            metrics.QUEUE_DROPPED.labels(self.name).inc(dropped)
+            logger.error(
+                f"[{self.name}] Dropped {dropped} items after {self.retries} retries"
+            )
+
+    def stats(self):
+        with self._cond:
+            latencies = sorted(self._latencies)
+            completed = self.processed + self.failed
+            return {
+                "depth": len(self._pending),
+                "in_flight": len(self._in_flight),
+                "maxsize": self.maxsize,
+                "accepted": self.accepted,
+                "merged": self.merged,
+                "rejected": self.rejected,
+                "processed": self.processed,
+                "retried": self.retried,
+                "failed": self.failed,
+                "latency_seconds": {
+                    "avg": self._latency_sum / completed if completed else 0.0,
+                    "max": self._latency_max,
+                    "p50": _percentile(latencies, 0.50),
+                    "p95": _percentile(latencies, 0.95),
+                },
+            }
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def enqueue_notification(queue, payload):
+    """
+    Splits an Orion notification into its entities and queues them by entity id.
+    Returns:
+        int: HTTP status for Orion: 202 when queued, 204 when there is nothing to do,
+        503 when the queue is full (the caller should send Retry-After). The entities
+        are queued all or none, so Orion's resend of a 503 repeats nothing.
+    """
+    data = (payload or {}).get("data")
+    if not data:
+        logger.warning("Payload does not contain 'data' key")
+        return 204
+
+    rejected = queue.put_many([(entity.get("id"), entity) for entity in data])
+    if rejected:
+        logger.warning(
+            f"[{queue.name}] Queue full, rejecting {len(rejected)} entities"
+        )
+        return 503
+    return 202
+
+
+def response_headers(status):
+    """
+    Headers to send back to Orion for a status returned by enqueue_notification.
+    """
+    if status == 503:
+        return {"Retry-After": str(RETRY_AFTER_SECONDS)}
+    return {}